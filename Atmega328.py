@@ -22,9 +22,67 @@
 #
 #
 
+import os
 import re
-from sim_mem import Memory
-from pyparsing import Word, alphas, nums, alphanums, Literal, Suppress, ZeroOrMore, Optional, hexnums
+import sys
+import zlib
+from array import array
+from sim_mem import Memory, MemoryFault
+from sim_elf import load_elf
+from sim_alu import Alu, ADD_MASK, SUB_MASK, SBC_MASK, LOGIC_MASK, INC_MASK, COM_MASK, NEG_MASK, SHIFT_MASK, Z as Z_FLAG
+from pyparsing import Word, alphas, nums, alphanums, Literal, Suppress, ZeroOrMore, Optional, hexnums, ParserElement
+
+# pyparsing queda solo para las lineas que no reconoce el camino rapido
+# (ver Atmega328.fast_operands); con packrat no repite subanalisis
+ParserElement.enable_packrat()
+
+
+def stub(fn):
+    """ Marca un manejador que todavia no simula nada (ver sim_block)
+    """
+    fn.stub = True
+    return fn
+
+
+def compile_opdcmd(cmd):
+    """ Traduce la descripcion de operandos de la tabla (p.ej. "r4d5r1")
+        a un programa de extraccion: tupla de pasos
+            (campo, desplazamiento, ancho, desplazamiento destino)
+        Los campos '-' (bits fijos) no generan pasos. Un '!' inicial indica
+        instruccion de 32 bits: el programa se aplica a (opc << 16) | opc2.
+        Devuelve (programa, tamano de la instruccion en bytes).
+    """
+    size = 2
+    if cmd[:1] == "!":
+        cmd = cmd[1:]
+        size = 4
+
+    prog = []
+    dest = {}
+    shift = 0                                   # Ej.: r4d5r1 (para ADC)
+    for name, width in re.findall(r"([a-zA-Z-])(\d+)", cmd):
+        width = int(width)                      #  (r,0,4,0) (d,4,5,0)
+        if name != "-":                         #  (r,9,1,4)
+            prog.append((name, shift, width, dest.get(name, 0)))
+            dest[name] = dest.get(name, 0) + width
+        shift += width
+
+    return tuple(prog), size
+
+
+def compile_extractor(prog):
+    """ Genera una funcion f(opc, pc) que devuelve el diccionario de
+        operandos, sin expresiones regulares ni listas intermedias.
+    """
+    fields = {}
+    for name, shift, width, dest in prog:
+        fields.setdefault(name, []).append(
+                "((opc >> {:d}) & 0x{:x}) << {:d}".format(shift, (1 << width) - 1, dest))
+
+    src = "lambda opc, pc: {{'pc': pc{:s}}}".format(
+                "".join(", '{:s}': {:s}".format(name, " | ".join(parts))
+                            for name, parts in fields.items()))
+    return eval(src)
 
 
 class OPC():
@@ -35,7 +93,7 @@ class OPC():
     fmt       = None
     sim_instr = None
 
-    def __init__(self, mask, remainder, opcstr, opdcmd, fmt, sim_instr, code_opd, token):
+    def __init__(self, mask, remainder, opcstr, opdcmd, fmt, sim_instr, code_opd, token, cycles):
         self.mask = mask
         self.remainder = remainder
         self.opcstr = opcstr
@@ -44,6 +102,52 @@ class OPC():
         self.sim_instr = sim_instr
         self.code_opd = code_opd
         self.token = token
+        # Ciclos: un entero, o una tupla indexada por lo que devuelve el
+        # manejador (saltos: 1 si se toma; salteos: palabras salteadas)
+        self.cycles = cycles if isinstance(cycles, tuple) else (cycles,)
+        self.opd_prog, self.size = compile_opdcmd(opdcmd)
+        self.extract = compile_extractor(self.opd_prog)
+
+
+class StopReason():
+    """ Resultado de Atmega328.run(): por que se detuvo, en que pc,
+        cuantas instrucciones ejecuto y cuantos ciclos tardo (None si el
+        cpu no esta en modo de ciclos exactos).
+    """
+    BUDGET, UNTIL_PC, BREAKPOINT, BREAK, SLEEP, UNDECODED, FAULT = range(7)
+    names = ("budget", "until_pc", "breakpoint", "break", "sleep", "undecoded",
+             "fault")
+
+    def __init__(self, reason, pc, instructions, cycles = None, fault = None):
+        self.reason = reason
+        self.pc = pc
+        self.instructions = instructions
+        self.cycles = cycles
+        self.fault = fault              # MemoryFault, si reason es FAULT
+
+    def __str__(self):
+        s = "{:s} en 0x{:04x} ({:d} instrucciones".format(
+                    self.names[self.reason], self.pc, self.instructions)
+        if self.cycles != None:
+            s += ", {:d} ciclos".format(self.cycles)
+        if self.fault != None:
+            s += ", {!s}".format(self.fault)
+        return s + ")"
+
+
+class Snapshot():
+    """ Estado completo de la maquina, devuelto por Atmega328.snapshot().
+        El espacio de datos se guarda en bytes y la flash como el estado
+        inmutable de Memory.snapshot(), que se comparte entre snapshots
+        mientras no cambie.
+    """
+    def __init__(self, data, flags, pc, cycles, halted, flash):
+        self.data = data
+        self.flags = flags
+        self.pc = pc
+        self.cycles = cycles
+        self.halted = halted
+        self.flash = flash
 
 
 class Atmega328():
@@ -53,54 +157,67 @@ class Atmega328():
     
     symtable = None
 
-    imm_4      = lambda d, s: "{K[0]:d}".format(**d)
-    bit        = lambda d, s: "{s[0]:d}".format(**d)
-    reg        = lambda d, s: "r{d[0]:d}".format(**d)
-    reg_imm    = lambda d, s: "r{d[0]:d}, 0x{K[0]:x}".format(**d)
-    reg8_imm   = lambda d, s: "r{:d}, 0x{:x}".format(d["d"][0] + 16, d["K"][0])
-    reg_imm16  = lambda d, s: "r{d[0]:d}, 0x{k[0]:x}".format(**d)
-    imm7_reg   = lambda d, s: "0x{k[0]:x}, r{d[0]:d}".format(**d)
-    imm16_reg  = lambda d, s: "0x{k[0]:x}, r{d[0]:d}".format(**d)
-    reg_bit    = lambda d, s: "r{d[0]:d}, {b[0]:x}".format(**d)
-    bit_reg    = lambda d, s: "{b[0]:x}, r{d[0]:d}".format(**d)
-    reg_reg    = lambda d, s: "r{d[0]:d}, r{r[0]:d}".format(**d)
-    reg3_reg3  = lambda d, s: "r{:d}, r{:d}".format(d["d"][0] + 16, d["r"][0] + 16)
-    reg4_reg4  = lambda d, s: "r{:d}, r{:d}".format(d["d"][0] + 16, d["r"][0] + 16)
-    reg4       = lambda d, s: "r{:d}".format(d["d"][0] + 16)
-    reg_x      = lambda d, s: "r{d[0]:d}, X".format(**d)
-    reg_x      = lambda d, s: "r{d[0]:d}, X".format(**d)
-    reg_mx     = lambda d, s: "r{d[0]:d}, -X".format(**d)
-    reg_xp     = lambda d, s: "r{d[0]:d}, X+".format(**d)
-    reg_y      = lambda d, s: "r{d[0]:d}, Y".format(**d)
-    reg_yp     = lambda d, s: "r{d[0]:d}, Y+".format(**d)
-    reg_my     = lambda d, s: "r{d[0]:d}, -Y".format(**d)
-    reg_yo     = lambda d, s: "r{d[0]:d}, Y+{q[0]:d}".format(**d)
-    reg_z      = lambda d, s: "r{d[0]:d}, Z".format(**d)
-    reg_zp     = lambda d, s: "r{d[0]:d}, Z+".format(**d)
-    reg_mz     = lambda d, s: "r{d[0]:d}, -Z".format(**d)
-    reg_zo     = lambda d, s: "r{d[0]:d}, Z+{q[0]:d}".format(**d)
-    reg_io     = lambda d, s: "r{d[0]:d}, 0x{A[0]:02x}".format(**d)
-    x_reg      = lambda d, s: "X, r{r[0]:d}".format(**d)
-    xp_reg     = lambda d, s: "X+, r{r[0]:d}".format(**d)
-    mx_reg     = lambda d, s: "-X, r{r[0]:d}".format(**d)
-    y_reg      = lambda d, s: "Y, r{r[0]:d}".format(**d)
-    yp_reg     = lambda d, s: "Y+, r{r[0]:d}".format(**d)
-    my_reg     = lambda d, s: "-Y, r{r[0]:d}".format(**d)
-    yo_reg     = lambda d, s: "Y+{q[0]:d}, r{r[0]:d}".format(**d)
-    z_reg      = lambda d, s: "Z, r{d[0]:d}".format(**d)
-    zp_reg     = lambda d, s: "Z+, r{d[0]:d}".format(**d)
-    mz_reg     = lambda d, s: "-Z, r{d[0]:d}".format(**d)
-    zo_reg     = lambda d, s: "Z+{q[0]:d}, r{d[0]:d}".format(**d)
-    dreg_imm   = lambda d, s: "r{:d}, 0x{:x}".format(d["d"][0]*2+24, d["K"][0])
-    dreg_dreg  = lambda d, s: "r{:d}, r{:x}".format(d["d"][0]*2, d["r"][0]*2)
-    rel_add    = lambda d, s: "0x{:04x}".format(s.calc_addr(d["pc"], d["k"][0], 128))
-    rel_add12  = lambda d, s: "0x{:04x}".format(s.calc_addr(d["pc"], d["k"][0], 4096))
-    add17      = lambda d, s: "0x{k[0]:04x}".format(**d)
-    bit_rel    = lambda d, s: "{s[0]:d}, 0x{k[0]:04x}".format(**d)
+    NO_OPCODE    = 0xffff      # Marca de palabra sin instruccion en decode_table
+    PC_MASK      = 0x7fff      # El pc (en bytes) recorre los 32K de flash
+    decode_table = None        # Compartida por todas las instancias
+    instructions = None        # mnemonico -> entrada (find_instruction)
+
+    # Espacio de datos: registros, E/S, E/S extendida y SRAM
+    IO_START     = 0x0020
+    EXT_IO_START = 0x0060
+    SRAM_START   = 0x0100
+    RAMEND       = 0x08ff
+    DATA_SIZE    = RAMEND + 1
+    SPL, SPH, SREG = 0x5d, 0x5e, 0x5f
+
+    imm_4      = lambda d, s: "{K:d}".format(**d)
+    bit        = lambda d, s: "{s:d}".format(**d)
+    reg        = lambda d, s: "r{d:d}".format(**d)
+    reg_imm    = lambda d, s: "r{d:d}, 0x{K:x}".format(**d)
+    reg8_imm   = lambda d, s: "r{:d}, 0x{:x}".format(d["d"] + 16, d["K"])
+    reg_imm16  = lambda d, s: "r{d:d}, 0x{k:x}".format(**d)
+    imm7_reg   = lambda d, s: "0x{k:x}, r{d:d}".format(**d)
+    imm16_reg  = lambda d, s: "0x{k:x}, r{d:d}".format(**d)
+    reg_bit    = lambda d, s: "r{d:d}, {b:x}".format(**d)
+    bit_reg    = lambda d, s: "{b:x}, r{d:d}".format(**d)
+    reg_reg    = lambda d, s: "r{d:d}, r{r:d}".format(**d)
+    reg3_reg3  = lambda d, s: "r{:d}, r{:d}".format(d["d"] + 16, d["r"] + 16)
+    reg4_reg4  = lambda d, s: "r{:d}, r{:d}".format(d["d"] + 16, d["r"] + 16)
+    reg4       = lambda d, s: "r{:d}".format(d["d"] + 16)
+    reg_x      = lambda d, s: "r{d:d}, X".format(**d)
+    reg_x      = lambda d, s: "r{d:d}, X".format(**d)
+    reg_mx     = lambda d, s: "r{d:d}, -X".format(**d)
+    reg_xp     = lambda d, s: "r{d:d}, X+".format(**d)
+    reg_y      = lambda d, s: "r{d:d}, Y".format(**d)
+    reg_yp     = lambda d, s: "r{d:d}, Y+".format(**d)
+    reg_my     = lambda d, s: "r{d:d}, -Y".format(**d)
+    reg_yo     = lambda d, s: "r{d:d}, Y+{q:d}".format(**d)
+    reg_z      = lambda d, s: "r{d:d}, Z".format(**d)
+    reg_zp     = lambda d, s: "r{d:d}, Z+".format(**d)
+    reg_mz     = lambda d, s: "r{d:d}, -Z".format(**d)
+    reg_zo     = lambda d, s: "r{d:d}, Z+{q:d}".format(**d)
+    reg_io     = lambda d, s: "r{d:d}, 0x{A:02x}".format(**d)
+    x_reg      = lambda d, s: "X, r{r:d}".format(**d)
+    xp_reg     = lambda d, s: "X+, r{r:d}".format(**d)
+    mx_reg     = lambda d, s: "-X, r{r:d}".format(**d)
+    y_reg      = lambda d, s: "Y, r{r:d}".format(**d)
+    yp_reg     = lambda d, s: "Y+, r{r:d}".format(**d)
+    my_reg     = lambda d, s: "-Y, r{r:d}".format(**d)
+    yo_reg     = lambda d, s: "Y+{q:d}, r{r:d}".format(**d)
+    z_reg      = lambda d, s: "Z, r{r:d}".format(**d)
+    zp_reg     = lambda d, s: "Z+, r{r:d}".format(**d)
+    mz_reg     = lambda d, s: "-Z, r{r:d}".format(**d)
+    zo_reg     = lambda d, s: "Z+{q:d}, r{r:d}".format(**d)
+    dreg_imm   = lambda d, s: "r{:d}, 0x{:x}".format(d["d"]*2+24, d["K"])
+    dreg_dreg  = lambda d, s: "r{:d}, r{:x}".format(d["d"]*2, d["r"]*2)
+    rel_add    = lambda d, s: "0x{:04x}".format(s.calc_addr(d["pc"], d["k"], 128))
+    rel_add12  = lambda d, s: "0x{:04x}".format(s.calc_addr(d["pc"], d["k"], 4096))
+    add17      = lambda d, s: "0x{k:04x}".format(**d)
+    bit_rel    = lambda d, s: "{s:d}, 0x{k:04x}".format(**d)
     no_opd     = lambda d, s: ""
-    io_bit     = lambda d, s: "0x{A[0]:02x}, {b[0]:d}".format(**d)
-    io_reg     = lambda d, s: "0x{A[0]:02x}, r{r[0]:d}".format(**d)
-    reg8_reg8  = lambda d, s: "r{:d}, r{:d}".format(d["d"][0]+16, d["r"][0]+16)
+    io_bit     = lambda d, s: "0x{A:02x}, {b:d}".format(**d)
+    io_reg     = lambda d, s: "0x{A:02x}, r{r:d}".format(**d)
+    reg8_reg8  = lambda d, s: "r{:d}, r{:d}".format(d["d"]+16, d["r"]+16)
     just_zp    = lambda d, s: "Z+"
 
     #ENUM
@@ -159,682 +276,765 @@ class Atmega328():
     jmp = Suppress(Word(alphas)) + (Word(nums) | Word(alphas))
     jmp.setParseAction(convert_jmp_0)
 
+    #Camino rapido: expresiones regulares precompiladas para las formas
+    #habituales de cada token. Son mas estrictas que pyparsing (espacio
+    #despues del mnemonico, "r" pegada al numero): lo que no reconocen, o
+    #queda fuera de rango, lo resuelve pyparsing.
+    FAST_LABEL = re.compile(r"\s*([A-Za-z][A-Za-z0-9]*)\s*:")
+    FAST_MNEMONIC = r"\s*[A-Za-z]+\s+"
+    FAST_COMMENT = r"(?:\s*;\s*[A-Za-z0-9]+)?\s*$"
+
+    def fast_d0_31(m):
+        d = int(m.group(1))
+        return [d] if d <= 31 else None
+
+    def fast_d0_31_r0_31(m):
+        d, r = int(m.group(1)), int(m.group(2))
+        return [d, r] if d <= 31 and r <= 31 else None
+
+    def fast_d24_30_k0_63(m):
+        d, k = int(m.group(1)), int(m.group(2), 16)
+        return [(d - 24) // 2, k] if 24 <= d <= 30 and d % 2 == 0 and k <= 63 else None
+
+    def fast_d16_31_k0_255(m):
+        d, k = int(m.group(1)), int(m.group(2), 16)
+        return [d - 16, k] if 16 <= d <= 31 and k <= 255 else None
+
+    def fast_d0_31_b0_7(m):
+        d, b = int(m.group(1)), int(m.group(2))
+        return [d, b] if d <= 31 and b <= 7 else None
+
+    def fast_jmp(m):
+        try:
+            return [Atmega328.symtable[m.group(1)]]
+        except (KeyError, TypeError):
+            return None
+
+    # id del token -> (expresion regular de la linea, conversion)
+    fast_parsers = {
+        id(d0_31):          (re.compile(FAST_MNEMONIC + r"r(\d+)" + FAST_COMMENT),
+                             fast_d0_31),
+        id(d0_31_r0_31):    (re.compile(FAST_MNEMONIC + r"r(\d+)\s*,\s*r(\d+)" + FAST_COMMENT),
+                             fast_d0_31_r0_31),
+        id(d24_30_k0_63):   (re.compile(FAST_MNEMONIC + r"r(\d+)\s*,\s*0x([0-9a-fA-F]+)" + FAST_COMMENT),
+                             fast_d24_30_k0_63),
+        id(d16_31_k0_255):  (re.compile(FAST_MNEMONIC + r"r(\d+)\s*,\s*0x([0-9a-fA-F]+)" + FAST_COMMENT),
+                             fast_d16_31_k0_255),
+        id(d0_31_b0_7):     (re.compile(FAST_MNEMONIC + r"r(\d+)\s*,\s*(\d+)" + FAST_COMMENT),
+                             fast_d0_31_b0_7),
+        id(jmp):            (re.compile(FAST_MNEMONIC + r"([A-Za-z]+)" + FAST_COMMENT),
+                             fast_jmp),
+    }
+
     #GRUPO N
+    @stub
     def f_imm_4(self, opcstr, opd_dict):
         pass
 
+    @stub
     def f_bit(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    @stub
     def f_reg(self, opcstr, opd_dict):
-        d = opd_dict["d"][0]
+        pass
 
-        #TST
-        if opcstr == "tst":
-            #calculo del resultado
-            res = self.ram[d] & self.ram[d]
-            
-            #calculo de v
-            self.set_flag(self.V,0)
-            
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
-            
-            #calculo de s
-            self.set_flag(self.S,self.get_flag(self.N) ^ self.get_flag(self.V))
+    #GRUPO N
+    def f_asr(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+
+        #resultado y banderas desde la tabla
+        i = self.ram[d]
+        v = Alu.asr[i]
+        if self.lazy_flags:
+            self.defer_flags(SHIFT_MASK, Alu.asr, i, 8)
+        else:
+            self._flags = (self._flags & ~SHIFT_MASK) | (v >> 8)
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
     #GRUPO N
-    def f_reg_imm(self, opcstr, opd_dict):
-        pass
+    def f_com(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+
+        #resultado y banderas desde la tabla
+        i = self.ram[d]
+        v = Alu.com[i]
+        if self.lazy_flags:
+            self.defer_flags(COM_MASK, Alu.com, i, 8)
+        else:
+            self._flags = (self._flags & ~COM_MASK) | (v >> 8)
+
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
     #GRUPO N
-    def f_reg8_imm(self, opcstr, opd_dict):
-        d = opd_dict["d"][0] + 16
-        k = opd_dict["K"][0]
+    def f_dec(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+
+        #resultado y banderas desde la tabla
+        i = self.ram[d]
+        v = Alu.dec[i]
+        if self.lazy_flags:
+            self.defer_flags(INC_MASK, Alu.dec, i, 8)
+        else:
+            self._flags = (self._flags & ~INC_MASK) | (v >> 8)
+
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-        #ANDI
-        if opcstr == "andi":
-            #calculo del resultado
-            res = self.ram[d] & k
+    #GRUPO N
+    def f_inc(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+
+        #resultado y banderas desde la tabla
+        i = self.ram[d]
+        v = Alu.inc[i]
+        if self.lazy_flags:
+            self.defer_flags(INC_MASK, Alu.inc, i, 8)
+        else:
+            self._flags = (self._flags & ~INC_MASK) | (v >> 8)
 
-            #calculo de v
-            self.set_flag(self.V,0)
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
+
+    #GRUPO N
+    def f_lsr(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+
+        #resultado y banderas desde la tabla
+        i = self.ram[d]
+        v = Alu.lsr[i]
+        if self.lazy_flags:
+            self.defer_flags(SHIFT_MASK, Alu.lsr, i, 8)
+        else:
+            self._flags = (self._flags & ~SHIFT_MASK) | (v >> 8)
 
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-            #calculo de s
-            self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
+    #GRUPO N
+    def f_neg(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+
+        #resultado y banderas desde la tabla
+        i = self.ram[d]
+        v = Alu.neg[i]
+        if self.lazy_flags:
+            self.defer_flags(NEG_MASK, Alu.neg, i, 8)
+        else:
+            self._flags = (self._flags & ~NEG_MASK) | (v >> 8)
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-        #CPI
-        elif opcstr == "cpi":
-            #calculo del resultado
-            res = self.ram[d] - k
+    #GRUPO N
+    def f_ror(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+
+        #resultado y banderas desde la tabla
+        i = ((self.flags & 0x01) << 8) | self.ram[d]
+        v = Alu.ror[i]
+        if self.lazy_flags:
+            self.defer_flags(SHIFT_MASK, Alu.ror, i, 8)
+        else:
+            self._flags = (self._flags & ~SHIFT_MASK) | (v >> 8)
 
-            #calculo de h
-            d3 = self.get_bit(self.ram[d], 3)
-            k3 = self.get_bit(k, 3)
-            res3 = self.get_bit(res, 3)
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-            self.set_flag(self.H, (~d3) & k3 | k3 & res3 | res3 & (~d3))
+    #GRUPO N
+    def f_tst(self, opcstr, opd_dict):
+        d = opd_dict["d"]
 
-            #calculo de v
-            d7 = self.get_bit(self.ram[d], 7)
-            k7 = self.get_bit(k, 7)
-            res7 = self.get_bit(res, 7)
+        #calculo del resultado
+        res = self.ram[d]
 
-            self.set_flag(self.V, d7 & (~k7) & (~res7) | (~d7) & k7 & res7)
+        #banderas desde la tabla
+        if self.lazy_flags:
+            self.defer_flags(LOGIC_MASK, Alu.logic, res, 0)
+        else:
+            self._flags = (self._flags & ~LOGIC_MASK) | Alu.logic[res]
 
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
+    #GRUPO N
+    @stub
+    def f_reg_imm(self, opcstr, opd_dict):
+        pass
 
-            #calculo de s
-            self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
+    #GRUPO N
+    @stub
+    def f_reg8_imm(self, opcstr, opd_dict):
+        pass
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
+    #GRUPO N
+    def f_andi(self, opcstr, opd_dict):
+        d = opd_dict["d"] + 16
+        k = opd_dict["K"]
 
-            #calculo de c
-            if k > self.ram[d]:
-                self.set_flag(self.C,1)
-            else:
-                self.set_flag(self.C,0)
-        #ORI
-        elif opcstr == "ori":
-            #calculo del resultado
-            res = self.ram[d] | k
-            
-            #calculo de v
-            self.set_flag(self.V,0)
-            
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
-            
-            #calculo de s
-            self.set_flag(self.S,self.get_flag(self.N) ^ self.get_flag(self.V))
+        #calculo del resultado
+        res = self.ram[d] & k
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
-    
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-        #SBCI
-        elif opcstr == "sbci":
-            #calculo del resultado
-            res = self.ram[d] - k - self.get_flag(7)
-
-            #calculo de h
-            d3 = self.get_bit(self.ram[d], 3)
-            k3 = self.get_bit(k, 3) 
-            res3 = self.get_bit(res, 3)
-    
-            self.set_flag(self.H, (~d3) & k3 | k3 & res3 | res3 & (~d3))
+        #banderas desde la tabla
+        if self.lazy_flags:
+            self.defer_flags(LOGIC_MASK, Alu.logic, res, 0)
+        else:
+            self._flags = (self._flags & ~LOGIC_MASK) | Alu.logic[res]
+
+        #guardado del resultado en el registro
+        self.ram[d] = res
+
+    #GRUPO N
+    def f_cpi(self, opcstr, opd_dict):
+        d = opd_dict["d"] + 16
+        k = opd_dict["K"]
+
+        #solo banderas: en modo perezoso ni siquiera se consulta la tabla
+        i = (self.ram[d] << 8) | k
+        if self.lazy_flags:
+            self.defer_flags(SUB_MASK, Alu.sub, i, 8)
+        else:
+            self._flags = (self._flags & ~SUB_MASK) | (Alu.sub[i] >> 8)
 
-            #calculo de v
-            d7 = self.get_bit(self.ram[d], 7) 
-            k7 = self.get_bit(k, 7) 
-            res7 = self.get_bit(res, 7)
+    #GRUPO N
+    def f_ori(self, opcstr, opd_dict):
+        d = opd_dict["d"] + 16
+        k = opd_dict["K"]
 
-            self.set_flag(self.V, d7 & (~k7) & (~res7) | (~d7) & k7 & res7)
+        #calculo del resultado
+        res = self.ram[d] | k
 
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
+        #banderas desde la tabla
+        if self.lazy_flags:
+            self.defer_flags(LOGIC_MASK, Alu.logic, res, 0)
+        else:
+            self._flags = (self._flags & ~LOGIC_MASK) | Alu.logic[res]
 
-            #calculo de s
-            self.set_flag(self.S,self.get_flag(self.N) ^ self.get_flag(self.V))
+        #guardado del resultado en el registro
+        self.ram[d] = res
 
-            #calculo de z
-            if res & 0xff != 0:
-                self.set_flag(self.Z, 0)
+    #GRUPO N
+    def f_sbci(self, opcstr, opd_dict):
+        d = opd_dict["d"] + 16
+        k = opd_dict["K"]
 
-            #calculo de c
-            d7 = self.get_bit(self.ram[d], 7) 
-            k7 = self.get_bit(k, 7) 
-            res7 = self.get_bit(res, 7)
+        #resultado y banderas desde la tabla
+        v = Alu.sub[((self.flags & 0x01) << 16) | (self.ram[d] << 8) | k]
+        f = v >> 8
+        self.flags = (self.flags & ~SBC_MASK & (f | ~Z_FLAG)) | (f & SBC_MASK)
 
-            self.set_flag(self.C, (~d7) & k7 | k7 & res7 | res7 & (~d7))
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
+
+    #GRUPO N
+    def f_subi(self, opcstr, opd_dict):
+        d = opd_dict["d"] + 16
+        k = opd_dict["K"]
+
+        #resultado y banderas desde la tabla
+        i = (self.ram[d] << 8) | k
+        v = Alu.sub[i]
+        if self.lazy_flags:
+            self.defer_flags(SUB_MASK, Alu.sub, i, 8)
+        else:
+            self._flags = (self._flags & ~SUB_MASK) | (v >> 8)
+
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-            
     #GRUPO N
     def f_reg_imm16(self, opcstr, opd_dict):
-        pass
+        #lds
+        self.ram[opd_dict["d"]] = self.read_data(opd_dict["k"])
 
     #GRUPO N
+    @stub
     def f_imm7_reg(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
     def f_imm16_reg(self, opcstr, opd_dict):
-        pass
+        #sts
+        self.write_data(opd_dict["k"], self.ram[opd_dict["d"]])
 
     #GRUPO 4
+    @stub
     def f_reg_bit(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    @stub
     def f_bit_reg(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    @stub
     def f_reg_reg(self, opcstr, opd_dict):
-        d = opd_dict["d"][0]
-        r = opd_dict["r"][0]
-
-        #ADC
-        if opcstr == "adc":
-            #calculo del resultado
-            res = self.ram[r] + self.ram[d] + self.get_flag(self.C)
-
-
-            #calculo de h
-            d3 = self.get_bit(self.ram[d], 3)
-            r3 = self.get_bit(self.ram[r], 3)
-            res3 = self.get_bit(res, 3)
-
-            self.set_flag(self.H, d3 & r3 | r3 & (~res3) | (~res3) & d3)
-
-            #calculo de v
-            d7 = self.get_bit(self.ram[d], 7)
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
-
-            self.set_flag(self.V, d7 & r7 & (~res7) | (~d7) & (~r7) & res7)
-
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
-
-            #calculo de s
-            self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
-
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
-            print(self.flags)
-
-
-            #calculo de c
-            crr = self.get_bit(res,8)
-            self.set_flag(self.C,crr)
-
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-        #ADD
-        elif opcstr == "add":
-            #calculo del resultado
-            res = self.ram[r] + self.ram[d]
-
-            #calculo de h
-            d3 = self.get_bit(self.ram[d], 3)
-            r3 = self.get_bit(self.ram[r], 3)
-            res3 = self.get_bit(res, 3)
-
-            self.set_flag(self.H, d3 & r3 | r3 & (~res3) | (~res3) & d3)
-
-            #calculo de v
-            d7 = self.get_bit(self.ram[d], 7)
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
-
-            self.set_flag(self.V, d7 & r7 & (~res7) | (~d7) & (~r7) & res7)
-
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
-
-            #calculo de s
-            self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
-
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
-
-            #calculo de c
-            c = self.get_bit(res ,8)
-            self.set_flag(self.C, c)
-
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-        #AND
-        elif opcstr == "and":
-            #calculo del resultado
-            res = self.ram[d] & self.ram[r]
-
-            #calculo de v
-            self.set_flag(self.V,0)
-
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
-
-            #calculo de s
-            self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
+        pass
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
+    #GRUPO N
+    def f_adc(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
+
+        #resultado y banderas desde la tabla
+        i = ((self.flags & 0x01) << 16) | (self.ram[d] << 8) | self.ram[r]
+        v = Alu.add[i]
+        if self.lazy_flags:
+            self.defer_flags(ADD_MASK, Alu.add, i, 8)
+        else:
+            self._flags = (self._flags & ~ADD_MASK) | (v >> 8)
 
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-        #CP
-        elif opcstr == "cp":
-            #calculo del resultado
-            res = self.ram[d] - self.ram[r]
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-            #calculo de h
-            d3 = self.get_bit(self.ram[d], 3)
-            r3 = self.get_bit(self.ram[r], 3)
-            res3 = self.get_bit(res, 3)
+    #GRUPO N
+    def f_add(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
+
+        #resultado y banderas desde la tabla
+        i = (self.ram[d] << 8) | self.ram[r]
+        v = Alu.add[i]
+        if self.lazy_flags:
+            self.defer_flags(ADD_MASK, Alu.add, i, 8)
+        else:
+            self._flags = (self._flags & ~ADD_MASK) | (v >> 8)
 
-            self.set_flag(self.H, (~d3) & r3 | r3 & res3 | res3 & (~d3))
-            #calculo de v
-            d7 = self.get_bit(self.ram[d], 7)
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-            self.set_flag(self.V, d7 & (~r7) & (~res7) | (~d7) & r7 & res7)
+    #GRUPO N
+    def f_and(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
 
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
+        #calculo del resultado
+        res = self.ram[d] & self.ram[r]
 
-            #calculo de s
-            self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
+        #banderas desde la tabla
+        if self.lazy_flags:
+            self.defer_flags(LOGIC_MASK, Alu.logic, res, 0)
+        else:
+            self._flags = (self._flags & ~LOGIC_MASK) | Alu.logic[res]
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
+        #guardado del resultado en el registro
+        self.ram[d] = res
 
-            #calculo de c
-            d7 = self.get_bit(self.ram[d], 7)
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
+    #GRUPO N
+    def f_cp(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
+
+        #solo banderas: en modo perezoso ni siquiera se consulta la tabla
+        i = (self.ram[d] << 8) | self.ram[r]
+        if self.lazy_flags:
+            self.defer_flags(SUB_MASK, Alu.sub, i, 8)
+        else:
+            self._flags = (self._flags & ~SUB_MASK) | (Alu.sub[i] >> 8)
 
-            self.set_flag(self.C, (~d7) & r7 | r7 & res7 | res7 & (~d7))
-        #CPC
-        elif opcstr == "cpc":
-            #calculo del resultado
-            res = self.ram[d] - self.ram[r] - self.get_flag(7)
+    #GRUPO N
+    def f_cpc(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
 
-            #calculo de h
-            d3 = self.get_bit(self.ram[d], 3)
-            r3 = self.get_bit(self.ram[r], 3)
-            res3 = self.get_bit(res, 3)
+        #resultado y banderas desde la tabla
+        v = Alu.sub[((self.flags & 0x01) << 16) | (self.ram[d] << 8) | self.ram[r]]
+        f = v >> 8
+        self.flags = (self.flags & ~SBC_MASK & (f | ~Z_FLAG)) | (f & SBC_MASK)
 
-            self.set_flag(self.H, (~d3) & r3 | r3 & res3 | res3 & (~d3))
+    #GRUPO N
+    def f_cpse(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
 
-            #calculo de v
-            d7 = self.get_bit(self.ram[d], 7)
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
+        #si son iguales se saltea la instruccion siguiente
+        if self.ram[d] == self.ram[r]:
+            return self.skip_next()
 
-            self.set_flag(self.V, d7 & (~r7) & (~res7) | (~d7) & r7 & res7)
+    #GRUPO N
+    def f_eor(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
 
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
+        #calculo del resultado
+        res = self.ram[d] ^ self.ram[r]
 
-            #calculo de s
-            self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
+        #banderas desde la tabla
+        if self.lazy_flags:
+            self.defer_flags(LOGIC_MASK, Alu.logic, res, 0)
+        else:
+            self._flags = (self._flags & ~LOGIC_MASK) | Alu.logic[res]
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
-
-            #calculo de c
-            d7 = self.get_bit(self.ram[d], 7)
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
-
-            self.set_flag(self.C, (~d7) & r7 | r7 & res7 | res7 & (~d7))
-        #CPSE
-        elif opcstr == "cpse":
-            #calculo del resultado
-            if self.ram[d] == self.ram[r]:
-                opc = self.flash.get_word(self.pc)
-                entry = self.find_opcode(opc)
-                if entry.opcstr[0] == "!":
-                    self.pc += 4        #Saltar una instruccion
-                else:
-                    self.pc +=2
-        #EOR
-        elif opcstr == "eor":
-            #calculo del resultado
-            res = self.ram[r] ^ self.ram[d]
-            
-            #calculo de v
-            self.set_flag(self.V,0)
-            
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
+        #guardado del resultado en el registro
+        self.ram[d] = res
 
-            #calculo de s
-            self.set_flag(self.S,self.get_flag(self.N) ^ self.get_flag(self.V))
-            
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
-            
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-        #MOV
-        elif opcstr == "mov":
-            #calculo del resultado
-            self.ram[d] = self.ram[r]
-        #OR
-        elif opcstr == "or":
-            #calculo del resultado
-            res = self.ram[r] | self.ram[d]
-
-            #calculo de v
-            self.set_flag(self.V,0)
-            
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
-            
-            #calculo de s
-            self.set_flag(self.S,self.get_flag(self.N) ^ self.get_flag(self.V))
+    #GRUPO N
+    def f_mov(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
-    
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-        #SBC
-        elif opcstr == "sbc":
-            #calculo del resultado
-            res = self.ram[d] - self.ram[r] - self.get_flag(7)
-
-            #calculo de h
-            d3 = self.get_bit(self.ram[d], 3)
-            r3 = self.get_bit(self.ram[r], 3)
-            res3 = self.get_bit(res, 3)
-
-            self.set_flag(self.H, (~d3) & r3 | r3 & res3 | res3 & (~d3))
-
-            #calculo de v
-            d7 = self.get_bit(self.ram[d], 7) 
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
-    
-            self.set_flag(self.V, d7 & (~r7) & (~res7) | (~d7) & r7 & res7)
+        #calculo del resultado
+        self.ram[d] = self.ram[r]
 
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
+    #GRUPO N
+    def f_or(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
 
-            #calculo de s
-            self.set_flag(self.S,self.get_flag(self.N) ^ self.get_flag(self.V))
+        #calculo del resultado
+        res = self.ram[d] | self.ram[r]
 
-            #calculo de z
-            if res & 0xff != 0:
-                self.set_flag(self.Z, 0)
-            
-            #calculo de c
-            d7 = self.get_bit(self.ram[d], 7) 
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
-
-            self.set_flag(self.C, (~d7) & r7 | r7 & res7 | res7 & (~d7))
-
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-        #SUB
-        elif opcstr == "sub":
-            #calculo del resultado
-            res = self.ram[d] - self.ram[r]
-
-            #calculo de h
-            d3 = self.get_bit(self.ram[d], 3) 
-            r3 = self.get_bit(self.ram[r], 3)
-            res3 = self.get_bit(res, 3)
-    
-            self.set_flag(self.H, (~d3) & r3 | r3 & res3 | res3 & (~d3))
+        #banderas desde la tabla
+        if self.lazy_flags:
+            self.defer_flags(LOGIC_MASK, Alu.logic, res, 0)
+        else:
+            self._flags = (self._flags & ~LOGIC_MASK) | Alu.logic[res]
 
-            #calculo de v
-            d7 = self.get_bit(self.ram[d], 7)
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
+        #guardado del resultado en el registro
+        self.ram[d] = res
 
-            self.set_flag(self.V, d7 & (~r7) & (~res7) | (~d7) & r7 & res7)
+    #GRUPO N
+    def f_sbc(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
 
-            #calculo de n
-            self.set_flag(self.N,self.get_bit(res, 7))
+        #resultado y banderas desde la tabla
+        v = Alu.sub[((self.flags & 0x01) << 16) | (self.ram[d] << 8) | self.ram[r]]
+        f = v >> 8
+        self.flags = (self.flags & ~SBC_MASK & (f | ~Z_FLAG)) | (f & SBC_MASK)
 
-            #calculo de s
-            self.set_flag(self.S,self.get_flag(self.N) ^ self.get_flag(self.V))
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-            #calculo de z
-            if res & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
-                
-            #calculo de c
-            d7 = self.get_bit(self.ram[d], 7)
-            r7 = self.get_bit(self.ram[r], 7)
-            res7 = self.get_bit(res, 7)
+    #GRUPO N
+    def f_sub(self, opcstr, opd_dict):
+        d = opd_dict["d"]
+        r = opd_dict["r"]
+
+        #resultado y banderas desde la tabla
+        i = (self.ram[d] << 8) | self.ram[r]
+        v = Alu.sub[i]
+        if self.lazy_flags:
+            self.defer_flags(SUB_MASK, Alu.sub, i, 8)
+        else:
+            self._flags = (self._flags & ~SUB_MASK) | (v >> 8)
 
-            self.set_flag(self.C, (~d7) & r7 | r7 & res7 | res7 & (~d7))
+        #guardado del resultado en el registro
+        self.ram[d] = v & 0xff
 
-            #guardado del resultado en el registro
-            self.ram[d] = res & 0xff
-            
     #GRUPO N
+    @stub
     def f_reg3_reg3(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    @stub
     def f_reg4_reg4(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    @stub
     def f_reg4(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
     def f_reg_x(self, opcstr, opd_dict):
-        pass
+        self.ram[opd_dict["d"]] = self.read_data(self.x)
 
     #GRUPO N
     def f_reg_mx(self, opcstr, opd_dict):
-        pass
+        x = (self.x - 1) & 0xffff
+        self.x = x
+        self.ram[opd_dict["d"]] = self.read_data(x)
 
     #GRUPO N
     def f_reg_xp(self, opcstr, opd_dict):
-        pass
+        x = self.x
+        self.ram[opd_dict["d"]] = self.read_data(x)
+        self.x = (x + 1) & 0xffff
 
     #GRUPO N
     def f_reg_y(self, opcstr, opd_dict):
-        pass
+        self.ram[opd_dict["d"]] = self.read_data(self.y)
 
     #GRUPO N
     def f_reg_yp(self, opcstr, opd_dict):
-        pass
+        y = self.y
+        self.ram[opd_dict["d"]] = self.read_data(y)
+        self.y = (y + 1) & 0xffff
 
     #GRUPO N
     def f_reg_my(self, opcstr, opd_dict):
-        pass
+        y = (self.y - 1) & 0xffff
+        self.y = y
+        self.ram[opd_dict["d"]] = self.read_data(y)
 
     #GRUPO N
     def f_reg_yo(self, opcstr, opd_dict):
-        pass
+        self.ram[opd_dict["d"]] = self.read_data((self.y + opd_dict["q"]) & 0xffff)
 
     #GRUPO N
     def f_reg_z(self, opcstr, opd_dict):
-        pass
+        #ld, o lpm/elpm (memoria de programa)
+        if opcstr == "ld":
+            self.ram[opd_dict["d"]] = self.read_data(self.z)
+        else:
+            self.ram[opd_dict["d"]] = self.read_program(self.z)
 
     #GRUPO N
     def f_reg_zp(self, opcstr, opd_dict):
-        pass
+        z = self.z
+        if opcstr == "ld":
+            self.ram[opd_dict["d"]] = self.read_data(z)
+        else:
+            self.ram[opd_dict["d"]] = self.read_program(z)
+        self.z = (z + 1) & 0xffff
 
     #GRUPO N
     def f_reg_mz(self, opcstr, opd_dict):
-        pass
+        z = (self.z - 1) & 0xffff
+        self.z = z
+        self.ram[opd_dict["d"]] = self.read_data(z)
 
     #GRUPO N
     def f_reg_zo(self, opcstr, opd_dict):
-        pass
+        self.ram[opd_dict["d"]] = self.read_data((self.z + opd_dict["q"]) & 0xffff)
 
     #GRUPO N
     def f_reg_io(self, opcstr, opd_dict):
-        pass
+        #in
+        self.ram[opd_dict["d"]] = self.read_data(opd_dict["A"] + self.IO_START)
 
     #GRUPO N
     def f_x_reg(self, opcstr, opd_dict):
-        pass
+        self.write_data(self.x, self.ram[opd_dict["r"]])
 
     #GRUPO N
     def f_xp_reg(self, opcstr, opd_dict):
-        pass
+        x = self.x
+        self.write_data(x, self.ram[opd_dict["r"]])
+        self.x = (x + 1) & 0xffff
 
     #GRUPO N
     def f_mx_reg(self, opcstr, opd_dict):
-        pass
+        x = (self.x - 1) & 0xffff
+        self.x = x
+        self.write_data(x, self.ram[opd_dict["r"]])
 
     #GRUPO N
     def f_y_reg(self, opcstr, opd_dict):
-        pass
+        self.write_data(self.y, self.ram[opd_dict["r"]])
 
     #GRUPO N
     def f_yp_reg(self, opcstr, opd_dict):
-        pass
+        y = self.y
+        self.write_data(y, self.ram[opd_dict["r"]])
+        self.y = (y + 1) & 0xffff
 
     #GRUPO N
     def f_my_reg(self, opcstr, opd_dict):
-        pass
+        y = (self.y - 1) & 0xffff
+        self.y = y
+        self.write_data(y, self.ram[opd_dict["r"]])
 
     #GRUPO N
     def f_yo_reg(self, opcstr, opd_dict):
-        pass
+        self.write_data((self.y + opd_dict["q"]) & 0xffff, self.ram[opd_dict["r"]])
 
     #GRUPO N
     def f_z_reg(self, opcstr, opd_dict):
-        pass
+        #st (lac, las y lat no existen en el atmega328)
+        if opcstr == "st":
+            self.write_data(self.z, self.ram[opd_dict["r"]])
 
     #GRUPO N
     def f_zp_reg(self, opcstr, opd_dict):
-        pass
+        z = self.z
+        self.write_data(z, self.ram[opd_dict["r"]])
+        self.z = (z + 1) & 0xffff
 
     #GRUPO N
     def f_mz_reg(self, opcstr, opd_dict):
-        pass
+        z = (self.z - 1) & 0xffff
+        self.z = z
+        self.write_data(z, self.ram[opd_dict["r"]])
 
     #GRUPO N
     def f_zo_reg(self, opcstr, opd_dict):
-        pass
+        self.write_data((self.z + opd_dict["q"]) & 0xffff, self.ram[opd_dict["r"]])
 
     #GRUPO N
+    @stub
     def f_dreg_imm(self, opcstr, opd_dict):
-        d = opd_dict["d"][0]*2+24
-        k = opd_dict["K"][0]
-
-        #ADIW
-        if opcstr == "adiw":
-            #calculo del resultado
-            res = self.ram[d] + k
-            res1 = self.ram[d+1] + k
-            
-            #calculo de v
-            dh7 = self.get_bit(self.ram[d+1], 7)
-            r15 = self.get_bit(res1, 7)
-            self.set_flag(self.V, ~dh7 & r15)
+        pass
 
-            #calculo de n
-            self.set_flag(self.N, r15)
+    #GRUPO N
+    def f_adiw(self, opcstr, opd_dict):
+        d = opd_dict["d"]*2+24
+        k = opd_dict["K"]
 
-            #calculo de s
-            self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
+        #calculo del resultado
+        res = self.ram[d] + k
+        res1 = self.ram[d+1] + k
+        
+        #calculo de v
+        dh7 = self.get_bit(self.ram[d+1], 7)
+        r15 = self.get_bit(res1, 7)
+        self.set_flag(self.V, ~dh7 & r15)
 
-            #calculo de z
-            if res & 0xff == 0 and res1 & 0xff == 0:
-                self.set_flag(self.Z,1)
-            else:
-                self.set_flag(self.Z,0)
+        #calculo de n
+        self.set_flag(self.N, r15)
 
-            #calculo de c
-            self.set_flag(self.C, ~r15 & dh7)
+        #calculo de s
+        self.set_flag(self.S, self.get_flag(self.N) ^ self.get_flag(self.V))
+
+        #calculo de z
+        if res & 0xff == 0 and res1 & 0xff == 0:
+            self.set_flag(self.Z,1)
+        else:
+            self.set_flag(self.Z,0)
+
+        #calculo de c
+        self.set_flag(self.C, ~r15 & dh7)
+
+        #guardado del resultado
+        self.ram[d] = res  & 0xff
+        self.ram[d+1] = res1  & 0xff
 
-            #guardado del resultado
-            self.ram[d] = res  & 0xff
-            self.ram[d+1] = res1  & 0xff
-            
     #GRUPO N
+    @stub
     def f_dreg_dreg(self, opcstr, opd_dict):
-        d = opd_dict["d"][0]*2
-        r = opd_dict["r"][0]*2
+        pass
+
+    #GRUPO N
+    def f_movw(self, opcstr, opd_dict):
+        d = opd_dict["d"]*2
+        r = opd_dict["r"]*2
 
-        #MOVW
-        if opcstr == "movw":
-            #calculo del resultado
-            self.ram[d] = self.ram[r]
-            self.ram[d+1] = self.ram[r+1]
+        #calculo del resultado
+        self.ram[d] = self.ram[r]
+        self.ram[d+1] = self.ram[r+1]
 
     #GRUPO N
+    @stub
     def f_rel_add(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    def f_brbs(self, opcstr, opd_dict):
+        #salto si la bandera 's' esta en 1
+        if (self.flags >> opd_dict["s"]) & 0x01:
+            self.pc = self.calc_addr(self.pc, opd_dict["k"], 128)
+            return 1
+
+    #GRUPO N
+    def f_brbc(self, opcstr, opd_dict):
+        #salto si la bandera 's' esta en 0
+        if not (self.flags >> opd_dict["s"]) & 0x01:
+            self.pc = self.calc_addr(self.pc, opd_dict["k"], 128)
+            return 1
+
+    #GRUPO N
+    @stub
     def f_rel_add12(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    def f_rcall(self, opcstr, opd_dict):
+        self.push_pc(self.pc)
+        self.pc = self.calc_addr(self.pc, opd_dict["k"], 4096) & self.PC_MASK
+
+    #GRUPO N
+    def f_rjmp(self, opcstr, opd_dict):
+        self.pc = self.calc_addr(self.pc, opd_dict["k"], 4096) & self.PC_MASK
+
+    #GRUPO N
+    @stub
     def f_add17(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    def f_call(self, opcstr, opd_dict):
+        self.push_pc(self.pc)
+        self.pc = (opd_dict["k"] << 1) & self.PC_MASK
+
+    #GRUPO N
+    def f_jmp(self, opcstr, opd_dict):
+        self.pc = (opd_dict["k"] << 1) & self.PC_MASK
+
+    #GRUPO N
+    @stub
     def f_bit_rel(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    @stub
     def f_no_opd(self, opcstr, opd_dict):
         pass
 
+    #GRUPO N
+    def f_icall(self, opcstr, opd_dict):
+        self.push_pc(self.pc)
+        self.pc = (self.z << 1) & self.PC_MASK
+
+    #GRUPO N
+    def f_ijmp(self, opcstr, opd_dict):
+        self.pc = (self.z << 1) & self.PC_MASK
+
+    #GRUPO N
+    def f_ret(self, opcstr, opd_dict):
+        self.pc = self.pop_pc()
+
+    #GRUPO N
+    def f_reti(self, opcstr, opd_dict):
+        self.pc = self.pop_pc()
+        self.flags |= 1 << self.I
+
+    #GRUPO N
+    def f_push(self, opcstr, opd_dict):
+        sp = self.sp
+        self.write_data(sp, self.ram[opd_dict["d"]])
+        self.sp = (sp - 1) & 0xffff
+
+    #GRUPO N
+    def f_pop(self, opcstr, opd_dict):
+        sp = (self.sp + 1) & 0xffff
+        self.sp = sp
+        self.ram[opd_dict["d"]] = self.read_data(sp)
+
+    #GRUPO N
+    def f_break(self, opcstr, opd_dict):
+        self.halted = StopReason.BREAK
+
+    #GRUPO N
+    def f_sleep(self, opcstr, opd_dict):
+        self.halted = StopReason.SLEEP
+
     #GRUPO N
     def f_io_bit(self, opcstr, opd_dict):
-        pass
+        addr = opd_dict["A"] + self.IO_START
+        bit = 1 << opd_dict["b"]
+        if opcstr == "sbi":
+            self.write_data(addr, self.read_data(addr) | bit)
+        elif opcstr == "cbi":
+            self.write_data(addr, self.read_data(addr) & ~bit)
+        elif bool(self.read_data(addr) & bit) == (opcstr == "sbis"):
+            return self.skip_next()
 
     #GRUPO N
     def f_io_reg(self, opcstr, opd_dict):
-        pass
+        #out
+        self.write_data(opd_dict["A"] + self.IO_START, self.ram[opd_dict["r"]])
 
     #GRUPO N
+    @stub
     def f_reg8_reg8(self, opcstr, opd_dict):
         pass
 
     #GRUPO N
+    @stub
     def f_just_zp(self, opcstr, opd_dict):
         pass
 
@@ -845,194 +1045,194 @@ class Atmega328():
     #   4:
     opcodes = (
         #A
-        OPC(0xfc00, 0x1c00, "adc",    "r4d5r1",     reg_reg,    f_reg_reg, "b4a5b1", d0_31_r0_31),     # 1
-        OPC(0xfc00, 0x0c00, "add",    "r4d5r1",     reg_reg,    f_reg_reg, "b4a5b1", d0_31_r0_31),     # 1
-        OPC(0xff00, 0x9600, "adiw",   "K4d2K2",     dreg_imm,   f_dreg_imm,"b4a2b2", d24_30_k0_63),    # 1
-        OPC(0xfc00, 0x2000, "and",    "r4d5r1",     reg_reg,    f_reg_reg, "b4a5b1", d0_31_r0_31),     # 1
-        OPC(0xf000, 0x7000, "andi",   "K4d4K4",     reg8_imm,   f_reg8_imm,"b4a4b4", d16_31_k0_255),    # 1
-        OPC(0xfe0f, 0x9405, "asr",    "-4d5",       reg,        f_reg     , "-4a5",  d0_31),         # 3
+        OPC(0xfc00, 0x1c00, "adc",    "r4d5r1",     reg_reg,    f_adc,     "b4a5b1", d0_31_r0_31, 1),     # 1
+        OPC(0xfc00, 0x0c00, "add",    "r4d5r1",     reg_reg,    f_add,     "b4a5b1", d0_31_r0_31, 1),     # 1
+        OPC(0xff00, 0x9600, "adiw",   "K4d2K2",     dreg_imm,   f_adiw,    "b4a2b2", d24_30_k0_63, 2),    # 1
+        OPC(0xfc00, 0x2000, "and",    "r4d5r1",     reg_reg,    f_and,     "b4a5b1", d0_31_r0_31, 1),     # 1
+        OPC(0xf000, 0x7000, "andi",   "K4d4K4",     reg8_imm,   f_andi,    "b4a4b4", d16_31_k0_255, 1),    # 1
+        OPC(0xfe0f, 0x9405, "asr",    "-4d5",       reg,        f_asr, "-4a5",  d0_31, 1),         # 3
 
         #B @12
         #OPC(0xff8f, 0x9488, "bclr",   "-4s3",      bit,        f_bit),
-        OPC(0xfe08, 0xf800, "bld",    "b3-1d5",     reg_bit,    f_reg_bit, "b3-1a5"      , d0_31_b0_7),     # 4
+        OPC(0xfe08, 0xf800, "bld",    "b3-1d5",     reg_bit,    f_reg_bit, "b3-1a5"      , d0_31_b0_7, 1),     # 4
         #OPC(0xfc00, 0xf400, "brbc",   "s3k7",      bit_rel,    f_bit_rel),
         #OPC(0xfc00, 0xf000, "brbs",   "s3k7",      bit_rel,    f_bit_rel),
-        OPC(0xfc07, 0xf400, "brcc",   "-3k7",       rel_add,    f_rel_add, "-3a7"      , jmp),     # 4
-        OPC(0xfc07, 0xf000, "brcs",   "-3k7",       rel_add,    f_rel_add, "-3a7"      , jmp),     # 4
-        OPC(0xffff, 0x9598, "break",  "",           no_opd,     f_no_opd, ""      , None),      # 2
-        OPC(0xfc07, 0xf001, "breq",   "-3k7",       rel_add,    f_rel_add, "-3k7"      , jmp),     # 4
-        OPC(0xfc07, 0xf404, "brge",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf405, "brhc",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf005, "brhs",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf407, "brid",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf007, "brie",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf000, "brlo",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf004, "brlt",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf002, "brmi",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf401, "brne",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf402, "brpl",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf400, "brsh",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf406, "brtc",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf006, "brts",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf403, "brvc",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
-        OPC(0xfc07, 0xf003, "brvs",   "-3k7",       rel_add,    f_rel_add, ""      , None),     # 4
+        OPC(0xfc07, 0xf400, "brcc",   "s3k7",       rel_add,    f_brbc,   "-3a7"      , jmp, (1, 2)),     # 4
+        OPC(0xfc07, 0xf000, "brcs",   "s3k7",       rel_add,    f_brbs,   "-3a7"      , jmp, (1, 2)),     # 4
+        OPC(0xffff, 0x9598, "break",  "",           no_opd,     f_break,  ""      , None, 1),      # 2
+        OPC(0xfc07, 0xf001, "breq",   "s3k7",       rel_add,    f_brbs,   "-3k7"      , jmp, (1, 2)),     # 4
+        OPC(0xfc07, 0xf404, "brge",   "s3k7",       rel_add,    f_brbc,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf405, "brhc",   "s3k7",       rel_add,    f_brbc,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf005, "brhs",   "s3k7",       rel_add,    f_brbs,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf407, "brid",   "s3k7",       rel_add,    f_brbc,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf007, "brie",   "s3k7",       rel_add,    f_brbs,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf000, "brlo",   "s3k7",       rel_add,    f_brbs,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf004, "brlt",   "s3k7",       rel_add,    f_brbs,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf002, "brmi",   "s3k7",       rel_add,    f_brbs,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf401, "brne",   "s3k7",       rel_add,    f_brbc,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf402, "brpl",   "s3k7",       rel_add,    f_brbc,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf400, "brsh",   "s3k7",       rel_add,    f_brbc,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf406, "brtc",   "s3k7",       rel_add,    f_brbc,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf006, "brts",   "s3k7",       rel_add,    f_brbs,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf403, "brvc",   "s3k7",       rel_add,    f_brbc,   ""      , None, (1, 2)),     # 4
+        OPC(0xfc07, 0xf003, "brvs",   "s3k7",       rel_add,    f_brbs,   ""      , None, (1, 2)),     # 4
         #OPC(0xff8f, 0x9408, "bset",   "-4s3",      bit,        f_bit),
-        OPC(0xfe08, 0xfa00, "bst",    "b3-1d5",     reg_bit,    f_reg_bit, "", None),     # 4
+        OPC(0xfe08, 0xfa00, "bst",    "b3-1d5",     reg_bit,    f_reg_bit, "", None, 1),     # 4
 
         #C
-        OPC(0xfe0e, 0x940e, "call",   "!k17-3k5",   add17,      f_add17, ""      , None),       # 2
-        OPC(0xff00, 0x9800, "cbi",    "b3A5",       io_bit,     f_io_bit, ""      , None),      # 4
-        OPC(0xffff, 0x9488, "clc",    "",           no_opd,     f_no_opd, ""      , None),      # 4
-        OPC(0xffff, 0x94d8, "clh",    "",           no_opd,     f_no_opd, ""      , None),      # 4
-        OPC(0xffff, 0x94f8, "cli",    "",           no_opd,     f_no_opd, ""      , None),      # 4
-        OPC(0xffff, 0x94a8, "cln",    "",           no_opd,     f_no_opd, ""      , None),      # 4
-        OPC(0xfc00, 0x2400, "clr",    "r4d5r1",     reg,        f_reg, ""      , None),         # 2
-        OPC(0xffff, 0x94c8, "cls",    "",           no_opd,     f_no_opd, ""      , None),      # 4
-        OPC(0xffff, 0x94e8, "clt",    "",           no_opd,     f_no_opd, ""      , None),      # 4
-        OPC(0xffff, 0x94b8, "clv",    "",           no_opd,     f_no_opd, ""      , None),      # 4
-        OPC(0xffff, 0x9498, "clz",    "",           no_opd,     f_no_opd, ""      , None),      # 4
-        OPC(0xfe0f, 0x9400, "com",    "-4d5",       reg,        f_reg, ""      , None),
-        OPC(0xfe00, 0x1400, "cp",     "r4d5r1",     reg_reg,    f_reg_reg, ""      , None),     # 1
-        OPC(0xfc00, 0x0400, "cpc",    "r4d5r1",     reg_reg,    f_reg_reg, ""      , None),     # 1
-        OPC(0xf000, 0x3000, "cpi",    "K4d4K4",     reg8_imm,   f_reg8_imm, ""      , None),    # 1
-        OPC(0xfc00, 0x1000, "cpse",   "r4d5r1",     reg_reg,    f_reg_reg, ""      , None),     # 1
+        OPC(0xfe0e, 0x940e, "call",   "!k17-3k5",   add17,      f_call, ""      , None, 4),       # 2
+        OPC(0xff00, 0x9800, "cbi",    "b3A5",       io_bit,     f_io_bit, ""      , None, 2),      # 4
+        OPC(0xffff, 0x9488, "clc",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 4
+        OPC(0xffff, 0x94d8, "clh",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 4
+        OPC(0xffff, 0x94f8, "cli",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 4
+        OPC(0xffff, 0x94a8, "cln",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 4
+        OPC(0xfc00, 0x2400, "clr",    "r4d5r1",     reg,        f_eor, ""      , None, 1),         # 2  (eor rd, rd)
+        OPC(0xffff, 0x94c8, "cls",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 4
+        OPC(0xffff, 0x94e8, "clt",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 4
+        OPC(0xffff, 0x94b8, "clv",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 4
+        OPC(0xffff, 0x9498, "clz",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 4
+        OPC(0xfe0f, 0x9400, "com",    "-4d5",       reg,        f_com, ""      , None, 1),
+        OPC(0xfe00, 0x1400, "cp",     "r4d5r1",     reg_reg,    f_cp,      ""      , None, 1),     # 1
+        OPC(0xfc00, 0x0400, "cpc",    "r4d5r1",     reg_reg,    f_cpc,     ""      , None, 1),     # 1
+        OPC(0xf000, 0x3000, "cpi",    "K4d4K4",     reg8_imm,   f_cpi,      ""      , None, 1),    # 1
+        OPC(0xfc00, 0x1000, "cpse",   "r4d5r1",     reg_reg,    f_cpse,    ""      , None, (1, 2, 3)),     # 1
 
         #D
-        OPC(0xfe0f, 0x940a, "dec",    "-4d5",       reg,        f_reg, ""      , None),         # 3
-        OPC(0xff0f, 0x940b, "des",    "-4K4",       imm_4,      f_imm_4, ""      , None),       # 3
+        OPC(0xfe0f, 0x940a, "dec",    "-4d5",       reg,        f_dec, ""      , None, 1),         # 3
+        OPC(0xff0f, 0x940b, "des",    "-4K4",       imm_4,      f_imm_4, ""      , None, 1),       # 3
 
         #E
-        OPC(0xffff, 0x9519, "eicall", "",           no_opd,     f_no_opd, ""      , None),      # 2
-        OPC(0xffff, 0x9419, "eijmp",  "",           no_opd,     f_no_opd, ""      , None),      # 2
-        OPC(0xffff, 0x95d8, "elpm",   "",           no_opd,     f_no_opd, ""      , None),      # 2
-        OPC(0xfe0f, 0x9006, "elpm",   "-4d5",       reg_z,      f_reg_z, ""      , None),       # 2
-        OPC(0xfe0f, 0x9007, "elpm",   "-4d5",       reg_zp,     f_reg_zp, ""      , None),      # 2
-        OPC(0xfc00, 0x2400, "eor",    "r4d5r1",     reg_reg,    f_reg_reg, ""      , None),     # 1
+        OPC(0xffff, 0x9519, "eicall", "",           no_opd,     f_no_opd, ""      , None, 4),      # 2
+        OPC(0xffff, 0x9419, "eijmp",  "",           no_opd,     f_no_opd, ""      , None, 2),      # 2
+        OPC(0xffff, 0x95d8, "elpm",   "",           no_opd,     f_no_opd, ""      , None, 3),      # 2
+        OPC(0xfe0f, 0x9006, "elpm",   "-4d5",       reg_z,      f_reg_z, ""      , None, 3),       # 2
+        OPC(0xfe0f, 0x9007, "elpm",   "-4d5",       reg_zp,     f_reg_zp, ""      , None, 3),      # 2
+        OPC(0xfc00, 0x2400, "eor",    "r4d5r1",     reg_reg,    f_eor,     ""      , None, 1),     # 1
 
         #F
-        OPC(0xff88, 0x0308, "fmul",   "r3-1d3",     reg8_reg8,  f_reg8_reg8, ""      , None),   # 3
-        OPC(0xff88, 0x0380, "fmuls",  "r3-1d3",     reg8_reg8,  f_reg8_reg8, ""      , None),   # 3
-        OPC(0xff88, 0x0388, "fmulsu", "r3-1d3",     reg8_reg8,  f_reg8_reg8, ""      , None),   # 3
+        OPC(0xff88, 0x0308, "fmul",   "r3-1d3",     reg8_reg8,  f_reg8_reg8, ""      , None, 2),   # 3
+        OPC(0xff88, 0x0380, "fmuls",  "r3-1d3",     reg8_reg8,  f_reg8_reg8, ""      , None, 2),   # 3
+        OPC(0xff88, 0x0388, "fmulsu", "r3-1d3",     reg8_reg8,  f_reg8_reg8, ""      , None, 2),   # 3
 
         #G - No hay
 
         #H - No hay
 
         #I
-        OPC(0xffff, 0x9509, "icall",  "",           no_opd,     f_no_opd, ""      , None),      # 2
-        OPC(0xffff, 0x9409, "ijmp",   "",           no_opd,     f_no_opd, ""      , None),      # 2
-        OPC(0xf800, 0xb000, "in",     "A4d5A2",     reg_io,     f_reg_io, ""      , None),      # 3
-        OPC(0xfe0f, 0x9403, "inc",    "-4d5",       reg,        f_reg, ""      , None),         # 3
+        OPC(0xffff, 0x9509, "icall",  "",           no_opd,     f_icall, ""      , None, 3),      # 2
+        OPC(0xffff, 0x9409, "ijmp",   "",           no_opd,     f_ijmp, ""      , None, 2),      # 2
+        OPC(0xf800, 0xb000, "in",     "A4d5A2",     reg_io,     f_reg_io, ""      , None, 1),      # 3
+        OPC(0xfe0f, 0x9403, "inc",    "-4d5",       reg,        f_inc, ""      , None, 1),         # 3
 
         #J
-        OPC(0xfe0e, 0x940c, "jmp",    "!k17-3k5",   add17,      f_add17, ""      , None),       # 2
+        OPC(0xfe0e, 0x940c, "jmp",    "!k17-3k5",   add17,      f_jmp,   ""      , None, 3),       # 2
 
         #K - No hay
 
         #L
-        OPC(0xfe0f, 0x9206, "lac",    "-4r5",       z_reg,      f_z_reg, ""      , None),
-        OPC(0xfe0f, 0x9205, "las",    "-4r5",       z_reg,      f_z_reg, ""      , None),
-        OPC(0xfe0f, 0x9207, "lat",    "-4r5",       z_reg,      f_z_reg, ""      , None),
-        OPC(0xfe0f, 0x900c, "ld",     "-4d5",       reg_x,      f_reg_x, ""      , None),
-        OPC(0xfe0f, 0x900d, "ld",     "-4d5",       reg_xp,     f_reg_xp, ""      , None),
-        OPC(0xfe0f, 0x900e, "ld",     "-4d5",       reg_mx,     f_reg_mx, ""      , None),
-        OPC(0xfe0f, 0x900c, "ld",     "-4d5",       reg_x,      f_reg_x, ""      , None),
-        OPC(0xfe0f, 0x900d, "ld",     "-4d5",       reg_xp,     f_reg_xp, ""      , None),
-        OPC(0xfe0f, 0x900e, "ld",     "-4d5",       reg_mx,     f_reg_mx, ""      , None),
-        OPC(0xfe0f, 0x8008, "ld",     "-4d5",       reg_y,      f_reg_y, ""      , None),
-        OPC(0xfe0f, 0x9009, "ld",     "-4d5",       reg_yp,     f_reg_yp, ""      , None),
-        OPC(0xfe0f, 0x900a, "ld",     "-4d5",       reg_my,     f_reg_my, ""      , None),
-        OPC(0xd208, 0x8008, "ldd",    "q3-1d5-1q2-1q1", reg_yo, f_reg_yo, ""      , None),
-        OPC(0xfe0f, 0x8000, "ld",     "-4d5",       reg_z,      f_reg_z, ""      , None),
-        OPC(0xfe0f, 0x9001, "ld",     "-4d5",       reg_zp,     f_reg_zp, ""      , None),
-        OPC(0xfe0f, 0x9002, "ld",     "-4d5",       reg_mz,     f_reg_mz, ""      , None),
-        OPC(0xd208, 0x8000, "ldd",    "q3-1d5-1q2-1q1", reg_zo, f_reg_zo, ""      , None),
-        OPC(0xf000, 0xe000, "ldi",    "K4d4K4",     reg8_imm,   f_reg8_imm, ""      , None),
-        OPC(0xfe0f, 0x9000, "lds",    "!k16-4d5",   reg_imm16,  f_reg_imm16, ""      , None),
-        OPC(0xffff, 0x95c8, "lpm",    "",           no_opd,     f_no_opd, ""      , None),
-        OPC(0xfe0f, 0x9004, "lpm",    "-4d5",       reg_z,      f_reg_z, ""      , None),
-        OPC(0xfe0f, 0x9005, "lpm",    "-4d5",       reg_zp,     f_reg_zp, ""      , None),
-        OPC(0xfc00, 0x0c00, "lsl",    "r4d5r1",     reg,        f_reg, ""      , None),         # 3
-        OPC(0xfe0f, 0x9406, "lsr",    "-4d5",       reg,        f_reg, ""      , None),         # 3
+        OPC(0xfe0f, 0x9206, "lac",    "-4r5",       z_reg,      f_z_reg, ""      , None, 2),
+        OPC(0xfe0f, 0x9205, "las",    "-4r5",       z_reg,      f_z_reg, ""      , None, 2),
+        OPC(0xfe0f, 0x9207, "lat",    "-4r5",       z_reg,      f_z_reg, ""      , None, 2),
+        OPC(0xfe0f, 0x900c, "ld",     "-4d5",       reg_x,      f_reg_x, ""      , None, 2),
+        OPC(0xfe0f, 0x900d, "ld",     "-4d5",       reg_xp,     f_reg_xp, ""      , None, 2),
+        OPC(0xfe0f, 0x900e, "ld",     "-4d5",       reg_mx,     f_reg_mx, ""      , None, 2),
+        OPC(0xfe0f, 0x900c, "ld",     "-4d5",       reg_x,      f_reg_x, ""      , None, 2),
+        OPC(0xfe0f, 0x900d, "ld",     "-4d5",       reg_xp,     f_reg_xp, ""      , None, 2),
+        OPC(0xfe0f, 0x900e, "ld",     "-4d5",       reg_mx,     f_reg_mx, ""      , None, 2),
+        OPC(0xfe0f, 0x8008, "ld",     "-4d5",       reg_y,      f_reg_y, ""      , None, 2),
+        OPC(0xfe0f, 0x9009, "ld",     "-4d5",       reg_yp,     f_reg_yp, ""      , None, 2),
+        OPC(0xfe0f, 0x900a, "ld",     "-4d5",       reg_my,     f_reg_my, ""      , None, 2),
+        OPC(0xd208, 0x8008, "ldd",    "q3-1d5-1q2-1q1", reg_yo, f_reg_yo, ""      , None, 2),
+        OPC(0xfe0f, 0x8000, "ld",     "-4d5",       reg_z,      f_reg_z, ""      , None, 2),
+        OPC(0xfe0f, 0x9001, "ld",     "-4d5",       reg_zp,     f_reg_zp, ""      , None, 2),
+        OPC(0xfe0f, 0x9002, "ld",     "-4d5",       reg_mz,     f_reg_mz, ""      , None, 2),
+        OPC(0xd208, 0x8000, "ldd",    "q3-1d5-1q2-1q1", reg_zo, f_reg_zo, ""      , None, 2),
+        OPC(0xf000, 0xe000, "ldi",    "K4d4K4",     reg8_imm,   f_reg8_imm, ""      , None, 1),
+        OPC(0xfe0f, 0x9000, "lds",    "!k16-4d5",   reg_imm16,  f_reg_imm16, ""      , None, 2),
+        OPC(0xffff, 0x95c8, "lpm",    "",           no_opd,     f_no_opd, ""      , None, 3),
+        OPC(0xfe0f, 0x9004, "lpm",    "-4d5",       reg_z,      f_reg_z, ""      , None, 3),
+        OPC(0xfe0f, 0x9005, "lpm",    "-4d5",       reg_zp,     f_reg_zp, ""      , None, 3),
+        OPC(0xfc00, 0x0c00, "lsl",    "r4d5r1",     reg,        f_add, ""      , None, 1),         # 3  (add rd, rd)
+        OPC(0xfe0f, 0x9406, "lsr",    "-4d5",       reg,        f_lsr, ""      , None, 1),         # 3
 
         #M
-        OPC(0xfc00, 0x2c00, "mov",    "r4d5r1",     reg_reg,    f_reg_reg, ""      , None),     # 1
-        OPC(0xff00, 0x0100, "movw",   "r4d4",       dreg_dreg,  f_dreg_dreg, ""      , None),   # 1
-        OPC(0xfc00, 0x9c00, "mul",    "r4d5r1",     reg_reg,    f_reg_reg, ""      , None),     # 3
-        OPC(0xff00, 0x0200, "muls",   "r4d4",       reg4_reg4,  f_reg4_reg4, ""      , None),   # 3
-        OPC(0xff88, 0x0300, "mulsu",  "r3-1d3",     reg3_reg3,  f_reg3_reg3, ""      , None),   # 3
+        OPC(0xfc00, 0x2c00, "mov",    "r4d5r1",     reg_reg,    f_mov,     ""      , None, 1),     # 1
+        OPC(0xff00, 0x0100, "movw",   "r4d4",       dreg_dreg,  f_movw,      ""      , None, 1),   # 1
+        OPC(0xfc00, 0x9c00, "mul",    "r4d5r1",     reg_reg,    f_reg_reg, ""      , None, 2),     # 3
+        OPC(0xff00, 0x0200, "muls",   "r4d4",       reg4_reg4,  f_reg4_reg4, ""      , None, 2),   # 3
+        OPC(0xff88, 0x0300, "mulsu",  "r3-1d3",     reg3_reg3,  f_reg3_reg3, ""      , None, 2),   # 3
 
         #N
-        OPC(0xfe0f, 0x9401, "neg",    "-4d5",       reg,        f_reg, ""      , None),         # 3
-        OPC(0xffff, 0x0000, "nop",    "",           no_opd,     f_no_opd, ""      , None),      # 2
+        OPC(0xfe0f, 0x9401, "neg",    "-4d5",       reg,        f_neg, ""      , None, 1),         # 3
+        OPC(0xffff, 0x0000, "nop",    "",           no_opd,     f_no_opd, ""      , None, 1),      # 2
 
         #O
-        OPC(0xfc00, 0x2800, "or",     "r4d5r1",     reg_reg,    f_reg_reg, ""      , None),     # 1
-        OPC(0xf000, 0x6000, "ori",    "K4d4K4",     reg8_imm,   f_reg8_imm, ""      , None),    # 1
-        OPC(0xf800, 0xb800, "out",    "A4r5A2",     io_reg,     f_io_reg, ""      , None),      # 3
+        OPC(0xfc00, 0x2800, "or",     "r4d5r1",     reg_reg,    f_or,      ""      , None, 1),     # 1
+        OPC(0xf000, 0x6000, "ori",    "K4d4K4",     reg8_imm,   f_ori,      ""      , None, 1),    # 1
+        OPC(0xf800, 0xb800, "out",    "A4r5A2",     io_reg,     f_io_reg, ""      , None, 1),      # 3
 
         #P
-        OPC(0xfe0f, 0x900f, "pop",    "-4d5",       reg,        f_reg, ""      , None),         # 2
-        OPC(0xfe0f, 0x920f, "push",   "-4d5",       reg,        f_reg, "", None),         # 2
+        OPC(0xfe0f, 0x900f, "pop",    "-4d5",       reg,        f_pop, ""      , None, 2),         # 2
+        OPC(0xfe0f, 0x920f, "push",   "-4d5",       reg,        f_push, "", None, 2),         # 2
 
         #Q - No hay
 
         #R
-        OPC(0xf000, 0xd000, "rcall",  "k12",        rel_add12,  f_rel_add12, "", None),   # 2
-        OPC(0xffff, 0x9508, "ret",    "",           no_opd,     f_no_opd, "", None),      # 2
-        OPC(0xffff, 0x9518, "reti",   "",           no_opd,     f_no_opd, "", None),      # 2
-        OPC(0xf000, 0xc000, "rjmp",   "k12",        rel_add12,  f_rel_add12, "", None),   # 2
-        OPC(0xfc00, 0x1c00, "rol",    "r4d5r1",     reg,        f_reg, "", None),         # 3
-        OPC(0xfe0f, 0x9407, "ror",    "-4d5",       reg,        f_reg, "", None),         # 3
+        OPC(0xf000, 0xd000, "rcall",  "k12",        rel_add12,  f_rcall, "", None, 3),   # 2
+        OPC(0xffff, 0x9508, "ret",    "",           no_opd,     f_ret, "", None, 4),      # 2
+        OPC(0xffff, 0x9518, "reti",   "",           no_opd,     f_reti, "", None, 4),      # 2
+        OPC(0xf000, 0xc000, "rjmp",   "k12",        rel_add12,  f_rjmp,      "", None, 2),   # 2
+        OPC(0xfc00, 0x1c00, "rol",    "r4d5r1",     reg,        f_adc, "", None, 1),         # 3  (adc rd, rd)
+        OPC(0xfe0f, 0x9407, "ror",    "-4d5",       reg,        f_ror, "", None, 1),         # 3
 
         #S - en proceso
-        OPC(0xfc00, 0x0800, "sbc",    "r4d5r1",     reg_reg,    f_reg_reg, "", None),     # 1
-        OPC(0xf000, 0x4000, "sbci",   "K4d4K4",     reg8_imm,   f_reg8_imm, "", None),    # 1
-        OPC(0xff00, 0x9a00, "sbi",    "b3A5",       io_bit,     f_io_bit, "", None),      # 4
-        OPC(0xff00, 0x9900, "sbic",   "b3A5",       io_bit,     f_io_bit, "", None),      # 4
-        OPC(0xff00, 0x9b00, "sbis",   "b3A5",       io_bit,     f_io_bit, "", None),      # 4
-        OPC(0xff00, 0x9700, "sbiw",   "K4d2K2",     dreg_imm,   f_dreg_imm, "", None),    # 4
-        OPC(0xf000, 0x6000, "sbr",    "K4d4K4",     reg_imm,    f_reg_imm, "", None),     # 4
-        OPC(0xfe00, 0xfc00, "sbrc",   "b3-1d5",     reg_bit,    f_reg_bit, "", None),     # 4
-        OPC(0xfe08, 0xfe00, "sbrs",   "b3-1d5",     reg_bit,    f_reg_bit, "", None),     # 4
-        OPC(0xffff, 0x9408, "sec",    "",           no_opd,     f_no_opd, "", None),      # 4
-        OPC(0xffff, 0x9458, "seh",    "",           no_opd,     f_no_opd, "", None),      # 4
-        OPC(0xffff, 0x9478, "sei",    "",           no_opd,     f_no_opd, "", None),      # 4
-        OPC(0xffff, 0x9428, "sen",    "",           no_opd,     f_no_opd, "", None),      # 4
-        OPC(0xff0f, 0xef0f, "ser",    "-4d4",       reg4,       f_reg4, "", None),
-        OPC(0xffff, 0x9448, "ses",    "",           no_opd,     f_no_opd, "", None),      # 4
-        OPC(0xffff, 0x9468, "set",    "",           no_opd,     f_no_opd, "", None),      # 4
-        OPC(0xffff, 0x9438, "sev",    "",           no_opd,     f_no_opd, "", None),      # 4
-        OPC(0xffff, 0x9418, "sez",    "",           no_opd,     f_no_opd, "", None),      # 4
-        OPC(0xffff, 0x9588, "sleep",  "",           no_opd,     f_no_opd, "", None),      # 2
-        OPC(0xffff, 0x95e8, "spm",    "",           no_opd,     f_no_opd, "", None),
-        OPC(0xffff, 0x95f8, "spm",    "",           just_zp,    f_just_zp, "", None),
-        OPC(0xfe0f, 0x920c, "st",     "-4r5",       x_reg,      f_x_reg, "", None),
-        OPC(0xfe0f, 0x920d, "st",     "-4r5",       xp_reg,     f_xp_reg, "", None),
-        OPC(0xfe0f, 0x920e, "st",     "-4r5",       mx_reg,     f_mx_reg, "", None),
-        OPC(0xfe0f, 0x8208, "st",     "-4r5",       y_reg,      f_y_reg, "", None),
-        OPC(0xfe0f, 0x9209, "st",     "-4r5",       yp_reg,     f_yp_reg, "", None),
-        OPC(0xfe0f, 0x920a, "st",     "-4r5",       my_reg,     f_my_reg, "", None),
-        OPC(0xd208, 0x8208, "std",    "q3-1r5-1q2-1q1", yo_reg, f_yo_reg, "", None),
-        OPC(0xfe0f, 0x8200, "st",     "-4d5",       z_reg,      f_z_reg, "", None),
-        OPC(0xfe0f, 0x9201, "st",     "-4d5",       zp_reg,     f_zp_reg, "", None),
-        OPC(0xfe0f, 0x9202, "st",     "-4d5",       mz_reg,     f_mz_reg, "", None),
-        OPC(0xd208, 0x8200, "std",    "q3-1d5-1q2-1q1", zo_reg, f_zo_reg, "", None),
-        OPC(0xfe0f, 0x9200, "sts",    "!k16-4d5",   imm16_reg,  f_imm16_reg, "", None),
-        OPC(0xf800, 0xa800, "sts",    "k4d4k3",     imm7_reg,   f_imm7_reg, "", None),
-        OPC(0xfc00, 0x1800, "sub",    "r4d5r1",     reg_reg,    f_reg_reg, "", None),     # 1
-        OPC(0xf000, 0x5000, "subi",   "K4d4K4",     reg8_imm,   f_reg8_imm, "", None),    # 3
-        OPC(0xfe0f, 0x9402, "swap",   "-4d5",       reg,        f_reg, "", None),         # 2
+        OPC(0xfc00, 0x0800, "sbc",    "r4d5r1",     reg_reg,    f_sbc,     "", None, 1),     # 1
+        OPC(0xf000, 0x4000, "sbci",   "K4d4K4",     reg8_imm,   f_sbci,     "", None, 1),    # 1
+        OPC(0xff00, 0x9a00, "sbi",    "b3A5",       io_bit,     f_io_bit, "", None, 2),      # 4
+        OPC(0xff00, 0x9900, "sbic",   "b3A5",       io_bit,     f_io_bit, "", None, (1, 2, 3)),      # 4
+        OPC(0xff00, 0x9b00, "sbis",   "b3A5",       io_bit,     f_io_bit, "", None, (1, 2, 3)),      # 4
+        OPC(0xff00, 0x9700, "sbiw",   "K4d2K2",     dreg_imm,   f_dreg_imm, "", None, 2),    # 4
+        OPC(0xf000, 0x6000, "sbr",    "K4d4K4",     reg_imm,    f_reg_imm, "", None, 1),     # 4
+        OPC(0xfe00, 0xfc00, "sbrc",   "b3-1d5",     reg_bit,    f_reg_bit, "", None, (1, 2, 3)),     # 4
+        OPC(0xfe08, 0xfe00, "sbrs",   "b3-1d5",     reg_bit,    f_reg_bit, "", None, (1, 2, 3)),     # 4
+        OPC(0xffff, 0x9408, "sec",    "",           no_opd,     f_no_opd, "", None, 1),      # 4
+        OPC(0xffff, 0x9458, "seh",    "",           no_opd,     f_no_opd, "", None, 1),      # 4
+        OPC(0xffff, 0x9478, "sei",    "",           no_opd,     f_no_opd, "", None, 1),      # 4
+        OPC(0xffff, 0x9428, "sen",    "",           no_opd,     f_no_opd, "", None, 1),      # 4
+        OPC(0xff0f, 0xef0f, "ser",    "-4d4",       reg4,       f_reg4, "", None, 1),
+        OPC(0xffff, 0x9448, "ses",    "",           no_opd,     f_no_opd, "", None, 1),      # 4
+        OPC(0xffff, 0x9468, "set",    "",           no_opd,     f_no_opd, "", None, 1),      # 4
+        OPC(0xffff, 0x9438, "sev",    "",           no_opd,     f_no_opd, "", None, 1),      # 4
+        OPC(0xffff, 0x9418, "sez",    "",           no_opd,     f_no_opd, "", None, 1),      # 4
+        OPC(0xffff, 0x9588, "sleep",  "",           no_opd,     f_sleep,  "", None, 1),      # 2
+        OPC(0xffff, 0x95e8, "spm",    "",           no_opd,     f_no_opd, "", None, 1),
+        OPC(0xffff, 0x95f8, "spm",    "",           just_zp,    f_just_zp, "", None, 1),
+        OPC(0xfe0f, 0x920c, "st",     "-4r5",       x_reg,      f_x_reg, "", None, 2),
+        OPC(0xfe0f, 0x920d, "st",     "-4r5",       xp_reg,     f_xp_reg, "", None, 2),
+        OPC(0xfe0f, 0x920e, "st",     "-4r5",       mx_reg,     f_mx_reg, "", None, 2),
+        OPC(0xfe0f, 0x8208, "st",     "-4r5",       y_reg,      f_y_reg, "", None, 2),
+        OPC(0xfe0f, 0x9209, "st",     "-4r5",       yp_reg,     f_yp_reg, "", None, 2),
+        OPC(0xfe0f, 0x920a, "st",     "-4r5",       my_reg,     f_my_reg, "", None, 2),
+        OPC(0xd208, 0x8208, "std",    "q3-1r5-1q2-1q1", yo_reg, f_yo_reg, "", None, 2),
+        OPC(0xfe0f, 0x8200, "st",     "-4r5",       z_reg,      f_z_reg, "", None, 2),
+        OPC(0xfe0f, 0x9201, "st",     "-4r5",       zp_reg,     f_zp_reg, "", None, 2),
+        OPC(0xfe0f, 0x9202, "st",     "-4r5",       mz_reg,     f_mz_reg, "", None, 2),
+        OPC(0xd208, 0x8200, "std",    "q3-1r5-1q2-1q1", zo_reg, f_zo_reg, "", None, 2),
+        OPC(0xfe0f, 0x9200, "sts",    "!k16-4d5",   imm16_reg,  f_imm16_reg, "", None, 2),
+        OPC(0xf800, 0xa800, "sts",    "k4d4k3",     imm7_reg,   f_imm7_reg, "", None, 1),
+        OPC(0xfc00, 0x1800, "sub",    "r4d5r1",     reg_reg,    f_sub,     "", None, 1),     # 1
+        OPC(0xf000, 0x5000, "subi",   "K4d4K4",     reg8_imm,   f_subi,     "", None, 1),    # 3
+        OPC(0xfe0f, 0x9402, "swap",   "-4d5",       reg,        f_reg, "", None, 1),         # 2
 
         #T
-        OPC(0xfc00, 0x2000, "tst",    "r4d5r1",     reg,        f_reg, "", None),         # 1
+        OPC(0xfc00, 0x2000, "tst",    "r4d5r1",     reg,        f_tst, "", None, 1),         # 1
 
         #U - No hay
 
         #V - No hay
 
         #W
-        OPC(0xffff, 0x95a8, "wdr",    "",           no_opd,     f_no_opd, "", None),      # 2
+        OPC(0xffff, 0x95a8, "wdr",    "",           no_opd,     f_no_opd, "", None, 1),      # 2
 
         #X
         #~ OPC(0xfe0f, 0x9204, "xch",    "-4d5",    reg,        f_reg)    # Not for atmega328
@@ -1043,12 +1243,133 @@ class Atmega328():
     )
 
     def __init__(self, symtable):
+        self.build_decode_table()
+        Alu.build()
         self.flash = Memory(32768, Memory.FLASH)
-        #self.symtable = symtable
+        self.symtable = symtable
+
+        # Todo el espacio de datos en un solo bytearray; cada zona es una
+        # vista (sin copia) sobre el mismo. SREG no se guarda aca sino en
+        # self.flags (ver read_data/write_data).
+        self.data = bytearray(self.DATA_SIZE)
+        view = memoryview(self.data)
+        self.ram = view[:self.IO_START]                     # r0..r31
+        self.io = view[self.IO_START:self.EXT_IO_START]
+        self.ext_io = view[self.EXT_IO_START:self.SRAM_START]
+        self.sram = view[self.SRAM_START:]
+
         self.pc = 0
-        self.sp = 0x7fff
-        self.ram = [0] * 32
-        self.flags = 0
+        self.sp = self.RAMEND
+
+        # Banderas perezosas: en lugar de SREG se guarda la ultima operacion
+        # que las modifica (ver defer_flags) y se aplica al leer 'flags'
+        self._flags = 0
+        self.pending = None         # (mascara, tabla, indice, desplazamiento)
+        self.lazy_flags = False
+        self.flags_avoided = 0      # Calculos de banderas descartados
+        self.flags_materialized = 0 # Calculos de banderas aplicados
+
+        self.fast_tokens = True     # assemble_one_instruction sin pyparsing
+                                    # para las formas habituales
+        self.halted = None          # StopReason.BREAK/SLEEP al ejecutarlas
+        self.cycles = 0             # Ciclos de reloj transcurridos
+        self.cycle_accurate = False # run() cuenta ciclos (mas lento)
+        self.engine = None          # BlockEngine opcional para run()
+        self.journal = None         # Journal opcional (ejecucion inversa)
+
+        # Cache de instrucciones decodificadas, por direccion (en bytes):
+        #   pc -> (sim_instr, entry, opd_dict, tamano en bytes)
+        self.icache = {}
+        self.icache_hits = 0
+        self.icache_misses = 0
+        self.flash.add_watcher(self.invalidate_icache)
+
+    @property
+    def sp(self):
+        return self.data[self.SPL] | (self.data[self.SPH] << 8)
+
+    @sp.setter
+    def sp(self, value):
+        self.data[self.SPL] = value & 0xff
+        self.data[self.SPH] = (value >> 8) & 0xff
+
+    # Punteros X (r27:r26), Y (r29:r28) y Z (r31:r30)
+    @property
+    def x(self):
+        return self.data[26] | (self.data[27] << 8)
+
+    @x.setter
+    def x(self, value):
+        self.data[26] = value & 0xff
+        self.data[27] = value >> 8
+
+    @property
+    def y(self):
+        return self.data[28] | (self.data[29] << 8)
+
+    @y.setter
+    def y(self, value):
+        self.data[28] = value & 0xff
+        self.data[29] = value >> 8
+
+    @property
+    def z(self):
+        return self.data[30] | (self.data[31] << 8)
+
+    @z.setter
+    def z(self, value):
+        self.data[30] = value & 0xff
+        self.data[31] = value >> 8
+
+    def read_data(self, addr):
+        """ Lectura de un byte del espacio de datos
+        """
+        if addr == self.SREG:
+            return self.flags
+        if addr >= self.DATA_SIZE:
+            raise MemoryFault(Memory.SRAM, addr, self.DATA_SIZE)
+        return self.data[addr]
+
+    def write_data(self, addr, value):
+        """ Escritura de un byte en el espacio de datos
+        """
+        if addr == self.SREG:
+            self.flags = value & 0xff
+        elif addr >= self.DATA_SIZE:
+            raise MemoryFault(Memory.SRAM, addr, self.DATA_SIZE, True)
+        else:
+            self.data[addr] = value & 0xff
+
+    def read_program(self, addr):
+        """ lpm: byte de la flash (0xff si no esta programado)
+        """
+        b = self.flash.get_byte(addr & self.PC_MASK)
+        return 0xff if b == None else b
+
+    def push_pc(self, pc):
+        """ Apila la direccion de retorno (en palabras): primero el byte
+            bajo, como el hardware
+        """
+        w = pc >> 1
+        sp = self.sp
+        self.write_data(sp, w & 0xff)
+        self.write_data((sp - 1) & 0xffff, w >> 8)
+        self.sp = (sp - 2) & 0xffff
+
+    def pop_pc(self):
+        sp = self.sp
+        w = (self.read_data((sp + 1) & 0xffff) << 8) | self.read_data((sp + 2) & 0xffff)
+        self.sp = (sp + 2) & 0xffff
+        return (w << 1) & self.PC_MASK
+
+    def skip_next(self):
+        """ Saltea la instruccion en self.pc (cpse, sbrc, sbis, ...) y
+            devuelve cuantas palabras ocupaba
+        """
+        entry = self.find_opcode(self.flash.get_word(self.pc))
+        words = 2 if entry != None and entry.size == 4 else 1
+        self.pc += 2 * words
+        return words
 
     def get_bit(self, reg, bit):
         return (reg >> bit) & 0x01
@@ -1067,66 +1388,257 @@ class Atmega328():
     def set_flag(self, flag , value):
         self.flags = self.set_bit(self.flags, flag, value)
 
+    @property
+    def flags(self):
+        """ SREG. Toda lectura (saltos, GUI, estado guardado, etc.) aplica
+            antes la operacion pendiente si la hay.
+        """
+        if self.pending is not None:
+            self.materialize_flags()
+        return self._flags
+
+    @flags.setter
+    def flags(self, value):
+        self.pending = None
+        self._flags = value
+
+    def defer_flags(self, mask, table, index, shift):
+        """ Modo perezoso: anota la operacion en lugar de calcular las
+            banderas. Las banderas son (table[index] >> shift) & mask.
+            Si la operacion anterior todavia no se aplico y la nueva
+            sobreescribe todas sus banderas, se descarta sin calcularla.
+        """
+        pending = self.pending
+        if pending is not None:
+            if pending[0] & ~mask:
+                self.materialize_flags()
+            else:
+                self.flags_avoided += 1
+        self.pending = (mask, table, index, shift)
+
+    def materialize_flags(self):
+        """ Aplica sobre SREG la operacion pendiente
+        """
+        mask, table, index, shift = self.pending
+        self.pending = None
+        self._flags = (self._flags & ~mask) | ((table[index] >> shift) & mask)
+        self.flags_materialized += 1
+
+    def set_lazy_flags(self, enabled):
+        """ Activa o desactiva el modo de banderas perezosas
+        """
+        if self.pending is not None:
+            self.materialize_flags()
+        self.lazy_flags = enabled
+
+    def flag_stats(self):
+        """ Devuelve (calculos evitados, calculos aplicados)
+        """
+        return self.flags_avoided, self.flags_materialized
+
     def reset(self):
         self.pc = 0
-        self.sp = 0x7fff
+        self.data[self.IO_START:self.SRAM_START] = bytes(self.SRAM_START - self.IO_START)
+        self.sp = self.RAMEND
         self.flags = 0
-
-    def load_flash(self, fname):
-        self.flash.load_intel_hex(fname)
+        self.halted = None
+        self.cycles = 0
+
+    def snapshot(self):
+        """ Captura el estado completo (espacio de datos con registros, E/S
+            y sp, SREG, pc, ciclos y flash). No hay perifericos simulados
+            todavia.
+        """
+        return Snapshot(bytes(self.data), self.flags, self.pc,
+                        self.cycles, self.halted, self.flash.snapshot())
+
+    def restore(self, snap):
+        """ Vuelve al estado de un snapshot(). Las memorias que no
+            cambiaron desde entonces no se copian.
+        """
+        self.data[:] = snap.data
+        self.flags = snap.flags
+        self.pc = snap.pc
+        self.cycles = snap.cycles
+        self.halted = snap.halted
+        self.flash.restore(snap.flash)
+
+    def load_flash(self, fname, symtable = None, cache = None):
+        """ Carga la flash segun la extension: .bin (binario crudo), .elf
+            (segmentos cargables y, si se da 'symtable', sus simbolos) o
+            Intel HEX (cualquier otra).
+            Con 'cache' (un sim_cache.ImageCache) la imagen se toma de la
+            cache en disco si esta al dia; si la cache guarda la tabla
+            decodificada, con ella se llena la cache de instrucciones. Un
+            .elf con 'symtable' se carga siempre del archivo, porque los
+            simbolos no se guardan en la cache.
+        """
+        if cache == None or (symtable != None and fname.lower().endswith(".elf")):
+            return self.load_image(self.flash, fname, symtable)
+        if cache.decoded:
+            result, decoded = cache.load(self.flash, fname, self.load_image,
+                                         self.decode_image, self.decoder_tag())
+            self.predecode(decoded)
+        else:
+            result, decoded = cache.load(self.flash, fname, self.load_image)
+        return result
+
+
+    def load_image(self, memory, fname, symtable = None):
+        ext = os.path.splitext(fname)[1].lower()
+        if ext == ".bin":
+            return memory.load_bin(fname)
+        if ext == ".elf":
+            load_elf(memory, fname, symtable)
+            return not memory.load_errors
+        return memory.load_intel_hex(fname)
+
+
+    def decode_image(self, memory):
+        """ Indice en 'opcodes' de cada palabra de 'memory' (NO_OPCODE si
+            no decodifica), para guardar en la cache de imagenes
+        """
+        words = array("H")
+        words.frombytes(memory.mem)
+        if sys.byteorder == "big":
+            words.byteswap()
+        return array("H", map(self.decode_table.__getitem__, words))
+
+
+    @classmethod
+    def decoder_tag(cls):
+        """ Huella de la tabla de opcodes: una tabla decodificada guardada
+            con otra version de 'opcodes' no sirve
+        """
+        return zlib.crc32(" ".join("{:04x}{:04x}{:s}{:s}".format(
+                        e.mask, e.remainder, e.opcstr, e.opdcmd)
+                        for e in cls.opcodes).encode())
+
+
+    def predecode(self, decoded):
+        """ Llena la cache de instrucciones con la tabla de decode_image,
+            hasta el ultimo byte usado de la flash
+        """
+        end = self.flash.get_highest_used()
+        if end == None:
+            return
+        icache = self.icache
+        opcodes = self.opcodes
+        for pc in range(0, end + 1, 2):
+            idx = decoded[pc >> 1]
+            if idx == self.NO_OPCODE or pc in icache:
+                continue
+            entry = opcodes[idx]
+            if pc + entry.size > self.flash.size:
+                continue
+            opd_dict = self.decode_operands(entry, pc + 2, self.flash.get_word(pc))
+            icache[pc] = (entry.sim_instr, entry, opd_dict, entry.size)
+
+
+    @classmethod
+    def build_decode_table(cls):
+        """ Construye, una sola vez por proceso, la tabla de 65536 entradas
+            que asocia cada palabra de opcode con el indice de su entrada en
+            'opcodes' (NO_OPCODE si ninguna coincide).
+            Las entradas se recorren de la ultima a la primera, de modo que
+            gana la primera coincidencia, igual que en la busqueda lineal
+            (p.ej. brcs sobre brlo, and sobre tst).
+        """
+        if cls.decode_table is not None:
+            return cls.decode_table
+
+        table = array("H", [cls.NO_OPCODE]) * 65536
+        for idx in range(len(cls.opcodes) - 1, -1, -1):
+            entry = cls.opcodes[idx]
+            free = ~entry.mask & 0xffff             # Bits de operandos
+            sub = 0
+            while True:                             # Todos los subconjuntos
+                table[entry.remainder | sub] = idx  # de 'free'
+                sub = (sub - free) & free
+                if sub == 0:
+                    break
+
+        cls.decode_table = table
+        return table
 
 
     def find_opcode(self, opc):
-        for entry in self.opcodes:
-            if (opc & entry.mask) == entry.remainder:
-                break
-        else:
+        idx = self.decode_table[opc]
+        if idx == self.NO_OPCODE:
             print("Instruccion no decodificada: {:04x}".format(opc))
             return None
-        return entry
+        return self.opcodes[idx]
     
     def find_instruction(self, instruction):
-        for entry in self.opcodes:
-            if instruction == entry.opcstr:
-                break
-        else:
+        if Atmega328.instructions == None:          # Primera fila de cada
+            table = {}                              # mnemonico
+            for entry in self.opcodes:
+                table.setdefault(entry.opcstr, entry)
+            Atmega328.instructions = table
+        entry = self.instructions.get(instruction)
+        if entry == None:
             print("Instruccion no encontrada:" + instruction)
-            return None
         return entry
 
 
-    def decode_operands(self, entry, pc, opc):
-        opd_dict = {"pc": pc}   # para calcular direcciones relativas
-        cmd = entry.opdcmd
-        if (cmd != "") and (cmd[0] == '!'):             # Instruccion de 32 bits?
-            opc = (opc << 16) | self.flash.get_word(pc)
-            cmd = cmd[1:]
-            pc += 2
-                                                        # Ej.: r4d5r1 (para ADC)
-                                                        # decodificar 0x1da5
-        while cmd != "":                                #  paso 1  paso 2  paso 3
-            r = re.match("([a-zA-Z-])(\d+)", cmd)       #  r, 4    d, 5    r, 1
-            if r == None:
-                print("error en expresion en la table")
-            field_name = r.group(1)                     #  r       d       r
-            field_len = int(r.group(2))                 #  4       5       1
+    def fetch_decoded(self, pc):
+        """ Devuelve la instruccion en 'pc' ya decodificada, desde la cache
+            si es posible. None si no hay instruccion valida.
+        """
+        slot = self.icache.get(pc)
+        if slot is not None:
+            self.icache_hits += 1
+            return slot
+
+        self.icache_misses += 1
+        opc = self.flash.get_word(pc)
+        if opc == None:
+            return None
+        entry = self.find_opcode(opc)
+        if entry == None:
+            return None
 
-            if field_name not in opd_dict:
-                opd_dict[field_name] = [0, 0]
-            step = opd_dict[field_name]
+        opd_dict = self.decode_operands(entry, pc + 2, opc)
+        slot = (entry.sim_instr, entry, opd_dict, entry.size)
+        self.icache[pc] = slot
+        return slot
 
-            temp = opc & (1 << field_len) - 1           #  5       26      0
-            opc >>= field_len                           #  0x01da  0x000e  0x0007
-            step[0] |= temp << step[1]                  #  [r]=5   [d]=26  [r]=5
-            step[1] += field_len                        #  4       5       5
 
-            cmd = cmd[len(r.group(0)):]                 #  r4d5r1  d5r1    r1
-                                                        #  ->d5r1  -> r1   -> ""
+    def invalidate_icache(self, start, end):
+        """ Descarta las instrucciones de la cache que ocupan algun byte de
+            [start, end). Se llama desde Memory en cada escritura de flash.
+        """
+        icache = self.icache
+        if not icache:
+            return
+        for addr in range((start & ~1) - 2, end, 2):    # -2: instruccion de
+            slot = icache.get(addr)                     # 32 bits anterior
+            if (slot is not None) and (addr + slot[3] > start):
+                del icache[addr]
 
-        return opd_dict
 
+    def icache_stats(self):
+        """ Devuelve (aciertos, fallos, instrucciones en cache)
+        """
+        return (self.icache_hits, self.icache_misses, len(self.icache))
 
-    def disassemble_one_instruction(self, pc, symtable = None):
+
+    def decode_operands(self, entry, pc, opc):
+        """ Extrae los operandos de 'opc' con el programa precompilado de
+            la entrada. 'pc' (ya incrementado) sirve para las direcciones
+            relativas.
+        """
+        if entry.size == 4:                             # Instruccion de 32 bits
+            opc = (opc << 16) | self.flash.get_word(pc)
+        return entry.extract(opc, pc)
+
+
+    def disassemble_at(self, pc):
+        """ Decodifica la instruccion en 'pc'. Devuelve (texto, destino,
+            pc siguiente), donde 'destino' es la direccion de un salto o
+            llamada (y el texto no incluye su etiqueta) o None. None si no
+            hay instruccion valida.
+        """
         opc = self.flash.get_word(pc)
         pc += 2
         if opc == None:
@@ -1137,40 +1649,64 @@ class Atmega328():
             return None
 
         opd_dict = self.decode_operands(entry, pc, opc)
+        pc += entry.size - 2
 
-        s= "{:8s}{:8s}".format("", entry.opcstr)
-        if entry.fmt in [Atmega328.add17, Atmega328.rel_add, Atmega328.rel_add12]:
-            sym = int(entry.fmt(opd_dict, self), 0)
-            self.symtable.add(self.symtable.create_label(sym), sym)
-            s += "{:s}".format(self.symtable.create_label(sym))
-        else:
-            s += entry.fmt(opd_dict, self)
+        s = "{:8s}{:8s}".format("", entry.opcstr)
+        if entry.fmt in (Atmega328.add17, Atmega328.rel_add, Atmega328.rel_add12):
+            return (s, int(entry.fmt(opd_dict, self), 0), pc)
+        return (s + entry.fmt(opd_dict, self), None, pc)
+
+
+    def disassemble_one_instruction(self, pc, symtable = None):
+        """ Como disassemble_at, pero con la etiqueta del destino en el
+            texto (y agregada a 'symtable' o, si no se da, a self.symtable)
+        """
+        r = self.disassemble_at(pc)
+        if r == None:
+            return None
+        s, target, pc = r
+        if target != None:
+            if symtable == None:
+                symtable = self.symtable
+            s += symtable.create_label(target)
+            symtable.add(symtable.create_label(target), target)
         return (s, pc)
         
+    def fast_operands(self, token, line):
+        """ Operandos de 'line' segun 'token' con el camino rapido, o None
+            si hay que recurrir a pyparsing
+        """
+        parser = self.fast_parsers.get(id(token))
+        if parser == None:
+            return None
+        m = parser[0].match(line)
+        if m == None:
+            return None
+        return parser[1](m)
+
+
     #funcion para ensamblar una instruccion
     def assemble_one_instruction(self, line, mem_pos):
         instruction = 0
         
-        try:
-            l = (self.etiqueta + self.comentario).parseString(line)
-            self.symtable[l[0]] = mem_pos
+        # Etiqueta: la expresion regular equivale a (etiqueta + comentario)
+        l = self.FAST_LABEL.match(line)
+        if l:
+            self.symtable[l.group(1)] = mem_pos
             return None
-        except Exception as e:
-            #print(e)
-            pass
         opc = re.match("([a-zA-Z]+)",line)
         
         entry = self.find_instruction(opc.group(1))
 
         instruction = entry.remainder
         
+        opd_list = self.fast_operands(entry.token, line) if self.fast_tokens else None
         try:
-            opd_list = (entry.token + self.comentario).parseString(line, parseAll=True)
-            if entry.token == Atmega328.jmp:
+            if opd_list == None:
+                opd_list = (entry.token + self.comentario).parseString(line, parseAll=True)
+            if entry.token is Atmega328.jmp:
                 opd_list[0] = opd_list[0] - mem_pos + (128 if opd_list[0] < mem_pos else 0)
-                print(opd_list)
 
-                
         except Exception as e:
             print("Instruccion no valida")
             print(e)
@@ -1207,21 +1743,146 @@ class Atmega328():
 
 
     def single_step(self, pc = None, symtable = None):
+        """ Ejecuta una instruccion y devuelve los ciclos que tardo (None si
+            no hay instruccion valida en el pc). Siempre suma a self.cycles.
+            Si la instruccion falla (MemoryFault) el pc queda en ella.
+        """
         if pc != None:
             self.pc = pc
 
-        opc = self.flash.get_word(self.pc)
-        self.pc += 2
-        if opc == None:
-            return None
-
-        entry = self.find_opcode(opc)
-        if entry == None:
-            return None
+        journal = self.journal
+        if journal != None:
+            journal.begin()
 
-        opd_dict = self.decode_operands(entry, pc, opc)
+        slot = self.fetch_decoded(self.pc)
+        if slot == None:
+            self.pc += 2
+            cycles = None
+        else:
+            sim_instr, entry, opd_dict, size = slot
+            start = self.pc
+            self.pc += size
+            try:
+                alt = sim_instr(self, entry.opcstr, opd_dict)
+            except MemoryFault:
+                self.pc = start
+                if journal != None:         # Con lo que llego a escribir
+                    journal.commit()
+                raise
+            cycles = entry.cycles[alt or 0]
+            self.cycles += cycles
+
+        if journal != None:
+            journal.commit()
+        return cycles
+
+
+    def run(self, max_instructions = None, until_pc = None, breakpoints = None,
+            max_cycles = None):
+        """ Ejecuta desde self.pc hasta que:
+              - se ejecutaron max_instructions instrucciones o pasaron
+                max_cycles ciclos (o algunos mas, si la ultima instruccion
+                tarda varios),
+              - el pc llega a until_pc o a una direccion de 'breakpoints'
+                (no se verifica antes de la primera instruccion, para poder
+                continuar desde un punto de parada),
+              - se ejecuta break o sleep,
+              - no hay instruccion decodificable en el pc,
+              - una instruccion accede fuera de la memoria (MemoryFault).
+            Si self.engine tiene un BlockEngine, se ejecutan bloques enteros
+            cuando no contienen puntos de parada ni exceden el limite.
+            Con self.cycle_accurate o max_cycles se cuentan los ciclos de cada
+            instruccion (en self.cycles y en el StopReason); si no, solo se
+            ejecuta. Un bloque se ejecuta entero solo si sus ciclos (los
+            maximos, si el ultimo salta) entran en lo que falta de max_cycles.
+            Con self.journal se registra cada instruccion (sin bloques).
+            Devuelve un StopReason.
+        """
+        stops = set(breakpoints) if breakpoints else set()
+        if until_pc != None:
+            stops.add(until_pc)
+        budget = -1 if max_instructions == None else max_instructions
+        limit = -1 if max_cycles == None else max_cycles
+
+        icache = self.icache
+        fetch = self.fetch_decoded
+        journal = self.journal
+        engine = self.engine if journal == None else None
+        accurate = self.cycle_accurate or max_cycles != None
+        base = self.cycles
+        cycles = 0
+        hits = 0
+        self.halted = None
+        reason = None
+        n = 0
+
+        fault = None
+        try:
+            while True:
+                pc = self.pc
+                if n == budget or (limit >= 0 and cycles >= limit):
+                    reason = StopReason.BUDGET
+                    break
+                if n and pc in stops:
+                    reason = (StopReason.UNTIL_PC if pc == until_pc
+                                else StopReason.BREAKPOINT)
+                    break
+
+                if engine != None:
+                    block = engine.blocks.get(pc) or engine.translate(pc)
+                    if ((block != None) and
+                        (budget < 0 or n + block.count <= budget) and
+                        (limit < 0 or cycles + block.cycles <= limit) and
+                        (not stops or stops.isdisjoint(range(pc + 2, block.end, 2)))):
+                        count, block_cycles = block.fn(self)
+                        n += count
+                        cycles += block_cycles
+                        if self.halted != None:
+                            reason = self.halted
+                            break
+                        continue
+
+                slot = icache.get(pc)
+                if slot == None:
+                    slot = fetch(pc)
+                    if slot == None:
+                        reason = StopReason.UNDECODED
+                        break
+                else:
+                    hits += 1
+                sim_instr, entry, opd_dict, size = slot
+                if journal != None:
+                    journal.begin()
+                self.pc = pc + size
+                alt = sim_instr(self, entry.opcstr, opd_dict)
+                if accurate:
+                    cycles += entry.cycles[alt or 0]
+                n += 1
+                if journal != None:
+                    if accurate:                    # El journal ve los ciclos
+                        self.cycles = base + cycles
+                    journal.commit()
+                if self.halted != None:
+                    reason = self.halted
+                    break
+        except MemoryFault as exc:
+            # El pc queda en la instruccion que fallo; dentro de un bloque
+            # ya lo dejo ahi el bloque, que cuenta lo que completo antes
+            if exc.partial == None:
+                self.pc = pc
+            else:
+                n += exc.partial[0]
+                cycles += exc.partial[1]
+            if journal != None and journal.pending != None:
+                journal.commit()            # Con lo que llego a escribir
+            fault = exc
+            reason = StopReason.FAULT
 
-        entry.sim_instr(self, entry.opcstr, opd_dict)
+        self.icache_hits += hits
+        if not accurate:
+            return StopReason(reason, self.pc, n, fault = fault)
+        self.cycles = base + cycles
+        return StopReason(reason, self.pc, n, cycles, fault)
 
 
 #Clase para probar simulacion
@@ -1235,35 +1896,33 @@ class Test():
         #Tabla de valores esperados
         #Partimos de flags en 0 y los registros en 0
         #(Instruccion, Reg1, ValorInicial1, ValorEsperado1, Reg2, ValorInicial2, ValorEsperado2, Banderas, PCIni, SPIni, PCFin, SPFin)
-        self.compare = (("tst", 11, 0x01, 0x01, None, None, None, 0b0000010, 0x0114, 0x7fff, 0x0116, 0x7fff),
-                        ("sub", 7, 0x01, 0x00, 8, 0x01, 0x01, 0b00000010, 0x010e, 0x7fff, 0x0110, 0x7fff),
-                        ("sbci", 16, 34, 0x00, None, None, None, 0b00000000, 0x00cc, 0x7fff, 0x00ce, 0x7fff),
-                        ("sbc", 4, 0x01, 0x00, 5, 0x01, 0x01, 0b00000000, 0x00ca, 0x7fff, 0x00cc, 0x7fff),
-                        ("ori", 16, 0x01, 0x81, None, None, None, 0b00000100, 0x00b6, 0x7fff, 0x00b8, 0x7fff),
-                        ("or", 16, 0x01, 0x81, 17, 0x80, 0x80, 0b00000100, 0x00b4, 0x7fff, 0x00b6, 0x7fff),
-                        ("movw", 4,0x00, 0x01, 8, 0x01, 0x01, 0b00000000, 0x00a8, 0x7fff, 0x00aa, 0x7fff),        #OJO: No probamos que se cambien los dos pares
-                        ("mov", 31, 0x00, 0x01, 1, 0x01, 0x01, 0b00000000, 0x00a6, 0x7fff, 0x00a8, 0x7fff),
-                        ("eor", 4, 0x00, 0x80, 14, 0x80, 0x80, 0b00000100, 0x006c, 0x7fff, 0x006e, 0x7fff))
+        #tst r11 con r11 = 1: el resultado no es cero, asi que Z queda en 0.
+        #or, ori y eor dan 0x80 o 0x81: N = 1 y V = 0, entonces S = N ^ V = 1
+        #(0x14). eor se decodifica con la fila de clr (misma mascara, va
+        #antes en la tabla), que por eso usa f_eor.
+        self.compare = (("tst", 11, 0x01, 0x01, None, None, None, 0b00000000, 0x0114, 0x08ff, 0x0116, 0x08ff),
+                        ("sub", 7, 0x01, 0x00, 8, 0x01, 0x01, 0b00000010, 0x010e, 0x08ff, 0x0110, 0x08ff),
+                        ("sbci", 16, 34, 0x00, None, None, None, 0b00000000, 0x00cc, 0x08ff, 0x00ce, 0x08ff),
+                        ("sbc", 4, 0x01, 0x00, 5, 0x01, 0x01, 0b00000000, 0x00ca, 0x08ff, 0x00cc, 0x08ff),
+                        ("ori", 16, 0x01, 0x81, None, None, None, 0b00010100, 0x00b6, 0x08ff, 0x00b8, 0x08ff),
+                        ("or", 16, 0x01, 0x81, 17, 0x80, 0x80, 0b00010100, 0x00b4, 0x08ff, 0x00b6, 0x08ff),
+                        ("movw", 4,0x00, 0x01, 8, 0x01, 0x01, 0b00000000, 0x00a8, 0x08ff, 0x00aa, 0x08ff),        #OJO: No probamos que se cambien los dos pares
+                        ("mov", 31, 0x00, 0x01, 1, 0x01, 0x01, 0b00000000, 0x00a6, 0x08ff, 0x00a8, 0x08ff),
+                        ("eor", 4, 0x00, 0x80, 14, 0x80, 0x80, 0b00010100, 0x006c, 0x08ff, 0x006e, 0x08ff))
 
 
     def run(self):
 
         for test in self.compare:
             print("Instruccion: ", test[0])
-            #Colocar PC
-            self.cpu.pc = test[8]
-            #Obtener el opc
-            opc = self.cpu.flash.get_word(self.cpu.pc)
-
-            entry = self.cpu.find_opcode(opc)
-            opd_dict = self.cpu.decode_operands(entry, test[8], opc)
-
-            #Ejecutar la instruccion
+            #Estado inicial
             self.cpu.flags = 0
             self.cpu.ram[test[1]] = test[2]
             if test[4] is not None:
                 self.cpu.ram[test[4]] = test[5]
-            entry.sim_instr(self.cpu, entry, opd_dict)
+
+            #Colocar PC y ejecutar la instruccion
+            self.cpu.single_step(test[8])
 
             #Verificar resultado
             print("Estado registros: ")
@@ -1291,6 +1950,35 @@ class Test():
             else:
                 print("Error, SP(", self.cpu.sp,") != ", test[11])
 
+        self.run_fault()
+
+
+    def run_fault(self):
+        #Falla a mitad de un bloque: inc r16; push r16 con sp = 0xffff.
+        #Con y sin el motor de bloques el estado debe ser el mismo: el inc
+        #ya se ejecuto (r16 = 1) y el pc queda en el push (0x0002).
+        from sim_block import BlockEngine
+        print("Instruccion: push fuera de la memoria (con y sin bloques)")
+        states = []
+        for engine in (False, True):
+            cpu = Atmega328(None)
+            for addr, word in ((0, 0x9503), (2, 0x930f)):
+                cpu.flash.save_byte(addr, word & 0xff)
+                cpu.flash.save_byte(addr + 1, word >> 8)
+            cpu.cycle_accurate = True
+            if engine:
+                cpu.engine = BlockEngine(cpu)
+            cpu.sp = 0xffff
+            stop = cpu.run(10)
+            states.append((stop.reason, stop.pc, stop.instructions,
+                           stop.cycles, cpu.pc, cpu.ram[16], cpu.flags))
+        if states[0] != states[1]:
+            print("    Error, ", states[0], " != ", states[1])
+        elif states[0][1:3] != (0x0002, 1) or states[0][5] != 1:
+            print("    Error, ", states[0])
+        else:
+            print("    Correcto")
+
 
 def main(args):
     #Correr test 9 ultimas instrucciones
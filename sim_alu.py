@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_alu.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Tablas precalculadas de resultado + banderas para la ALU de 8 bits.
+
+    Cada entrada de 'add' y 'sub' es un entero de 16 bits:
+        bits 0-7:  resultado
+        bits 8-15: banderas (en la posicion de SREG)
+    indexado por (carry << 16) | (Rd << 8) | Rr.
+
+    Las tablas de operaciones de un operando se indexan por el operando
+    (ror ademas por el carry: (carry << 8) | Rd). Para and, or y eor las
+    banderas dependen solo del resultado, asi que 'logic' se indexa por
+    el resultado.
+
+    Para aplicar una entrada:
+        flags = (flags & ~MASCARA) | (v >> 8)
+"""
+
+import time
+from array import array
+
+C, Z, N, V, S, H = (1 << b for b in range(6))
+
+ADD_MASK   = H | S | V | N | Z | C          # add, adc
+SUB_MASK   = H | S | V | N | Z | C          # sub, subi, cp, cpi
+SBC_MASK   = H | S | V | N | C              # sbc, sbci, cpc (Z solo se borra)
+LOGIC_MASK = S | V | N | Z                  # and, andi, or, ori, eor, tst
+INC_MASK   = S | V | N | Z                  # inc, dec
+COM_MASK   = S | V | N | Z | C              # com
+NEG_MASK   = H | S | V | N | Z | C          # neg
+SHIFT_MASK = S | V | N | Z | C              # lsr, ror, asr
+
+
+def nzs(res, v):
+    """ Banderas N, Z, S y V de un resultado de 8 bits
+    """
+    n = N if res & 0x80 else 0
+    f = n | (Z if res == 0 else 0) | (V if v else 0)
+    if bool(n) != bool(v):
+        f |= S
+    return f
+
+
+def add_entry(i):
+    c, d, r = i >> 16, (i >> 8) & 0xff, i & 0xff
+    res9 = d + r + c
+    res = res9 & 0xff
+    f = nzs(res, (d ^ res) & (r ^ res) & 0x80)
+    if (d & 0x0f) + (r & 0x0f) + c > 0x0f:
+        f |= H
+    if res9 > 0xff:
+        f |= C
+    return res | (f << 8)
+
+
+def sub_entry(i):
+    c, d, r = i >> 16, (i >> 8) & 0xff, i & 0xff
+    res9 = d - r - c
+    res = res9 & 0xff
+    f = nzs(res, (d ^ r) & (d ^ res) & 0x80)
+    if (d & 0x0f) - (r & 0x0f) - c < 0:
+        f |= H
+    if res9 < 0:
+        f |= C
+    return res | (f << 8)
+
+
+def inc_entry(d):
+    res = (d + 1) & 0xff
+    return res | (nzs(res, res == 0x80) << 8)
+
+
+def dec_entry(d):
+    res = (d - 1) & 0xff
+    return res | (nzs(res, res == 0x7f) << 8)
+
+
+def com_entry(d):
+    res = 0xff - d
+    return res | ((nzs(res, 0) | C) << 8)
+
+
+def neg_entry(d):
+    res = (-d) & 0xff
+    f = nzs(res, res == 0x80)
+    if (res | d) & 0x08:
+        f |= H
+    if res != 0:
+        f |= C
+    return res | (f << 8)
+
+
+def shift_entry(res, c):
+    """ lsr, ror y asr: V = N ^ C, S = N ^ V
+    """
+    n = res & 0x80
+    f = nzs(res, bool(n) != bool(c))
+    if c:
+        f |= C
+    return res | (f << 8)
+
+
+class Alu():
+    add   = None
+    sub   = None
+    logic = None
+    inc   = None
+    dec   = None
+    com   = None
+    neg   = None
+    lsr   = None
+    ror   = None
+    asr   = None
+
+    build_time = None
+
+    @classmethod
+    def build(cls):
+        """ Construye las tablas una sola vez por proceso
+        """
+        if cls.add is not None:
+            return
+        t0 = time.perf_counter()
+        cls.add   = array("H", map(add_entry, range(1 << 17)))
+        cls.sub   = array("H", map(sub_entry, range(1 << 17)))
+        cls.logic = array("B", (nzs(res, 0) for res in range(256)))
+        cls.inc   = array("H", map(inc_entry, range(256)))
+        cls.dec   = array("H", map(dec_entry, range(256)))
+        cls.com   = array("H", map(com_entry, range(256)))
+        cls.neg   = array("H", map(neg_entry, range(256)))
+        cls.lsr   = array("H", (shift_entry(d >> 1, d & 1) for d in range(256)))
+        cls.ror   = array("H", (shift_entry(((i >> 1) & 0x80) | ((i & 0xff) >> 1), i & 1)
+                                    for i in range(512)))
+        cls.asr   = array("H", (shift_entry((d & 0x80) | (d >> 1), d & 1)
+                                    for d in range(256)))
+        cls.build_time = time.perf_counter() - t0
+
+
+    @classmethod
+    def stats(cls):
+        """ Devuelve (bytes ocupados por las tablas, tiempo de construccion)
+        """
+        cls.build()
+        size = 0
+        for name in ("add", "sub", "logic", "inc", "dec", "com", "neg", "lsr", "ror", "asr"):
+            tbl = getattr(cls, name)
+            size += len(tbl) * tbl.itemsize
+        return size, cls.build_time
+
+
+
+def main(args):
+    size, t = Alu.stats()
+    print("Tablas de ALU: {:d} bytes, construidas en {:.1f} ms".format(size, t * 1000))
+    v = Alu.add[(0x7f << 8) | 0x01]
+    print("0x7f + 0x01 = 0x{:02x}, SREG = {:08b}".format(v & 0xff, v >> 8))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
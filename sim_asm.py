@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_asm.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Ensamblador de archivos completos, en dos pasadas, con salida Intel HEX.
+
+    Pasada 1: cada linea se separa en etiquetas, mnemonico y operandos; la
+    forma de los operandos (registro, puntero, expresion) elige la fila de
+    Atmega328.opcodes y con ella el tamano, de modo que al terminar se
+    conocen todas las etiquetas.
+    Pasada 2: se evaluan las expresiones (ya con todas las referencias
+    resueltas) y se codifica cada instruccion con el programa de operandos
+    de su fila (opd_prog), al reves de como lo hace el decodificador.
+
+    Sintaxis (la de avr-as): comentarios con ';' o '//', lineas '#' (del
+    preprocesador) ignoradas, etiquetas 'nombre:', numeros decimales, 0x y
+    0b, expresiones con + y -, lo8(), hi8() y pm(). Directivas: .org,
+    .equ/.set, .byte, .word y .end; .text, .global y similares se ignoran.
+    Ademas de las filas de la tabla se aceptan bset, bclr, brbs, brbc y cbr.
+
+    Las etiquetas quedan en un Symbol_table propio de cada Assembler (o en
+    el que se le pase), y los simbolos de .equ/.set tambien, pero fuera de
+    su indice de codigo; los simbolos enteros que ya tuviera se pueden usar
+    como constantes (p.ej. nombres de registros de E/S).
+
+    Uso: python3 sim_asm.py fuente.S [salida.hex]
+"""
+
+import re
+
+from Atmega328 import Atmega328, compile_opdcmd
+from sym_table import Symbol_table
+
+
+#
+# Forma de los operandos de cada formato de la tabla: (tipo, campo)
+#   reg       r0..r31
+#   reg16     r16..r31 (se guarda n - 16)
+#   reg16_23  r16..r23 (se guarda n - 16)
+#   regw      r24, r26, r28, r30 (se guarda (n - 24) / 2)
+#   pair      registro par (se guarda n / 2)
+#   imm       expresion
+#   nimm      expresion, complementada (cbr)
+#   data      direccion de datos de lds/sts: se toman los 16 bits bajos, como
+#             avr-as (avr-gcc les suma 0x800000)
+#   rel       direccion destino de un salto relativo
+#   abs       direccion destino de call/jmp (se guarda en palabras)
+#   Y+q, Z+q  puntero con desplazamiento
+#   X, X+, -X, ...  puntero literal, sin campo
+#
+F = Atmega328
+FORMS = {
+    F.no_opd:       (),
+    F.imm_4:        (("imm", "K"),),
+    F.bit:          (("imm", "s"),),
+    F.reg:          (("reg", "d"),),
+    F.reg4:         (("reg16", "d"),),
+    F.reg_imm:      (("reg16", "d"), ("imm", "K")),
+    F.reg8_imm:     (("reg16", "d"), ("imm", "K")),
+    F.reg_imm16:    (("reg", "d"), ("data", "k")),
+    F.imm7_reg:     (("imm", "k"), ("reg16", "d")),
+    F.imm16_reg:    (("data", "k"), ("reg", "d")),
+    F.reg_bit:      (("reg", "d"), ("imm", "b")),
+    F.bit_reg:      (("imm", "b"), ("reg", "d")),
+    F.reg_reg:      (("reg", "d"), ("reg", "r")),
+    F.reg3_reg3:    (("reg16_23", "d"), ("reg16_23", "r")),
+    F.reg8_reg8:    (("reg16_23", "d"), ("reg16_23", "r")),
+    F.reg4_reg4:    (("reg16", "d"), ("reg16", "r")),
+    F.reg_yo:       (("reg", "d"), ("Y+q", "q")),
+    F.reg_zo:       (("reg", "d"), ("Z+q", "q")),
+    F.yo_reg:       (("Y+q", "q"), ("reg", "r")),
+    F.zo_reg:       (("Z+q", "q"), ("reg", "r")),
+    F.reg_io:       (("reg", "d"), ("imm", "A")),
+    F.io_reg:       (("imm", "A"), ("reg", "r")),
+    F.io_bit:       (("imm", "A"), ("imm", "b")),
+    F.dreg_imm:     (("regw", "d"), ("imm", "K")),
+    F.dreg_dreg:    (("pair", "d"), ("pair", "r")),
+    F.rel_add:      (("rel", "k"),),
+    F.rel_add12:    (("rel", "k"),),
+    F.add17:        (("abs", "k"),),
+    F.bit_rel:      (("imm", "s"), ("rel", "k")),
+    F.just_zp:      (("Z+", None),),
+}
+for name, text in (("x", "X"), ("xp", "X+"), ("mx", "-X"),
+                   ("y", "Y"), ("yp", "Y+"), ("my", "-Y"),
+                   ("z", "Z"), ("zp", "Z+"), ("mz", "-Z")):
+    FORMS[getattr(F, "reg_" + name)] = (("reg", "d"), (text, None))
+    FORMS[getattr(F, name + "_reg")] = ((text, None), ("reg", "r"))
+del F, name, text
+
+# Alias de avr-as que no tienen fila propia en la tabla:
+# (mnemonico, bits fijos, descripcion de operandos, forma)
+ALIASES = (
+    ("bset", 0x9408, "-4s3",   (("imm", "s"),)),
+    ("bclr", 0x9488, "-4s3",   (("imm", "s"),)),
+    ("brbs", 0xf000, "s3k7",   (("imm", "s"), ("rel", "k"))),
+    ("brbc", 0xf400, "s3k7",   (("imm", "s"), ("rel", "k"))),
+    ("cbr",  0x7000, "K4d4K4", (("reg16", "d"), ("nimm", "K"))),
+)
+
+# Tipo de operando -> clase que se reconoce en el texto
+KINDS = {"reg": "reg", "reg16": "reg", "reg16_23": "reg", "regw": "reg",
+         "pair": "reg", "imm": "expr", "nimm": "expr", "data": "expr",
+         "rel": "expr", "abs": "expr"}
+
+REGISTER = re.compile(r"[rR](\d{1,2})$")
+POINTER = re.compile(r"(-?)([XYZxyz])(\+?)$")
+DISPLACEMENT = re.compile(r"([YZyz])\s*\+\s*(.+)$")
+LABEL = re.compile(r"\s*([A-Za-z_.$][\w.$]*)\s*:")
+STATEMENT = re.compile(r"\s*([.\w]+)\s*(.*?)\s*$")
+SYMBOL = re.compile(r"[A-Za-z_.$][\w.$]*$")
+TERM = re.compile(r"\s*([+-])?\s*([A-Za-z_.$][\w.$]*\s*\([^()]*\)|[^\s+-]+)")
+FUNCTION = re.compile(r"(lo8|hi8|pm)\s*\((.*)\)$")
+
+IGNORED = (".text", ".global", ".globl", ".section", ".type", ".size",
+           ".func", ".endfunc", ".file", ".ident")
+
+
+class Form():
+    """ Una manera de codificar un mnemonico con cierta forma de operandos
+    """
+    def __init__(self, opcstr, remainder, opdcmd, spec):
+        self.opcstr = opcstr
+        self.prog, self.size = compile_opdcmd(opdcmd)
+        self.base = remainder << 16 if self.size == 4 else remainder
+        self.spec = spec
+        self.bits = {}                          # campo -> ancho total
+        for field, shift, width, dest in self.prog:
+            self.bits[field] = max(self.bits.get(field, 0), dest + width)
+
+        # Los campos sin operando ya estan en los bits fijos (la 's' de
+        # breq, p.ej.), salvo la 'r' de clr, lsl, rol y tst, que repite 'd'
+        given = {field for _, field in spec}
+        self.repeat = "r" in self.bits and "r" not in given
+        if self.repeat:
+            given.add("r")
+        self.prog = tuple(step for step in self.prog if step[0] in given)
+
+    def signature(self):
+        return tuple(KINDS.get(kind, kind) for kind, field in self.spec)
+
+
+def build_forms():
+    """ Devuelve {(mnemonico, firma de operandos): Form}. Si varias filas
+        tienen la misma firma, queda la primera, como en el decodificador.
+    """
+    forms = {}
+    rows = [(e.opcstr, e.remainder, e.opdcmd, FORMS[e.fmt])
+                for e in Atmega328.opcodes if e.fmt in FORMS]
+    for opcstr, remainder, opdcmd, spec in rows + list(ALIASES):
+        form = Form(opcstr, remainder, opdcmd, spec)
+        forms.setdefault((opcstr, form.signature()), form)
+    return forms
+
+
+def classify(text):
+    """ Devuelve (clase, valor) del operando: ("reg", numero),
+        ("X+", None), ("Y+q", expresion) o ("expr", expresion)
+    """
+    m = REGISTER.match(text)
+    if m:
+        return "reg", int(m.group(1))
+    m = POINTER.match(text)
+    if m:
+        return (m.group(1) + m.group(2).upper() + m.group(3)), None
+    m = DISPLACEMENT.match(text)
+    if m:
+        return m.group(1).upper() + "+q", m.group(2)
+    return "expr", text
+
+
+def split_operands(text):
+    if not text:
+        return []
+    return [opd.strip() for opd in text.split(",")]
+
+
+def strip_comment(line):
+    i = line.find(";")
+    if i >= 0:
+        line = line[:i]
+    i = line.find("//")
+    if i >= 0:
+        line = line[:i]
+    return line
+
+
+class Assembler():
+    """ Ensambla un archivo completo. Los errores no detienen el ensamblado:
+        se anotan en self.errors como (numero de linea, mensaje), igual que
+        Memory.load_errors.
+    """
+    forms = None                    # Compartidas por todas las instancias
+
+    def __init__(self, symtable = None):
+        if Assembler.forms == None:
+            Assembler.forms = build_forms()
+        self.symtable = symtable if symtable != None else Symbol_table()
+        self.mnemonics = {opcstr for opcstr, _ in self.forms}
+        # Constantes previas; las etiquetas de un ensamblado anterior no
+        # cuentan como tales
+        self.predefined = {sym: value for sym, value in self.symtable.table.items()
+                                if isinstance(value, int)}
+        self.reset()
+
+
+    def reset(self):
+        self.errors = []
+        self.items = []             # Pasada 1: (linea, direccion, Form o ancho, operandos)
+        self.segments = []          # Pasada 2: [direccion, bytearray]
+        self.symbols = dict(self.predefined)
+        self.labels = {}
+        self.constants = {}         # .equ/.set: valores, no direcciones de codigo
+        self.lines = 0
+
+
+    def assemble(self, lines):
+        """ Ensambla las lineas (un iterable de str). Devuelve True si no
+            hubo errores.
+        """
+        self.reset()
+        self.first_pass(lines)
+        self.symtable.add_many(self.labels.items())
+        self.symtable.add_many(self.constants.items(), code = False)
+        self.second_pass()
+        self.errors.sort()
+        return not self.errors
+
+
+    def assemble_file(self, fname):
+        with open(fname) as f:
+            return self.assemble(f)
+
+
+    def first_pass(self, lines):
+        addr = 0
+        forms = self.forms
+        items = self.items
+        errors = self.errors
+        for nr, line in enumerate(lines, 1):
+            self.lines = nr
+            line = strip_comment(line)
+            if line.lstrip().startswith("#"):
+                continue
+            m = LABEL.match(line)
+            while m:
+                self.define(nr, m.group(1), addr, True)
+                line = line[m.end():]
+                m = LABEL.match(line)
+            m = STATEMENT.match(line)
+            if not m:
+                if line.strip():
+                    errors.append((nr, "linea invalida"))
+                continue
+
+            mnemonic, text = m.group(1).lower(), m.group(2)
+            if mnemonic[0] == ".":
+                if mnemonic == ".end":
+                    break
+                addr = self.directive(nr, addr, mnemonic, text)
+                continue
+
+            operands = [classify(opd) for opd in split_operands(text)]
+            form = forms.get((mnemonic, tuple(kind for kind, _ in operands)))
+            if form == None:
+                if mnemonic in self.mnemonics:
+                    errors.append((nr, "operandos invalidos para {:s}: {:s}".format(mnemonic, text)))
+                else:
+                    errors.append((nr, "instruccion desconocida: {:s}".format(mnemonic)))
+                continue
+            if addr & 1:
+                errors.append((nr, "instruccion en direccion impar 0x{:04x}".format(addr)))
+            items.append((nr, addr, form, operands))
+            addr += form.size
+
+
+    def directive(self, nr, addr, name, text):
+        """ Procesa una directiva en la pasada 1. Devuelve la nueva
+            direccion.
+        """
+        try:
+            if name == ".org":
+                return self.evaluate(text)
+            if name in (".equ", ".set"):
+                sym, value = split_operands(text)
+                self.define(nr, sym, self.evaluate(value), name == ".equ",
+                            False)
+                return addr
+            if name in (".byte", ".word"):
+                width = 1 if name == ".byte" else 2
+                values = split_operands(text)
+                self.items.append((nr, addr, width, values))
+                return addr + width * len(values)
+        except (ValueError, KeyError) as e:
+            self.errors.append((nr, "{:s}: {:s}".format(name, str(e))))
+            return addr
+        if name not in IGNORED:
+            self.errors.append((nr, "directiva desconocida: {:s}".format(name)))
+        return addr
+
+
+    def define(self, nr, sym, value, unique, code = True):
+        if unique and sym in self.symbols:
+            self.errors.append((nr, "simbolo definido dos veces: {:s}".format(sym)))
+            return
+        self.symbols[sym] = value
+        (self.labels if code else self.constants)[sym] = value
+
+
+    def evaluate(self, text):
+        """ Valor de una expresion: terminos sumados o restados, cada uno
+            un numero, un simbolo o lo8/hi8/pm de una expresion
+        """
+        try:
+            return int(text, 0)
+        except ValueError:
+            pass
+        value = self.symbols.get(text)
+        if value != None:
+            return value
+        text = text.strip()
+        if not text:
+            raise ValueError("falta un operando")
+
+        total = 0
+        pos = 0
+        while pos < len(text):
+            m = TERM.match(text, pos)
+            if not m:
+                raise ValueError("expresion invalida: {:s}".format(text))
+            sign, term = m.groups()
+            if pos > 0 and sign == None:
+                raise ValueError("expresion invalida: {:s}".format(text))
+            value = self.term(term)
+            total += -value if sign == "-" else value
+            pos = m.end()
+        return total
+
+
+    def term(self, term):
+        m = FUNCTION.match(term)
+        if m:
+            value = self.evaluate(m.group(2))
+            if m.group(1) == "lo8":
+                return value & 0xff
+            if m.group(1) == "hi8":
+                return (value >> 8) & 0xff
+            return value >> 1                       # pm: direccion en palabras
+        if SYMBOL.match(term):
+            value = self.symbols.get(term)
+            if value == None:
+                raise ValueError("simbolo no definido: {:s}".format(term))
+            return value
+        if term.isdigit():
+            return int(term)                        # Admite ceros a la izquierda
+        try:
+            return int(term, 0)
+        except ValueError:
+            raise ValueError("numero invalido: {:s}".format(term))
+
+
+    def operand(self, kind, value, bits, addr, size):
+        """ Valor del campo para un operando de tipo 'kind'
+        """
+        if kind == "reg":
+            return value
+        if kind == "reg16":
+            if value < 16:
+                raise ValueError("se esperaba r16..r31")
+            return value - 16
+        if kind == "reg16_23":
+            if not 16 <= value <= 23:
+                raise ValueError("se esperaba r16..r23")
+            return value - 16
+        if kind == "regw":
+            if value not in (24, 26, 28, 30):
+                raise ValueError("se esperaba r24, r26, r28 o r30")
+            return (value - 24) >> 1
+        if kind == "pair":
+            if value & 1:
+                raise ValueError("se esperaba un registro par")
+            return value >> 1
+
+        value = self.evaluate(value)
+        if kind == "rel":
+            offs = value - (addr + size)
+            if offs & 1 or not -(1 << bits) <= offs < (1 << bits):
+                raise ValueError("destino fuera de alcance: 0x{:04x}".format(value))
+            return (offs >> 1) & ((1 << bits) - 1)
+        if kind == "abs":
+            if value & 1:
+                raise ValueError("destino en direccion impar: 0x{:04x}".format(value))
+            value >>= 1
+        elif kind == "nimm":
+            value = ~value & ((1 << bits) - 1)
+        elif kind == "data":
+            return value & ((1 << bits) - 1)
+        if not -(1 << (bits - 1)) <= value < (1 << bits):
+            raise ValueError("valor fuera de rango: {:d}".format(value))
+        return value & ((1 << bits) - 1)
+
+
+    def encode(self, form, operands, addr):
+        """ Palabra de instruccion (de 16 o 32 bits) de 'form'
+        """
+        fields = {}
+        bits = form.bits
+        for (kind, field), (_, value) in zip(form.spec, operands):
+            if field != None:
+                fields[field] = self.operand(kind, value, bits[field], addr, form.size)
+        if form.repeat:
+            fields["r"] = fields["d"]               # clr, lsl, rol, tst
+
+        opc = form.base
+        for field, shift, width, dest in form.prog:
+            opc |= ((fields[field] >> dest) & ((1 << width) - 1)) << shift
+        return opc
+
+
+    def emit(self, addr, data):
+        segments = self.segments
+        if segments and segments[-1][0] + len(segments[-1][1]) == addr:
+            segments[-1][1] += data
+        else:
+            segments.append([addr, bytearray(data)])
+
+
+    def second_pass(self):
+        encode = self.encode
+        emit = self.emit
+        for nr, addr, form, operands in self.items:
+            try:
+                if isinstance(form, int):               # .byte / .word
+                    data = b"".join((self.evaluate(v) & ((1 << 8 * form) - 1)).to_bytes(
+                                        form, "little") for v in operands)
+                else:
+                    opc = encode(form, operands, addr)
+                    if form.size == 4:
+                        data = (opc >> 16 | (opc & 0xffff) << 16).to_bytes(4, "little")
+                    else:
+                        data = opc.to_bytes(2, "little")
+            except (ValueError, KeyError) as e:
+                self.errors.append((nr, str(e)))
+                continue
+            emit(addr, data)
+
+
+    def write_hex(self, f):
+        """ Escribe lo ensamblado como Intel HEX, en registros de 16 bytes,
+            con registros 04 cuando se pasa de los 64K
+        """
+        upper = 0
+        for start, data in sorted(self.segments):
+            for offs in range(0, len(data), 16):
+                addr = start + offs
+                chunk = data[offs : offs + 16]
+                if addr >> 16 != upper:
+                    upper = addr >> 16
+                    self.write_record(f, 0, 4, upper.to_bytes(2, "big"))
+                if (addr & 0xffff) + len(chunk) > 0x10000:
+                    split = 0x10000 - (addr & 0xffff)
+                    self.write_record(f, addr & 0xffff, 0, chunk[:split])
+                    upper = (addr + split) >> 16
+                    self.write_record(f, 0, 4, upper.to_bytes(2, "big"))
+                    addr, chunk = addr + split, chunk[split:]
+                self.write_record(f, addr & 0xffff, 0, chunk)
+        f.write(":00000001FF\n")
+
+
+    @staticmethod
+    def write_record(f, addr, kind, data):
+        rec = bytes([len(data), addr >> 8, addr & 0xff, kind]) + data
+        f.write(":{:s}{:02X}\n".format(rec.hex().upper(), -sum(rec) & 0xff))
+
+
+    def save_hex(self, fname):
+        with open(fname, "w") as f:
+            self.write_hex(f)
+
+
+    def load(self, memory):
+        """ Copia lo ensamblado en 'memory' (p.ej. cpu.flash)
+        """
+        ranges = []
+        for start, data in self.segments:
+            memory.write_block(start, data)
+            ranges.append((start, start + len(data)))
+        memory.loaded(ranges)
+
+
+    def size(self):
+        return sum(len(data) for _, data in self.segments)
+
+
+
+def main(args):
+    import time
+
+    src = args[1] if len(args) > 1 else "validate_hex.S"
+    dst = args[2] if len(args) > 2 else src.rsplit(".", 1)[0] + "_asm.hex"
+    asm = Assembler()
+    t0 = time.perf_counter()
+    ok = asm.assemble_file(src)
+    t = time.perf_counter() - t0
+    for nr, msg in asm.errors:
+        print("{:s}:{:d}: {:s}".format(src, nr, msg))
+    asm.save_hex(dst)
+    print("{:d} lineas, {:d} bytes en {:.3f} ms ({:.0f} lineas/s) -> {:s}".format(
+                asm.lines, asm.size(), t * 1000, asm.lines / t, dst))
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
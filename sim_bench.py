@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_bench.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Mediciones de rendimiento del simulador.
+    Uso: python3 sim_bench.py [nombre ...]   (sin nombres: todas)
+"""
+
+import os
+import time
+import random
+import tempfile
+from Atmega328 import Atmega328
+from sim_block import BlockEngine
+from sim_alu import Alu
+from sim_journal import Journal
+from sim_cache import ImageCache
+from sim_dis import Disassembler
+from sym_table import Symbol_table
+from sim_asm import Assembler
+from sim_mem import Memory
+
+
+def timeit(fn, repeat = 1):
+    """ Ejecuta fn() 'repeat' veces y devuelve el tiempo total (s)
+    """
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return time.perf_counter() - t0
+
+
+def report(name, seconds, count, unit):
+    print("{:<36s} {:10.3f} ms  {:12.0f} {:s}/s".format(
+                name, seconds * 1000, count / seconds, unit))
+
+
+def bench_decode():
+    Atmega328.decode_table = None
+    t = timeit(Atmega328.build_decode_table)
+    print("{:<36s} {:10.3f} ms".format("decode_table: construccion", t * 1000))
+
+    cpu = Atmega328(None)
+    words = [w for w in range(65536) if cpu.decode_table[w] != Atmega328.NO_OPCODE]
+
+    def linear():
+        for w in words:
+            for entry in cpu.opcodes:
+                if (w & entry.mask) == entry.remainder:
+                    break
+
+    def table():
+        find = cpu.find_opcode
+        for w in words:
+            find(w)
+
+    report("find_opcode: busqueda lineal", timeit(linear), len(words), "op")
+    report("find_opcode: decode_table", timeit(table), len(words), "op")
+
+    cpu.flash.save_byte(0, 0)                   # Segunda palabra de call/jmp
+    cpu.flash.save_byte(1, 0)
+    decoded = [(cpu.find_opcode(w), w) for w in words]
+
+    def operands():
+        decode = cpu.decode_operands
+        for entry, w in decoded:
+            decode(entry, 0, w)
+
+    report("decode_operands", timeit(operands), len(words), "op")
+
+
+def bench_alu():
+    Alu.add = None
+    size, t = Alu.stats()
+    print("{:<36s} {:10.3f} ms  {:12d} bytes".format("Alu: construccion de tablas", t * 1000, size))
+
+    cpu = Atmega328(None)
+    entry = cpu.find_opcode(0x0c01)                 # add r0, r1
+    opd_dict = cpu.decode_operands(entry, 0, 0x0c01)
+    count = 100000
+
+    def add():
+        f = cpu.f_add
+        for _ in range(count):
+            f("add", opd_dict)
+
+    report("f_add", timeit(add), count, "op")
+
+
+def write_hex(f, image):
+    """ Escribe 'image' como Intel HEX, en registros de 16 bytes
+    """
+    for addr in range(0, len(image), 16):
+        rec = bytes([16, addr >> 8, addr & 0xff, 0]) + image[addr : addr + 16]
+        f.write(":{:s}{:02X}\n".format(rec.hex().upper(), -sum(rec) & 0xff))
+    f.write(":00000001FF\n")
+
+
+def bench_load():
+    image = bytes(random.randrange(256) for _ in range(32768))
+    with tempfile.NamedTemporaryFile("w", suffix = ".hex", delete = False) as f:
+        write_hex(f, image)
+    with tempfile.NamedTemporaryFile("wb", suffix = ".bin", delete = False) as b:
+        b.write(image)
+    try:
+        for name, fname in (("load_flash: 32 KB Intel HEX", f.name),
+                            ("load_flash: 32 KB .bin (mmap)", b.name)):
+            cpu = Atmega328(None)
+            t = timeit(lambda: cpu.load_flash(fname), 20)
+            report(name, t, 20 * len(image), "byte")
+            assert bytes(cpu.flash.mem) == image and not cpu.flash.load_errors
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ImageCache(directory)
+            Atmega328(None).load_flash(f.name, cache = cache)
+            t = timeit(lambda: Atmega328(None).load_flash(f.name, cache = cache), 20)
+            report("load_flash: 32 KB HEX desde la cache", t, 20 * len(image), "byte")
+    finally:
+        os.unlink(f.name)
+        os.unlink(b.name)
+
+
+def bench_fetch():
+    cpu = Atmega328(None)
+    cpu.load_flash("validate_hex.hex")
+    flash = cpu.flash
+    addrs = range(0, flash.size, 2)
+
+    def words():
+        get = flash.get_word
+        for addr in addrs:
+            get(addr)
+
+    for check in (True, False):
+        flash.set_check_init(check)
+        report("get_word{:s}".format(" (check_init)" if check else ""),
+                timeit(words, 10), len(addrs) * 10, "op")
+
+    code = range(0, flash.get_highest_used() & ~1, 2)
+
+    def cold():
+        cpu.icache.clear()
+        fetch = cpu.fetch_decoded
+        for addr in code:
+            fetch(addr)
+
+    report("fetch_decoded: sin cache", timeit(cold, 100), len(code) * 100, "op")
+
+
+def bench_disasm():
+    cpu = Atmega328(Symbol_table())
+    cpu.load_flash("validate_hex.hex")
+    end = cpu.flash.get_highest_used()
+    dis = Disassembler(cpu)
+    lines = len(dis.disassemble(0, end).splitlines())
+
+    def full():
+        dis.cache.clear()
+        dis.disassemble(0, end)
+
+    def changed():
+        cpu.flash.save_byte(0x20, cpu.flash.get_byte(0x20) ^ 0x01)
+        dis.update(0, end)
+
+    report("disassemble: validate_hex.hex", timeit(full, 50), 50 * lines, "linea")
+    report("update: una palabra cambiada", timeit(changed, 50), 50 * lines, "linea")
+
+    # Flash llena (32 KB) de instrucciones al azar, en serie y en paralelo
+    rnd = random.Random(1)
+    words = [w for w in range(65536) if cpu.decode_table[w] != Atmega328.NO_OPCODE and
+                cpu.opcodes[cpu.decode_table[w]].fmt not in (Atmega328.rel_add, Atmega328.rel_add12)]
+    for pc in range(0, cpu.flash.size, 2):
+        w = rnd.choice(words)
+        cpu.flash.save_byte(pc, w & 0xff)
+        cpu.flash.save_byte(pc + 1, w >> 8)
+    end = cpu.flash.size - 2
+    serial = Disassembler(cpu)
+    t = timeit(lambda: serial.disassemble(0, end))
+    lines = len(serial.rows)
+    report("disassemble: 32 KB", t, lines, "linea")
+    parallel = Disassembler(cpu)
+    t = timeit(lambda: parallel.disassemble_parallel(0, end))
+    report("disassemble_parallel: 32 KB ({:d} cpus)".format(os.cpu_count() or 1), t, lines, "linea")
+
+
+def bench_symbols():
+    st = Symbol_table()
+    count = 10000
+    report("Symbol_table.add", timeit(lambda: [st.add("f{:d}".format(i), i * 6)
+                                              for i in range(count)]), count, "op")
+    addrs = range(0, count * 6, 3)
+    report("has_label", timeit(lambda: [st.has_label(a) for a in addrs]), len(addrs), "op")
+    report("symbol_offset", timeit(lambda: [st.symbol_offset(a) for a in addrs]),
+                len(addrs), "op")
+    report("dump_table", timeit(lambda: list(st.dump_table()), 10), 10 * count, "linea")
+
+
+def asm_source(blocks):
+    """ Fuente grande: el cuerpo de validate_hex.S repetido, cada copia con
+        su propia etiqueta para que los saltos relativos queden al alcance
+    """
+    with open("validate_hex.S") as f:
+        body = [line for line in f if not line.startswith("#") and
+                    line.strip() not in (".text", ".end", "main:")]
+    lines = []
+    for n in range(blocks):
+        label = "b{:d}".format(n)
+        lines.append(label + ":\n")
+        lines.extend(line.replace("main", label) for line in body)
+    return lines
+
+
+def bench_asm():
+    lines = asm_source(640)
+    asm = Assembler()
+    t = timeit(lambda: asm.assemble(lines), 3)
+    report("Assembler: {:d} lineas".format(len(lines)), t, 3 * len(lines), "linea")
+    assert not asm.errors
+
+    # La salida (mas de 64K: con registros 04) la tiene que aceptar Memory
+    with tempfile.NamedTemporaryFile("w", suffix = ".hex", delete = False) as f:
+        asm.write_hex(f)
+    try:
+        memory = Memory(asm.size(), Memory.FLASH)
+        assert memory.load_intel_hex(f.name)
+        assert memory.mem == asm.segments[0][1]
+    finally:
+        os.unlink(f.name)
+
+
+def bench_asm_line():
+    """ assemble_one_instruction linea por linea: camino rapido contra
+        pyparsing (con packrat), sobre la misma fuente de 100k lineas
+    """
+    forms = ("main:", "adc r2, r5", "add r3, r16 ; suma", "adiw r26, 0x12",
+             "and r4, r24", "andi r18, 0x55", "asr r7", "bld r4, 4",
+             "brcc main", "brcs main")
+    lines = [forms[i % len(forms)] for i in range(100000)]
+    symtable = {}
+    Atmega328.symtable = symtable
+    try:
+        cpu = Atmega328(symtable)
+        results = []
+        for fast in (True, False):
+            cpu.fast_tokens = fast
+            words = []
+            assemble = cpu.assemble_one_instruction
+            t = timeit(lambda: words.extend(assemble(line, pos)
+                                    for pos, line in enumerate(lines)))
+            report("assemble_one_instruction: {:s}".format(
+                        "camino rapido" if fast else "pyparsing"), t, len(lines), "linea")
+            results.append(words)
+        assert results[0] == results[1]
+    finally:
+        Atmega328.symtable = None
+
+
+def bench_step():
+    cpu = Atmega328(None)
+    cpu.load_flash("validate_hex.hex")
+    count = 20000
+
+    def program():
+        cpu.reset()
+        step = cpu.single_step
+        for _ in range(count):
+            step()
+
+    t = timeit(program, 10)
+    report("single_step: validate_hex.hex", t, count * 10, "instr")
+    print("    icache: {:d} aciertos, {:d} fallos, {:d} instrucciones".format(
+                *cpu.icache_stats()))
+
+
+def bench_block():
+    cpu = Atmega328(None)
+    cpu.load_flash("validate_hex.hex")
+    engine = BlockEngine(cpu)
+    count = [0]
+
+    def program():
+        cpu.reset()
+        n = 0
+        while n < 20000:
+            n += engine.step() or 1
+        count[0] += n
+
+    t = timeit(program, 10)
+    report("BlockEngine: validate_hex.hex", t, count[0], "instr")
+    print("    bloques traducidos: {:d}".format(engine.translated))
+
+
+def bench_run():
+    for engine in (False, True):
+        cpu = Atmega328(None)
+        cpu.load_flash("validate_hex.hex")
+        if engine:
+            cpu.engine = BlockEngine(cpu)
+        t = timeit(lambda: cpu.run(max_instructions = 200000))
+        report("run(){:s}".format(" + BlockEngine" if engine else ""),
+                t, 200000, "instr")
+
+
+def bench_flags():
+    for lazy in (False, True):
+        cpu = Atmega328(None)
+        cpu.load_flash("validate_hex.hex")
+        cpu.set_lazy_flags(lazy)
+        t = timeit(lambda: cpu.run(max_instructions = 200000))
+        report("run(){:s}".format(" + banderas perezosas" if lazy else ""),
+                t, 200000, "instr")
+        if lazy:
+            print("    banderas: {:d} calculos evitados, {:d} aplicados".format(
+                        *cpu.flag_stats()))
+
+
+def bench_cycles():
+    for accurate in (False, True):
+        cpu = Atmega328(None)
+        cpu.load_flash("validate_hex.hex")
+        cpu.cycle_accurate = accurate
+        t = timeit(lambda: cpu.run(max_instructions = 200000))
+        report("run(){:s}".format(" + ciclos exactos" if accurate else ""),
+                t, 200000, "instr")
+    print("    {:d} ciclos".format(cpu.cycles))
+
+
+def bench_lockstep():
+    try:
+        import numpy as np
+        from sim_lockstep import Lockstep
+    except ImportError:
+        print("    (requiere numpy)")
+        return
+    for lanes in (1, 100, 10000):
+        cpu = Atmega328(None)
+        cpu.load_flash("validate_hex.hex")
+        ls = Lockstep(cpu, lanes)
+        ls.ram[:] = np.random.randint(0, 256, (lanes, 32))
+        t = timeit(lambda: ls.run(200))
+        report("Lockstep: {:d} carriles".format(lanes), t, lanes * 200, "instr")
+
+
+def bench_snapshot():
+    def reload():
+        cpu = Atmega328(None)
+        cpu.load_flash("validate_hex.hex")
+
+    report("Atmega328() + load_flash", timeit(reload, 100), 100, "op")
+
+    cpu = Atmega328(None)
+    cpu.load_flash("validate_hex.hex")
+    boot = cpu.snapshot()
+    report("snapshot()", timeit(cpu.snapshot, 100000), 100000, "op")
+    report("restore()", timeit(lambda: cpu.restore(boot), 100000), 100000, "op")
+
+    def modified():
+        cpu.flash.save_byte(0x100, 0)
+        cpu.restore(boot)
+
+    report("restore() con flash modificada", timeit(modified, 10000), 10000, "op")
+
+
+def bench_journal():
+    for journal in (False, True):
+        cpu = Atmega328(None)
+        cpu.load_flash("validate_hex.hex")
+        if journal:
+            cpu.journal = Journal(cpu)
+        t = timeit(lambda: cpu.run(max_instructions = 200000))
+        report("run(){:s}".format(" + journal" if journal else ""),
+                t, 200000, "instr")
+    report("step_back(1000)", timeit(lambda: cpu.journal.step_back(1000), 50),
+                50000, "paso")
+    print("    pasos disponibles: {:d}, checkpoints: {:d}".format(*cpu.journal.stats()))
+
+
+BENCHMARKS = (
+    ("decode", bench_decode),
+    ("alu", bench_alu),
+    ("fetch", bench_fetch),
+    ("load", bench_load),
+    ("disasm", bench_disasm),
+    ("symbols", bench_symbols),
+    ("asm", bench_asm),
+    ("asm_line", bench_asm_line),
+    ("step", bench_step),
+    ("block", bench_block),
+    ("run", bench_run),
+    ("flags", bench_flags),
+    ("cycles", bench_cycles),
+    ("lockstep", bench_lockstep),
+    ("snapshot", bench_snapshot),
+    ("journal", bench_journal),
+)
+
+
+def main(args):
+    names = args[1:]
+    for name, fn in BENCHMARKS:
+        if not names or name in names:
+            print("== {:s}".format(name))
+            fn()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_block.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from Atmega328 import Atmega328
+from sim_mem import MemoryFault
+from sim_alu import (Alu, ADD_MASK, SUB_MASK, SBC_MASK, LOGIC_MASK,
+                     INC_MASK, COM_MASK, NEG_MASK, SHIFT_MASK, Z as Z_FLAG)
+
+
+def is_empty(fn):
+    """ True si fn no hace nada (instruccion todavia no simulada): los
+        manejadores vacios estan marcados con @stub en Atmega328
+    """
+    return getattr(fn, "stub", False)
+
+
+#
+# Traducciones en linea. Cada una recibe los operandos decodificados y
+# devuelve sentencias equivalentes al manejador, sobre las variables del
+# bloque: ram (cpu.data, que empieza con los registros), lazy
+# (cpu.lazy_flags) y las tablas de la ALU (t_add, t_sub, ...).
+#
+def flags_lines(table, mask, index, shift, value):
+    """ Banderas desde la tabla, en modo perezoso o no, como los
+        manejadores; 'index' es la variable con el indice y 'value' la
+        expresion con las banderas ya desplazadas
+    """
+    return ["if lazy:",
+            "    cpu.defer_flags({:d}, {:s}, {:s}, {:d})".format(mask, table, index, shift),
+            "else:",
+            "    cpu._flags = (cpu._flags & {:d}) | ({:s})".format(~mask, value)]
+
+
+def table_op(table, mask, index, store = True, base = 0):
+    """ Resultado y banderas de una tabla indexada por 'index' (formato con
+        d, r y K; 'base' se suma a d). Sin 'store' solo hay banderas (cp).
+    """
+    def template(o):
+        d = o["d"] + base
+        src = ["i = " + index.format(d = d, r = o.get("r"), K = o.get("K"))]
+        if not store:               # En modo perezoso ni se consulta la tabla
+            return src + flags_lines(table, mask, "i", 8, table + "[i] >> 8")
+        src.append("v = {:s}[i]".format(table))
+        src += flags_lines(table, mask, "i", 8, "v >> 8")
+        src.append("ram[{:d}] = v & 0xff".format(d))
+        return src
+    return template
+
+
+def logic_op(expr, store = True, base = 0):
+    """ and, or, eor, andi, ori, tst: banderas de Alu.logic
+    """
+    def template(o):
+        d = o["d"] + base
+        src = ["res = " + expr.format(d = d, r = o.get("r"), K = o.get("K"))]
+        src += flags_lines("t_logic", LOGIC_MASK, "res", 0, "t_logic[res]")
+        if store:
+            src.append("ram[{:d}] = res".format(d))
+        return src
+    return template
+
+
+def carry_op(operand, store = True, base = 0):
+    """ sbc, sbci, cpc: resta con acarreo, Z solo se puede borrar
+    """
+    def template(o):
+        d = o["d"] + base
+        src = ["v = t_sub[((cpu.flags & 0x01) << 16) | (ram[{:d}] << 8) | {:s}]".format(
+                    d, operand.format(r = o.get("r"), K = o.get("K"))),
+               "f = v >> 8",
+               "cpu.flags = (cpu.flags & {:d} & (f | {:d})) | (f & {:d})".format(
+                    ~SBC_MASK, ~Z_FLAG, SBC_MASK)]
+        if store:
+            src.append("ram[{:d}] = v & 0xff".format(d))
+        return src
+    return template
+
+TABLES = ("add", "sub", "logic", "inc", "dec", "com", "neg", "lsr", "asr", "ror")
+
+
+class Block():
+    def __init__(self, start, end, count, cycles, fn):
+        self.start = start          # Primera direccion (bytes)
+        self.end = end              # Direccion siguiente a la ultima
+        self.count = count          # Cantidad de instrucciones
+        self.cycles = cycles        # Ciclos maximos (si el ultimo salta)
+        self.fn = fn                # fn(cpu) -> (instrucciones, ciclos)
+
+
+class BlockEngine():
+    """ Motor de ejecucion opcional: traduce cada bloque basico de la flash
+        una sola vez a una funcion de Python que ejecuta sus instrucciones
+        de corrido, y la guarda en cache hasta que se escriba la flash.
+        El estado al terminar cada bloque es el mismo que deja single_step
+        instruccion por instruccion.
+        Las operaciones de registros (mov, movw y las de la ALU, con
+        registro o inmediato) se traducen en linea y actualizan ram y las
+        banderas directamente; el resto sigue siendo una llamada a su
+        manejador. cpu.pc solo se escribe antes de la ultima instruccion,
+        que es la que lo usa para calcular el destino; si un manejador
+        falla (MemoryFault), el bloque deja el pc en esa instruccion y
+        guarda en exc.partial las instrucciones y ciclos completados.
+    """
+    # Instrucciones que terminan un bloque (saltos, llamadas, retornos,
+    # saltos condicionales de instruccion y detencion)
+    TERMINATORS = { "brcc", "brcs", "breq", "brge", "brhc", "brhs", "brid",
+                    "brie", "brlo", "brlt", "brmi", "brne", "brpl", "brsh",
+                    "brtc", "brts", "brvc", "brvs", "brbc", "brbs",
+                    "rjmp", "rcall", "jmp", "call", "ijmp", "icall",
+                    "eijmp", "eicall", "ret", "reti",
+                    "cpse", "sbrc", "sbrs", "sbic", "sbis",
+                    "break", "sleep" }
+
+    MAX_BLOCK = 64
+
+    # Traducciones en linea: sentencias que reemplazan la llamada al
+    # manejador (ver table_op y siguientes)
+    templates = {
+        Atmega328.f_mov:    lambda o: ["ram[{d}] = ram[{r}]".format(**o)],
+        Atmega328.f_movw:   lambda o: ["ram[{0}] = ram[{1}]".format(o["d"]*2, o["r"]*2),
+                                       "ram[{0}] = ram[{1}]".format(o["d"]*2+1, o["r"]*2+1)],
+        Atmega328.f_add:    table_op("t_add", ADD_MASK, "(ram[{d}] << 8) | ram[{r}]"),
+        Atmega328.f_adc:    table_op("t_add", ADD_MASK,
+                                "((cpu.flags & 0x01) << 16) | (ram[{d}] << 8) | ram[{r}]"),
+        Atmega328.f_sub:    table_op("t_sub", SUB_MASK, "(ram[{d}] << 8) | ram[{r}]"),
+        Atmega328.f_subi:   table_op("t_sub", SUB_MASK, "(ram[{d}] << 8) | {K}", base = 16),
+        Atmega328.f_cp:     table_op("t_sub", SUB_MASK, "(ram[{d}] << 8) | ram[{r}]", False),
+        Atmega328.f_cpi:    table_op("t_sub", SUB_MASK, "(ram[{d}] << 8) | {K}", False, 16),
+        Atmega328.f_sbc:    carry_op("ram[{r}]"),
+        Atmega328.f_sbci:   carry_op("{K}", base = 16),
+        Atmega328.f_cpc:    carry_op("ram[{r}]", False),
+        Atmega328.f_and:    logic_op("ram[{d}] & ram[{r}]"),
+        Atmega328.f_or:     logic_op("ram[{d}] | ram[{r}]"),
+        Atmega328.f_eor:    logic_op("ram[{d}] ^ ram[{r}]"),
+        Atmega328.f_andi:   logic_op("ram[{d}] & {K}", base = 16),
+        Atmega328.f_ori:    logic_op("ram[{d}] | {K}", base = 16),
+        Atmega328.f_tst:    logic_op("ram[{d}]", False),
+        Atmega328.f_inc:    table_op("t_inc", INC_MASK, "ram[{d}]"),
+        Atmega328.f_dec:    table_op("t_dec", INC_MASK, "ram[{d}]"),
+        Atmega328.f_com:    table_op("t_com", COM_MASK, "ram[{d}]"),
+        Atmega328.f_neg:    table_op("t_neg", NEG_MASK, "ram[{d}]"),
+        Atmega328.f_lsr:    table_op("t_lsr", SHIFT_MASK, "ram[{d}]"),
+        Atmega328.f_asr:    table_op("t_asr", SHIFT_MASK, "ram[{d}]"),
+        Atmega328.f_ror:    table_op("t_ror", SHIFT_MASK, "((cpu.flags & 0x01) << 8) | ram[{d}]"),
+    }
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}            # inicio -> Block
+        self.owners = {}            # direccion de palabra -> [inicios]
+        self.translated = 0
+        cpu.flash.add_watcher(self.invalidate)
+
+
+    def translate(self, start):
+        """ Construye el bloque que comienza en 'start'. None si no hay
+            ninguna instruccion decodificable en esa direccion.
+        """
+        cpu = self.cpu
+        pc = start
+        slots = []
+        while len(slots) < self.MAX_BLOCK:
+            slot = cpu.fetch_decoded(pc)
+            if slot == None:
+                break
+            slots.append((pc, slot))
+            pc += slot[3]
+            if slot[1].opcstr in self.TERMINATORS:
+                break
+        if not slots:
+            return None
+
+        src = ["def block(cpu):", "    ram = cpu.data", "    lazy = cpu.lazy_flags"]
+        names = {"t_" + name: getattr(Alu, name) for name in TABLES}
+        body = []                   # Sentencias de las instrucciones
+        starts = []                 # Direccion de cada instruccion
+        before = []                 # Ciclos fijos antes de cada instruccion
+        cycles = 0                  # Ciclos fijos del bloque
+        result = None               # Expresion de retorno
+        for n, (addr, (sim_instr, entry, opd_dict, size)) in enumerate(slots):
+            starts.append(addr)
+            before.append(cycles)
+            last = (n == len(slots) - 1)
+            if last:                            # El manejador ve el pc
+                body.append("cpu.pc = {:d}".format(addr + size))
+            if sim_instr in self.templates:
+                body += self.templates[sim_instr](opd_dict)
+            elif not is_empty(sim_instr):
+                # Los manejadores pueden fallar (MemoryFault): k dice cual
+                names["h{:d}".format(n)] = sim_instr
+                names["o{:d}".format(n)] = opd_dict
+                body.append("k = {:d}".format(n))
+                call = "h{0:d}(cpu, {1!r}, o{0:d})".format(n, entry.opcstr)
+                if last and len(entry.cycles) > 1:
+                    # El costo depende de si salto o salteo (ver OPC.cycles)
+                    result = "{:d}, {:d} + {!r}[{:s} or 0]".format(
+                                len(slots), cycles, entry.cycles, call)
+                    break
+                body.append(call)
+            cycles += entry.cycles[0]
+        if result == None:
+            result = "{:d}, {:d}".format(len(slots), cycles)
+        body.append("return " + result)
+
+        if any(s.startswith("k = ") for s in body):
+            # Ante una falla el pc queda en la instruccion que fallo y la
+            # excepcion lleva lo que se completo antes, como en run()
+            names["starts"] = tuple(starts)
+            names["before"] = tuple(before)
+            names["MemoryFault"] = MemoryFault
+            src += (["    try:"] + ["        " + s for s in body] +
+                    ["    except MemoryFault as exc:",
+                     "        cpu.pc = starts[k]",
+                     "        exc.partial = (k, before[k])",
+                     "        raise"])
+        else:
+            src += ["    " + s for s in body]
+
+        exec(compile("\n".join(src), "<block 0x{:04x}>".format(start), "exec"), names)
+        worst = sum(max(slot[1].cycles) for _, slot in slots)
+        block = Block(start, pc, len(slots), worst, names["block"])
+
+        self.blocks[start] = block
+        for addr in range(start, pc, 2):
+            self.owners.setdefault(addr, []).append(start)
+        self.translated += 1
+        return block
+
+
+    def invalidate(self, start, end):
+        """ Descarta los bloques que contienen algun byte de [start, end)
+        """
+        if not self.blocks:
+            return
+        for addr in range(start & ~1, end, 2):
+            for bstart in self.owners.pop(addr, ()):
+                block = self.blocks.pop(bstart, None)
+                if block == None:
+                    continue
+                for a in range(block.start, block.end, 2):
+                    if a != addr and bstart in self.owners.get(a, ()):
+                        self.owners[a].remove(bstart)
+
+
+    def step(self):
+        """ Ejecuta el bloque que comienza en cpu.pc, suma sus ciclos a
+            cpu.cycles y devuelve la cantidad de instrucciones ejecutadas
+            (None si no hay instruccion valida, igual que single_step).
+        """
+        block = self.blocks.get(self.cpu.pc)
+        if block == None:
+            block = self.translate(self.cpu.pc)
+            if block == None:
+                return self.cpu.single_step()
+        try:
+            count, cycles = block.fn(self.cpu)
+        except MemoryFault as exc:
+            self.cpu.cycles += exc.partial[1]
+            raise
+        self.cpu.cycles += cycles
+        return count
+
+
+
+def main(args):
+    cpu = Atmega328(None)
+    cpu.load_flash("validate_hex.hex")
+    engine = BlockEngine(cpu)
+    for _ in range(20):
+        n = engine.step()
+        print("0x{:04x}: {:d} instrucciones".format(cpu.pc, n or 0))
+    print("Bloques traducidos: {:d}".format(engine.translated))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
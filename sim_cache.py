@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_cache.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Cache en disco de imagenes ya cargadas (opcional).
+
+    Por cada archivo de programa se guarda un binario con el contenido de
+    la memoria, el bitmap de bytes inicializados, highest_used, los
+    rangos escritos y, si se pide, la tabla de instrucciones decodificadas
+    (indice en Atmega328.opcodes de cada palabra).
+
+    Formato (little endian):
+        cabecera   HEADER (ver abajo)
+        mem        'size' bytes
+        bitmap     'size // 8' bytes
+        rangos     'nranges' pares de uint32 [inicio, fin)
+        decodif.   'ndecoded' uint16
+
+    La entrada se identifica por la ruta del archivo (nombre del archivo
+    de cache) y se valida con su tamano, mtime y sha256. Si tamano y mtime
+    coinciden se usa sin releer el original; si no, se compara el hash.
+    El crc32 del contenido detecta entradas corruptas. Cualquier entrada
+    vencida o invalida se reconstruye sola.
+
+    Uso:
+        cache = ImageCache()                # o ImageCache(decoded = True)
+        cpu.load_flash("programa.hex", cache = cache)
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import tempfile
+from array import array
+
+from sim_mem import Memory
+
+MAGIC = b"AVRIMG01"
+HAS_DECODED = 0x01
+
+# magic, flags, etiqueta del decodificador, size, base, highest_used y
+# start_address (-1: None), nranges, ndecoded, tamano y mtime_ns del
+# original, sha256 del original, crc32 del contenido
+HEADER = struct.Struct("<8sIIIIiiIIQQ32sI")
+
+
+def file_hash(fname):
+    with open(fname, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+class ImageCache():
+    """ 'directory': donde se guardan las entradas (por defecto
+        ~/.cache/atmega328). Con 'decoded' tambien se guarda la tabla de
+        instrucciones decodificadas.
+    """
+    def __init__(self, directory = None, decoded = False):
+        if directory == None:
+            directory = os.path.join(os.path.expanduser("~"), ".cache", "atmega328")
+        self.directory = directory
+        self.decoded = decoded
+        self.hits = 0
+        self.misses = 0             # Entradas nuevas o reconstruidas
+        self.rebuilt = 0            # De las anteriores, vencidas o corruptas
+
+
+    def entry_name(self, fname):
+        key = hashlib.sha1(os.path.abspath(fname).encode()).hexdigest()
+        return os.path.join(self.directory, key + ".img")
+
+
+    def load(self, memory, fname, loader, decoder = None, tag = 0):
+        """ Carga 'fname' en 'memory' desde la cache, o con
+            loader(memory, fname) si no hay entrada valida (y la guarda).
+            decoder(memory), si se da, calcula la tabla decodificada; 'tag'
+            identifica al decodificador (una entrada con otra etiqueta se
+            considera vencida).
+            Devuelve (resultado del loader o True, tabla decodificada o
+            None).
+        """
+        st = os.stat(fname)
+        cname = self.entry_name(fname)
+        want = tag if decoder != None else None
+        state, decoded = self.read(cname, fname, st, memory, want)
+        if state == "ok":
+            self.hits += 1
+            return True, decoded
+
+        self.misses += 1
+        if state == "stale":
+            self.rebuilt += 1
+
+        # Se carga en una memoria vacia para que la entrada sirva sin
+        # importar lo que 'memory' tuviera antes
+        fresh = Memory(memory.size, memory.memtype, memory.base)
+        ranges = []
+        fresh.add_watcher(lambda start, end: ranges.append((start, end)))
+        result = loader(fresh, fname)
+        decoded = decoder(fresh) if decoder != None else None
+        if not fresh.load_errors:
+            self.write(cname, fname, st, fresh, ranges, decoded, tag)
+        self.apply(memory, fresh.mem, fresh.bitmap, fresh.highest_used, ranges)
+        memory.load_errors = fresh.load_errors
+        memory.start_address = fresh.start_address
+        return result, decoded
+
+
+    def read(self, cname, fname, st, memory, tag):
+        """ Intenta cargar la entrada (con la tabla decodificada de
+            etiqueta 'tag', si no es None). Devuelve (estado, tabla), con
+            estado "ok", "missing" o "stale".
+        """
+        try:
+            f = open(cname, "rb")
+        except OSError:
+            return "missing", None
+        with f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            except ValueError:                          # Archivo vacio
+                return "stale", None
+        with mm:
+            if len(mm) < HEADER.size:
+                return "stale", None
+            (magic, flags, entry_tag, size, base, highest, start_address,
+             nranges, ndecoded, src_size, src_mtime, src_hash,
+             crc) = HEADER.unpack_from(mm, 0)
+            if (magic != MAGIC or size != memory.size or base != memory.base or
+                    (tag != None and not (flags & HAS_DECODED and entry_tag == tag))):
+                return "stale", None
+            if (src_size, src_mtime) != (st.st_size, st.st_mtime_ns):
+                if src_size != st.st_size or src_hash != file_hash(fname):
+                    return "stale", None
+
+            start = HEADER.size
+            lengths = (size, size // 8, nranges * 8, ndecoded * 2)
+            if len(mm) != start + sum(lengths):
+                return "stale", None
+            with memoryview(mm) as view:
+                if zlib.crc32(view[start:]) != crc:
+                    return "stale", None
+                parts = []
+                for length in lengths:
+                    parts.append(view[start : start + length])
+                    start += length
+                mem, bitmap, ranges, decoded = parts
+                pairs = array("I")
+                pairs.frombytes(ranges)
+                self.apply(memory, mem, bitmap, None if highest < 0 else highest,
+                           list(zip(pairs[0::2], pairs[1::2])))
+                table = None
+                if tag != None:
+                    table = array("H")
+                    table.frombytes(decoded)
+                for part in parts:
+                    part.release()
+        memory.load_errors = []
+        memory.start_address = None if start_address < 0 else start_address
+        return "ok", table
+
+
+    def apply(self, memory, mem, bitmap, highest_used, ranges):
+        """ Copia la imagen en 'memory'. Si estaba vacia se copia todo de
+            una vez; si no, solo los rangos escritos, como haria el loader.
+        """
+        if memory.highest_used == None:
+            memory.mem[:] = mem
+            memory.bitmap[:] = bitmap
+            memory.highest_used = highest_used
+        else:
+            for start, end in ranges:
+                memory.write_block(start, mem[start - memory.base : end - memory.base])
+        memory.loaded(ranges)
+
+
+    def write(self, cname, fname, st, memory, ranges, decoded, tag):
+        """ Guarda la entrada; se escribe en un temporal y se renombra, de
+            modo que nunca queda una entrada a medio escribir
+        """
+        pairs = array("I", [n for r in ranges for n in r])
+        body = [memory.mem, memory.bitmap, pairs.tobytes(),
+                decoded.tobytes() if decoded != None else b""]
+        crc = 0
+        for part in body:
+            crc = zlib.crc32(part, crc)
+        header = HEADER.pack(MAGIC, HAS_DECODED if decoded != None else 0,
+                             tag if decoded != None else 0, memory.size, memory.base,
+                             -1 if memory.highest_used == None else memory.highest_used,
+                             -1 if memory.start_address == None else memory.start_address,
+                             len(ranges), len(decoded) if decoded != None else 0,
+                             st.st_size, st.st_mtime_ns, file_hash(fname), crc)
+        os.makedirs(self.directory, exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                for part in body:
+                    f.write(part)
+            os.replace(tmp, cname)
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+
+    def stats(self):
+        """ Devuelve (aciertos, fallos, reconstrucciones)
+        """
+        return self.hits, self.misses, self.rebuilt
+
+
+
+def main(args):
+    import time
+    from Atmega328 import Atmega328
+
+    fname = args[1] if len(args) > 1 else "validate_hex.hex"
+    cache = ImageCache(tempfile.mkdtemp())
+    for n in range(3):
+        cpu = Atmega328(None)
+        t0 = time.perf_counter()
+        cpu.load_flash(fname, cache = cache)
+        print("Carga {:d}: {:.3f} ms".format(n, (time.perf_counter() - t0) * 1000))
+    print("Aciertos: {:d}, fallos: {:d}, reconstrucciones: {:d}".format(*cache.stats()))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -24,51 +24,254 @@
 
 import re
 import pdb
+import os
+from concurrent.futures import ProcessPoolExecutor
 from sim_mem import Memory
 from Atmega328 import Atmega328
 from sym_table import Symbol_table
 
 
+#
+# Desensamblado en paralelo: lado del proceso de trabajo
+#
+worker_cpu = None
+
+def init_worker(mem, bitmap, highest_used):
+    """ Cada proceso arma su cpu con una copia de la flash
+    """
+    global worker_cpu
+    worker_cpu = Atmega328(None)
+    flash = worker_cpu.flash
+    flash.mem[:] = mem
+    flash.bitmap[:] = bitmap
+    flash.highest_used = highest_used
+
+
+def decode_chunk(start, end):
+    """ Decodifica desde 'start' hasta pasar 'end' (la ultima instruccion
+        puede ser de 2 palabras y cruzar el limite). Devuelve las entradas
+        para Disassembler.cache; las palabras que no decodifican se saltean
+        (el recorrido final las encuentra y falla igual que en serie).
+    """
+    cpu = worker_cpu
+    mem = cpu.flash.mem
+    base = cpu.flash.base
+    slots = []
+    pc = start
+    while pc < end:
+        r = cpu.disassemble_at(pc)
+        if r == None:
+            pc += 2
+            continue
+        text, target, next_pc = r
+        slots.append((pc, (bytes(mem[pc - base : next_pc - base]), text, target, next_pc)))
+        pc = next_pc
+    return slots
+
+
+class ListingDiff():
+    """ Cambios entre dos listados de Disassembler.update, para aplicar
+        sobre las filas del listado anterior:
+            edits: [(operacion, indice, texto)] en orden creciente, con
+                   operacion "insert" (antes de la fila 'indice'),
+                   "delete" o "replace"; aplicarlas de la ultima a la
+                   primera para que los indices sigan valiendo
+            labels_added, labels_removed: direcciones con etiqueta
+            decoded: instrucciones que hubo que decodificar
+    """
+    def __init__(self, edits, labels_added, labels_removed, decoded):
+        self.edits = edits
+        self.labels_added = labels_added
+        self.labels_removed = labels_removed
+        self.decoded = decoded
+
+    def __str__(self):
+        return "{:d} cambios, +{:d}/-{:d} etiquetas, {:d} decodificadas".format(
+                    len(self.edits), len(self.labels_added),
+                    len(self.labels_removed), self.decoded)
+
+
 class Disassembler():
-    def __init__(self, cpu):
+    def __init__(self, cpu, symtable = None):
         self.cpu = cpu
+        if symtable == None:
+            symtable = cpu.symtable if cpu.symtable != None else Symbol_table()
+        self.symtable = symtable
+        self.cache = {}         # direccion -> (bytes, texto sin etiqueta,
+                                #             destino, pc siguiente)
+        self.rows = []          # Ultimo listado: [(clave, texto)]
+        self.sources = {}       # direccion -> destino que aporto su instruccion
+        self.refs = {}          # destino -> cuantas instrucciones lo aportan
+        self.auto = set()       # Etiquetas creadas aca (se quitan sin refs)
+        self.decoded = 0        # Decodificadas en el ultimo decode()
         print("Numero de instrucciones: ", len(self.cpu.opcodes))
 
 
     def load_flash(self, prog_name):
-        self.cpu.load_flash(prog_name)
+        self.cpu.load_flash(prog_name, self.symtable)
+        
+        
+    def decode(self, pc, end):
+        """ Decodifica cada instruccion de [pc, end) y agrega los destinos
+            de saltos y llamadas a la tabla de simbolos. Las direcciones
+            cuyas palabras de flash no cambiaron desde la ultima vez salen
+            de la cache, sin decodificar; como el recorrido sigue los
+            limites de instruccion, un cambio se propaga solo hasta donde
+            vuelve a coincidir con lo anterior.
+            Cada destino lleva la cuenta de las instrucciones que lo
+            aportan; la etiqueta que se creo para uno se quita de la tabla
+            cuando ya ninguna lo hace.
+            Devuelve [(direccion, texto)].
+        """
+        disassemble_at = self.cpu.disassemble_at
+        mem = self.cpu.flash.mem
+        base = self.cpu.flash.base
+        cache = self.cache
+        symtable = self.symtable
+        sources = self.sources
+        lines = []
+        visited = set()
+        start = pc
+        self.decoded = 0
+        while pc < end:
+            slot = cache.get(pc)
+            if slot == None or mem[pc - base : slot[3] - base] != slot[0]:
+                r = disassemble_at(pc)
+                if r == None:
+                    raise Exception("No puedo desensamblar en 0x{:04x}".format(pc))
+                text, target, next_pc = r
+                slot = (bytes(mem[pc - base : next_pc - base]), text, target, next_pc)
+                cache[pc] = slot
+                self.decoded += 1
+            key, text, target, next_pc = slot
+            if sources.get(pc) != target:
+                self.unref(sources.pop(pc, None))
+                if target != None:
+                    self.ref(target)
+                    sources[pc] = target
+            if target != None:
+                text += symtable.create_label(target)
+            visited.add(pc)
+            lines.append((pc, text))
+            pc = next_pc
+
+        # Instrucciones del listado anterior que ahora quedaron a mitad de
+        # otra (cambio de limites)
+        for addr in [a for a in sources if start <= a < end and a not in visited]:
+            self.unref(sources.pop(addr))
+        return lines
+
+
+    def ref(self, target):
+        count = self.refs.get(target, 0)
+        self.refs[target] = count + 1
+        if count == 0:
+            lbl = self.symtable.create_label(target)
+            if self.symtable.find_symbol(lbl) is False:
+                self.auto.add(lbl)
+            self.symtable.add(lbl, target)
+
+
+    def unref(self, target):
+        if target == None:
+            return
+        count = self.refs.pop(target) - 1
+        if count:
+            self.refs[target] = count
+            return
+        lbl = self.symtable.create_label(target)
+        if lbl in self.auto:
+            self.auto.discard(lbl)
+            self.symtable.remove(lbl)
+
+
+    def listing(self, pc, end):
+        """ Filas del listado completo como (clave, texto); la clave
+            ordena las filas: (0, direccion, 0, nombre) etiqueta,
+            (0, direccion, 1) instruccion, (1, n) encabezado de la tabla,
+            (2, simbolo)
+        """
+        lines = self.decode(pc, end)
+        symtable = self.symtable
+        by_code = symtable.by_code
+        rows = []
+        for addr, text in lines:
+            if addr in by_code:
+                for lbl in by_code[addr]:
+                    rows.append(((0, addr, 0, lbl), "     {:s}:".format(lbl)))
+            rows.append(((0, addr, 1), "{:04x}{:s}".format(addr, text)))
+
+        rows.append(((1, 0), ""))
+        rows.append(((1, 1), "Tabla de simbolos"))
+        for sym, value in symtable.sorted_items():
+            rows.append(((2, sym), symtable.format_entry(sym, value)))
+        return rows
+        
+        
+    def iter_disassemble(self, pc, end):
+        """ Genera las lineas del listado (sin fin de linea), con las
+            etiquetas ya ubicadas, seguidas de la tabla de simbolos
+        """
+        self.rows = self.listing(pc, end)
+        for key, text in self.rows:
+            yield text
         
         
     def disassemble(self, pc, end):
-        # Pasada 1: Recoleccion de etiquetas
-        tpc = pc
-        while tpc < end:
-            r = self.cpu.disassemble_one_instruction(tpc, self.cpu.symtable)
-            if r == None:
-                raise Exception("No puedo desensamblar en 0x{:04x}".format(tpc))
-            tpc = r[1]
-                
-        # Pasada 2: Generacion del listado
-        tpc = pc
-        s = ""
-        while tpc < end:
-            r = self.cpu.disassemble_one_instruction(tpc, self.cpu.symtable)
-            if r != None:
-                lbl = self.cpu.symtable.create_label(tpc)
-                sym = self.cpu.symtable.find_symbol(lbl)
-                if type(sym) != bool:                   # Para detectar False!
-                    s += "     {:s}:\n".format(lbl)
-                s += "{:04x}{:s}\n".format(tpc, r[0])
-                tpc = r[1]
+        return "".join(line + "\n" for line in self.iter_disassemble(pc, end))
+
+
+    def disassemble_parallel(self, pc, end, workers = None, chunks = None):
+        """ Igual que disassemble(pc, end), pero la decodificacion se
+            reparte en 'chunks' tramos (por defecto 4 por proceso) en un
+            ProcessPoolExecutor.
+            Cada tramo se decodifica desde su comienzo, que puede caer en
+            la segunda palabra de un call/jmp/lds/sts, y sigue hasta pasar
+            su final. Los resultados solo llenan la cache; el recorrido en
+            serie posterior sigue los limites reales de instruccion, usa la
+            cache donde coincide y decodifica lo que falte en las uniones.
+            El listado y las etiquetas quedan identicos a los de
+            disassemble().
+        """
+        workers = workers or os.cpu_count() or 1
+        chunks = chunks or 4 * workers
+        size = max(2, ((end - pc) // chunks + 1) & ~1)
+        flash = self.cpu.flash
+        with ProcessPoolExecutor(max_workers = workers, initializer = init_worker,
+                                 initargs = (bytes(flash.mem), bytes(flash.bitmap),
+                                             flash.highest_used)) as pool:
+            starts = range(pc, end, size)
+            for slots in pool.map(decode_chunk, starts,
+                                  [min(s + size, end) for s in starts]):
+                self.cache.update(slots)
+        return self.disassemble(pc, end)
+
+
+    def update(self, pc, end):
+        """ Vuelve a desensamblar [pc, end) (con la cache) y devuelve un
+            ListingDiff respecto del listado anterior
+        """
+        old = self.rows
+        new = self.listing(pc, end)
+        edits = []
+        i = j = 0
+        while i < len(old) or j < len(new):
+            if i < len(old) and j < len(new) and old[i][0] == new[j][0]:
+                if old[i][1] != new[j][1]:
+                    edits.append(("replace", i, new[j][1]))
+                i += 1
+                j += 1
+            elif i == len(old) or (j < len(new) and new[j][0] < old[i][0]):
+                edits.append(("insert", i, new[j][1]))
+                j += 1
             else:
-                break
-
-        s += "\n"
-        s += "Tabla de simbolos\n"
-        for l in self.cpu.symtable.dump_table():
-            s += l + "\n"
-            
-        return s
+                edits.append(("delete", i, None))
+                i += 1
+
+        labels = lambda rows: {k[1] for k, t in rows if k[0] == 0 and k[2] == 0}
+        before, after = labels(old), labels(new)
+        self.rows = new
+        return ListingDiff(edits, after - before, before - after, self.decoded)
         
 
 
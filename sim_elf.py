@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_elf.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Carga de imagenes ELF de avr-gcc (32 bits, little endian).
+
+    El archivo se mapea en memoria con mmap y cada segmento PT_LOAD se
+    copia a la flash con una sola asignacion de rebanada, en su direccion
+    fisica (p_paddr): asi el valor inicial de .data, que vive en la SRAM
+    pero se guarda en la flash, queda donde lo busca el codigo de arranque.
+    Los segmentos fuera de la flash (eeprom, fusibles) no se cargan y
+    quedan anotados en load_errors.
+
+    Los simbolos FUNC y OBJECT de .symtab se pueden cargar de una vez en
+    un Symbol_table (los OBJECT como simbolos de datos, fuera del indice
+    de codigo). Las direcciones de datos de avr-gcc llevan 0x800000
+    sumado; se les resta, para que queden en el espacio de datos del cpu.
+
+    Uso: python3 sim_elf.py archivo.elf
+"""
+
+import mmap
+import struct
+
+EM_AVR = 83
+PT_LOAD = 1
+SHT_SYMTAB = 2
+STT_OBJECT, STT_FUNC = 1, 2
+
+DATA_OFFSET = 0x800000          # Espacio de datos en las direcciones de avr-gcc
+EEPROM_OFFSET = 0x810000
+
+ELF_HEADER = struct.Struct("<16sHHIIIIIHHHHHH")
+PROGRAM_HEADER = struct.Struct("<IIIIIIII")
+SECTION_HEADER = struct.Struct("<IIIIIIIIII")
+SYMBOL = struct.Struct("<IIIBBH")
+
+
+class ElfError(Exception):
+    """ El archivo no es un ELF de AVR valido
+    """
+    pass
+
+
+class ElfFile():
+    """ Vista de solo lectura sobre un ELF mapeado en memoria. Usar como
+        administrador de contexto para liberar el mapeo.
+    """
+    def __init__(self, fname):
+        with open(fname, "rb") as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            except ValueError:                  # Archivo vacio
+                raise ElfError("{:s}: archivo vacio".format(fname))
+        self.view = memoryview(self.mm)
+        try:
+            self.parse_header(fname)
+        except (ElfError, struct.error):
+            self.close()
+            raise
+
+
+    def parse_header(self, fname):
+        if len(self.mm) < ELF_HEADER.size:
+            raise ElfError("{:s}: demasiado corto para ser ELF".format(fname))
+        (ident, self.e_type, self.e_machine, _, self.entry, self.phoff,
+         self.shoff, _, _, self.phentsize, self.phnum, self.shentsize,
+         self.shnum, _) = ELF_HEADER.unpack_from(self.mm, 0)
+        if ident[:4] != b"\x7fELF":
+            raise ElfError("{:s}: no es un archivo ELF".format(fname))
+        if ident[4] != 1 or ident[5] != 1:
+            raise ElfError("{:s}: solo se soportan ELF de 32 bits little endian".format(fname))
+        if self.e_machine != EM_AVR:
+            raise ElfError("{:s}: no es un ELF de AVR (e_machine = {:d})".format(
+                        fname, self.e_machine))
+
+
+    def segments(self):
+        """ Genera (direccion fisica, datos) de cada segmento PT_LOAD con
+            contenido. 'datos' es una memoryview sobre el mapeo (sin copia).
+        """
+        for i in range(self.phnum):
+            (p_type, offset, vaddr, paddr, filesz, memsz, flags,
+             align) = PROGRAM_HEADER.unpack_from(self.mm, self.phoff + i * self.phentsize)
+            if p_type == PT_LOAD and filesz:
+                yield paddr, self.view[offset : offset + filesz]
+
+
+    def sections(self):
+        return [SECTION_HEADER.unpack_from(self.mm, self.shoff + i * self.shentsize)
+                    for i in range(self.shnum)]
+
+
+    def symbols(self, types = (STT_FUNC, STT_OBJECT)):
+        """ Devuelve [(nombre, valor)] de los simbolos de .symtab cuyo tipo
+            esta en 'types'. Las direcciones de datos quedan sin el
+            desplazamiento 0x800000.
+        """
+        sections = self.sections()
+        result = []
+        for sh in sections:
+            if sh[1] != SHT_SYMTAB:
+                continue
+            strtab = sections[sh[6]]
+            names = self.mm[strtab[4] : strtab[4] + strtab[5]]
+            offset, size = sh[4], sh[5]
+            for st_name, value, _, info, _, _ in SYMBOL.iter_unpack(
+                        self.view[offset : offset + size - size % SYMBOL.size]):
+                if (info & 0x0f) not in types or st_name == 0:
+                    continue
+                if DATA_OFFSET <= value < EEPROM_OFFSET:
+                    value -= DATA_OFFSET
+                result.append((names[st_name : names.index(b"\0", st_name)].decode(),
+                               value))
+        return result
+
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+
+def load_elf(memory, fname, symtable = None):
+    """ Copia los segmentos cargables de 'fname' en 'memory' y, si se da
+        'symtable', agrega los simbolos. Devuelve el punto de entrada,
+        que tambien queda en memory.start_address.
+        Como en Memory.load_intel_hex, memory.load_errors se vacia al
+        empezar; cada segmento que no entra en la flash se anota ahi como
+        (numero de segmento cargable, mensaje).
+    """
+    with ElfFile(fname) as elf:
+        memory.load_errors = []
+        memory.start_address = elf.entry
+        ranges = []
+        for nr, (addr, data) in enumerate(elf.segments()):
+            if addr - memory.base + len(data) <= memory.size:
+                memory.write_block(addr, data)
+                ranges.append((addr, addr + len(data)))
+            else:
+                memory.load_errors.append((nr, "fuera de la flash"))
+            data.release()
+        memory.loaded(ranges)
+        if symtable != None:
+            symtable.add_many(elf.symbols((STT_FUNC,)))
+            symtable.add_many(elf.symbols((STT_OBJECT,)), code = False)
+        return elf.entry
+
+
+
+def main(args):
+    from sim_mem import Memory
+    from sym_table import Symbol_table
+
+    if len(args) < 2:
+        print("Uso: python3 sim_elf.py archivo.elf")
+        return 1
+    flash = Memory(32768, Memory.FLASH)
+    symtable = Symbol_table()
+    entry = load_elf(flash, args[1], symtable)
+    for nr, msg in flash.load_errors:
+        print("Segmento {:d}: {:s}".format(nr, msg))
+    print("Entrada: 0x{:04x}, ultimo byte: {:s}".format(entry, flash.get_highest_used(True)))
+    for line in symtable.dump_table():
+        print(line)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
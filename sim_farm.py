@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_farm.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Ejecucion de muchos trabajos (imagen hex + estado inicial + condicion
+    de parada) en paralelo, repartidos en un ProcessPoolExecutor.
+
+    Cada proceso construye decode_table y las tablas de la ALU una sola
+    vez (en init_worker) y conserva un cpu por archivo hex, de modo que
+    la cache de instrucciones decodificadas sigue caliente entre trabajos.
+    Cada trabajo arranca restaurando el snapshot tomado al cargar el hex.
+
+    Uso: python3 sim_farm.py [archivo.hex ...]
+"""
+
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from Atmega328 import Atmega328, StopReason
+from sim_alu import Alu
+
+
+class Job():
+    """ Un trabajo: que imagen cargar, con que estado arrancar, cuando
+        detenerse y que valores devolver.
+            registers:  {numero: valor} con los registros iniciales
+            memory:     {direccion: bytes} a escribir en el espacio de
+                        datos despues de restaurar el snapshot (antes de
+                        registers, flags y sp)
+            max_instructions, max_cycles: limites de Atmega328.run()
+            collect:    nombres a leer al terminar: "r0".."r31", "pc",
+                        "sp", "flags", "cycles", "reason", o una
+                        direccion de datos en hexa ("0x0100", un byte)
+            expect:     {nombre: valor} para decidir si paso o no
+    """
+    def __init__(self, name, hexfile, registers = None, flags = 0, pc = 0,
+                    sp = None, max_instructions = 1000000, until_pc = None,
+                    breakpoints = None, collect = (), expect = None,
+                    max_cycles = None, memory = None):
+        self.name = name
+        self.hexfile = hexfile
+        self.registers = registers or {}
+        self.memory = memory or {}
+        self.flags = flags
+        self.pc = pc
+        self.sp = sp
+        self.max_instructions = max_instructions
+        self.max_cycles = max_cycles
+        self.until_pc = until_pc
+        self.breakpoints = breakpoints
+        self.collect = tuple(collect)
+        self.expect = expect or {}
+
+
+class Result():
+    def __init__(self, name, passed, reason, pc, instructions, cycles,
+                    values, failures, seconds, error = None):
+        self.name = name
+        self.passed = passed
+        self.reason = reason            # Nombre del StopReason
+        self.pc = pc
+        self.instructions = instructions
+        self.cycles = cycles
+        self.values = values            # {nombre: valor} de Job.collect
+        self.failures = failures        # [(nombre, obtenido, esperado)]
+        self.seconds = seconds
+        self.error = error              # Texto de la excepcion, si hubo
+
+    def __str__(self):
+        if self.error != None:
+            return "{:s}: ERROR {:s}".format(self.name, self.error.splitlines()[-1])
+        s = "{:s}: {:s} - {:s} en 0x{:04x}, {:d} instrucciones, {:d} ciclos".format(
+                    self.name, "ok" if self.passed else "FALLO",
+                    self.reason, self.pc, self.instructions, self.cycles)
+        for name, got, expected in self.failures:
+            s += "\n    {:s} = {!r} (se esperaba {!r})".format(name, got, expected)
+        return s
+
+
+class Summary():
+    """ Totales de una serie de resultados
+    """
+    def __init__(self):
+        self.passed = 0
+        self.failed = 0
+        self.errors = 0
+        self.instructions = 0
+        self.cycles = 0
+        self.seconds = 0.0
+
+    def add(self, result):
+        if result.error != None:
+            self.errors += 1
+        elif result.passed:
+            self.passed += 1
+        else:
+            self.failed += 1
+        self.instructions += result.instructions
+        self.cycles += result.cycles
+        self.seconds += result.seconds
+
+    def __str__(self):
+        return ("{:d} correctos, {:d} fallidos, {:d} errores; "
+                "{:d} instrucciones, {:d} ciclos ({:.3f} s de cpu)").format(
+                    self.passed, self.failed, self.errors,
+                    self.instructions, self.cycles, self.seconds)
+
+
+#
+# Lado del proceso de trabajo
+#
+worker_cpus = {}                    # hexfile -> (mtime, cpu, snapshot)
+
+def init_worker():
+    """ Tablas compartidas, una vez por proceso
+    """
+    Atmega328.build_decode_table()
+    Alu.build()
+
+
+def worker_cpu(hexfile):
+    """ Devuelve el cpu de este proceso para 'hexfile' y el snapshot
+        recien cargado, recargandolo solo si el archivo cambio
+    """
+    mtime = os.stat(hexfile).st_mtime_ns
+    cached = worker_cpus.get(hexfile)
+    if cached != None and cached[0] == mtime:
+        return cached[1:]
+    cpu = Atmega328(None)
+    cpu.load_flash(hexfile)
+    cpu.cycle_accurate = True
+    boot = cpu.snapshot()
+    worker_cpus[hexfile] = (mtime, cpu, boot)
+    return cpu, boot
+
+
+def read_value(cpu, stop, name):
+    if name == "reason":
+        return StopReason.names[stop.reason]
+    if name[0] == "r" and name[1:].isdigit():
+        return cpu.ram[int(name[1:])]
+    if name.startswith("0x"):
+        return cpu.read_data(int(name, 16))
+    return getattr(cpu, name)
+
+
+def run_job(job):
+    t0 = time.perf_counter()
+    try:
+        cpu, boot = worker_cpu(job.hexfile)
+        cpu.restore(boot)
+        for addr, values in job.memory.items():
+            for offset, value in enumerate(values):
+                cpu.write_data(addr + offset, value)
+        for reg, value in job.registers.items():
+            cpu.ram[reg] = value
+        cpu.flags = job.flags
+        cpu.pc = job.pc
+        if job.sp != None:
+            cpu.sp = job.sp
+
+        stop = cpu.run(max_instructions = job.max_instructions,
+                       until_pc = job.until_pc,
+                       breakpoints = job.breakpoints,
+                       max_cycles = job.max_cycles)
+
+        values = {name: read_value(cpu, stop, name) for name in job.collect}
+        failures = []
+        for name, expected in job.expect.items():
+            got = read_value(cpu, stop, name)
+            if got != expected:
+                failures.append((name, got, expected))
+
+        return Result(job.name, not failures, StopReason.names[stop.reason],
+                      stop.pc, stop.instructions, stop.cycles, values,
+                      failures, time.perf_counter() - t0)
+
+    except Exception:
+        return Result(job.name, False, None, 0, 0, 0, {}, [],
+                      time.perf_counter() - t0, traceback.format_exc())
+
+
+#
+# Lado del proceso principal
+#
+class Farm():
+    """ Reparte trabajos entre 'workers' procesos (por defecto, uno por
+        nucleo). Usar como administrador de contexto:
+
+            with Farm() as farm:
+                for result in farm.run(jobs):
+                    ...
+    """
+    def __init__(self, workers = None):
+        self.pool = ProcessPoolExecutor(max_workers = workers,
+                                        initializer = init_worker)
+        self.summary = Summary()
+
+    def run(self, jobs):
+        """ Envia todos los trabajos y devuelve los Result a medida que
+            terminan (no en el orden de 'jobs'). Cada resultado se suma
+            tambien a self.summary.
+        """
+        futures = [self.pool.submit(run_job, job) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            self.summary.add(result)
+            yield result
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+
+def main(args):
+    import random
+
+    hexfiles = args[1:] or ["validate_hex.hex"]
+    jobs = []
+    for hexfile in hexfiles:
+        for n in range(32):
+            regs = {r: random.randrange(256) for r in range(32)}
+            jobs.append(Job("{:s}#{:d}".format(hexfile, n), hexfile,
+                            registers = regs,
+                            max_instructions = 20000 + 1000 * n,
+                            collect = ("r16", "flags"),
+                            expect = {"reason": "budget"}))
+
+    t0 = time.perf_counter()
+    with Farm() as farm:
+        for result in farm.run(jobs):
+            print(result)
+    print(farm.summary)
+    print("Tiempo total: {:.3f} s".format(time.perf_counter() - t0))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -10,11 +10,13 @@ import pdb
 from sim_gui_menu import MainMenu
 from sym_table import Symbol_table
 from Atmega328 import Atmega328
-from sim_sim import Disassembler
+from sim_dis import Disassembler
 
 IMAGE_DIR = "images/"
 
 class Tools(Gtk.Box):
+    RUN_BUDGET = 1000000            # Limite de instrucciones por "Ejecutar"
+
     def __init__(self, parent):
         super(Tools, self).__init__(
                     orientation = Gtk.Orientation.VERTICAL)
@@ -44,7 +46,11 @@ class Tools(Gtk.Box):
 
 
     def on_run_clicked(self, btn):
-        pass
+        self.parent.viewer.mark_pc(self.parent.cpu.pc, False)
+        stop = self.parent.cpu.run(max_instructions = self.RUN_BUDGET)
+        print("Detenido: {:s}".format(str(stop)))
+        self.parent.regs.update_registers()
+        self.parent.viewer.mark_pc(self.parent.cpu.pc)
 
 
     def on_stop_clicked(self, btn):
@@ -191,8 +197,22 @@ class Viewer(Gtk.Notebook):
         self.append_page(scroller, Gtk.Label("Flash"))
         
         
-    def update(self, new_text):
-        self.mem_buffer.set_text(new_text)
+    def update(self, lines):
+        """ Muestra un volcado: un texto o un iterable de lineas (p.ej.
+            Memory.iter_dump_words()), que se inserta por tandas
+        """
+        if isinstance(lines, str):
+            self.mem_buffer.set_text(lines)
+            return
+        self.mem_buffer.set_text("")
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == 256:
+                self.mem_buffer.insert(self.mem_buffer.get_end_iter(), "\n".join(chunk) + "\n")
+                chunk = []
+        if chunk:
+            self.mem_buffer.insert(self.mem_buffer.get_end_iter(), "\n".join(chunk) + "\n")
 
     def go_to_page(self, page_name):
         number = self.get_n_pages()
@@ -233,12 +253,32 @@ class Viewer(Gtk.Notebook):
         
     def add_disasm_page(self, page_name, dis_text):
         bff = self.add_page(page_name)
-        for line in dis_text.split('\n'):
+        if isinstance(dis_text, str):
+            dis_text = dis_text.split('\n')
+        for line in dis_text:
             self.dis_store.append( ("", line))
         self.reindex()
         self.parent.regs.update_registers()
 
 
+    def apply_disasm_diff(self, page_name, diff):
+        """ Aplica un ListingDiff de Disassembler.update a la pagina (que
+            se crea vacia si no existe), sin rearmar todo el listado
+        """
+        if self.go_to_page(page_name) == None:
+            self.add_page(page_name)
+        store = self.dis_store
+        for op, index, text in reversed(diff.edits):
+            if op == "insert":
+                store.insert(index, ("", text))
+            elif op == "delete":
+                store.remove(store.get_iter(index))
+            else:
+                store[index][1] = text
+        self.reindex()
+        self.parent.regs.update_registers()
+
+
     def reindex(self):
         self.dis_index = {}
         for row in self.dis_store:
@@ -274,7 +314,7 @@ class MainWindow(Gtk.Window):
         
         self.mainmenu = MainMenu(self)        
         self.viewer = Viewer(self)
-        self.viewer.update(self.cpu.flash.dump_words())
+        self.viewer.update(self.cpu.flash.iter_dump_words())
         self.tools = Tools(self)
         self.regs = Registers(self)
         
@@ -71,7 +71,7 @@ class MainMenu(Gtk.MenuBar):
         if dlg.run() == Gtk.ResponseType.ACCEPT:
             fname = dlg.get_filename()
             self.toplevel.cpu.flash.load_intel_hex(fname)
-            self.toplevel.viewer.update(self.toplevel.cpu.flash.dump_words())
+            self.toplevel.viewer.update(self.toplevel.cpu.flash.iter_dump_words())
         dlg.destroy()
         
         
@@ -86,14 +86,14 @@ class MainMenu(Gtk.MenuBar):
         if dlg.run() == Gtk.ResponseType.ACCEPT:
             fname = dlg.get_filename()
             self.toplevel.cpu.flash.load_intel_hex(fname)
-            self.toplevel.viewer.update(self.toplevel.cpu.flash.dump_words())
+            self.toplevel.viewer.update(self.toplevel.cpu.flash.iter_dump_words())
         dlg.destroy()
         
         
     def disasm(self, item):
-        self.toplevel.viewer.add_disasm_page(
+        self.toplevel.viewer.apply_disasm_diff(
                 "Desensamblado",
-                self.toplevel.dis.disassemble(0, self.toplevel.cpu.flash.get_highest_used()))
+                self.toplevel.dis.update(0, self.toplevel.cpu.flash.get_highest_used()))
             
     def exit_program(self, item):
         exit(0)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_journal.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Ejecucion inversa: registro de los cambios de cada instruccion.
+
+    Por cada paso se guarda una entrada con el estado anterior de pc,
+    SREG, ciclos y halted, y solo los bytes del espacio de datos
+    (registros, E/S con el sp, SRAM) que cambiaron, mas la flash entera
+    como snapshot inmutable en el raro caso de que el paso la modifique.
+    Las entradas viven en un buffer circular de 'max_steps' posiciones;
+    cada 'checkpoint_every' pasos se guarda un snapshot completo, de modo
+    que volver n pasos cuesta a lo sumo min(n, checkpoint_every) deshacer.
+
+    Uso:
+        cpu.journal = Journal(cpu)
+        cpu.run(...)
+        cpu.journal.step_back(10)
+"""
+
+from Atmega328 import Atmega328
+
+
+class Journal():
+    def __init__(self, cpu, max_steps = 100000, checkpoint_every = 1000):
+        self.cpu = cpu
+        self.max_steps = max_steps
+        self.checkpoint_every = checkpoint_every
+        self.entries = [None] * max_steps
+        self.checkpoints = {}       # paso -> Snapshot (estado antes del paso)
+        self.count = 0              # Pasos registrados (indice del proximo)
+        self.first = 0              # Paso mas antiguo que sigue en el buffer
+        self.pending = None         # Estado de begin() sin commit() todavia
+
+
+    def oldest(self):
+        """ Primer paso al que todavia se puede volver
+        """
+        return self.first
+
+
+    def begin(self):
+        """ Antes de ejecutar una instruccion
+        """
+        cpu = self.cpu
+        if self.count % self.checkpoint_every == 0:
+            self.checkpoints[self.count] = cpu.snapshot()
+            for step in [s for s in self.checkpoints if s < self.first]:
+                del self.checkpoints[step]
+        self.pending = (cpu.pc, cpu.flags, cpu.cycles, cpu.halted,
+                        bytes(cpu.data), cpu.flash.snapshot())
+
+
+    def commit(self):
+        """ Despues de ejecutar la instruccion: guarda solo lo que cambio.
+            Tambien si fallo (MemoryFault): lo que llego a escribir se
+            deshace con el paso.
+        """
+        cpu = self.cpu
+        pc, flags, cycles, halted, data, flash = self.pending
+        self.pending = None
+        changed = self.diff(data, cpu.data)
+        if flash[0] == cpu.flash.version:
+            flash = None
+        self.entries[self.count % self.max_steps] = (pc, flags, cycles,
+                                                     halted, changed, flash)
+        self.count += 1
+        if self.count - self.first > self.max_steps:
+            self.first += 1
+
+
+    @staticmethod
+    def diff(before, after):
+        """ Pares (direccion, valor anterior) de los bytes que cambiaron.
+            Una instruccion toca a lo sumo unos pocos bytes: el XOR de los
+            dos bloques como enteros dice donde estan sin recorrer todo.
+        """
+        if before == after:
+            return ()
+        x = int.from_bytes(before, "little") ^ int.from_bytes(after, "little")
+        changed = []
+        while x:
+            low = x & -x
+            i = low.bit_length() - 1 >> 3
+            changed.append((i, before[i]))
+            x &= ~(0xff << (i << 3))
+        return tuple(changed)
+
+
+    def undo(self, entry):
+        pc, flags, cycles, halted, changed, flash = entry
+        cpu = self.cpu
+        cpu.pc = pc
+        cpu.flags = flags
+        cpu.cycles = cycles
+        cpu.halted = halted
+        data = cpu.data
+        for i, old in changed:
+            data[i] = old
+        if flash != None:
+            cpu.flash.restore(flash)
+
+
+    def step_back(self, n = 1):
+        """ Vuelve n pasos atras (o hasta el paso mas antiguo registrado).
+            Devuelve la cantidad de pasos deshechos.
+        """
+        target = max(self.oldest(), self.count - n)
+        if target >= self.count:
+            return 0
+
+        # Checkpoint mas cercano por encima del destino: se restaura y se
+        # deshacen solo los pasos entre ambos
+        current = self.count
+        above = [s for s in self.checkpoints if target <= s < current]
+        if above:
+            current = min(above)
+            self.cpu.restore(self.checkpoints[current])
+        while current > target:
+            current -= 1
+            self.undo(self.entries[current % self.max_steps])
+
+        undone = self.count - target
+        self.count = target
+        for step in [s for s in self.checkpoints if s > target]:
+            del self.checkpoints[step]
+        return undone
+
+
+    def run_back_to(self, pc, max_steps = None):
+        """ Deshace pasos hasta que el pc sea 'pc'. Devuelve la cantidad de
+            pasos deshechos, o None si no se llego (y queda en el paso
+            mas antiguo que se pudo alcanzar).
+        """
+        limit = self.count - self.oldest()
+        if max_steps != None:
+            limit = min(limit, max_steps)
+        for n in range(1, limit + 1):
+            self.count -= 1
+            self.undo(self.entries[self.count % self.max_steps])
+            self.checkpoints.pop(self.count + 1, None)
+            if self.cpu.pc == pc:
+                return n
+        return None
+
+
+    def stats(self):
+        """ Devuelve (pasos disponibles, checkpoints guardados)
+        """
+        return self.count - self.oldest(), len(self.checkpoints)
+
+
+
+def check():
+    """ Falla a mitad de una instruccion: rcall con sp = 0 escribe la mitad
+        de la direccion de retorno en r0 y despues falla en 0xffff. Volver
+        un paso tiene que deshacer esa escritura. Devuelve True si anda.
+    """
+    from sim_asm import Assembler
+    from sim_mem import MemoryFault
+
+    asm = Assembler()
+    asm.assemble(["start: nop", "nop", "rcall start"])
+    cpu = Atmega328(None)
+    asm.load(cpu.flash)
+    cpu.journal = Journal(cpu)
+    cpu.sp = 0
+    cpu.ram[0] = 0xaa
+    stop = cpu.run(10)
+    ok = stop.fault != None and stop.pc == 4 and cpu.ram[0] == 0x03
+    ok = ok and cpu.journal.step_back(1) == 1
+    ok = ok and (cpu.pc, cpu.sp, cpu.ram[0]) == (4, 0, 0xaa)
+    ok = ok and cpu.journal.step_back(1) == 1 and cpu.pc == 2
+
+    # Igual con single_step
+    cpu.pc = 4
+    try:
+        cpu.single_step()
+        ok = False
+    except MemoryFault:
+        ok = ok and cpu.pc == 4 and cpu.ram[0] == 0x03
+    ok = ok and cpu.journal.step_back(1) == 1 and cpu.ram[0] == 0xaa
+    return ok
+
+
+def main(args):
+    cpu = Atmega328(None)
+    cpu.load_flash("validate_hex.hex")
+    cpu.journal = Journal(cpu, max_steps = 10000, checkpoint_every = 500)
+    print(cpu.run(max_instructions = 20000))
+    print("Pasos disponibles: {:d}, checkpoints: {:d}".format(*cpu.journal.stats()))
+    print("Deshechos: {:d}, pc = 0x{:04x}".format(cpu.journal.step_back(1234), cpu.pc))
+    print("Hasta 0x0000: {!r} pasos".format(cpu.journal.run_back_to(0)))
+    print("Volver atras despues de una falla: {:s}".format(
+                "Correcto" if check() else "Error"))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sim_lockstep.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+""" Motor vectorizado: N estados de cpu (espacio de datos, SREG, pc,
+    ciclos) en arreglos de NumPy, ejecutando el mismo programa a la vez.
+
+    En cada paso los carriles se agrupan por pc; cada grupo ejecuta su
+    instruccion con un nucleo vectorizado sobre los indices del grupo.
+    Las instrucciones sin nucleo se ejecutan carril por carril con el
+    single_step del cpu escalar, de modo que cada carril termina
+    exactamente en el mismo estado que dejaria single_step.
+"""
+
+import numpy as np
+
+from Atmega328 import Atmega328, StopReason
+from sim_mem import MemoryFault
+from sim_alu import (Alu, ADD_MASK, SUB_MASK, SBC_MASK, LOGIC_MASK,
+                     INC_MASK, COM_MASK, NEG_MASK, SHIFT_MASK, Z)
+from sim_block import is_empty
+
+
+class Lockstep():
+    """ 'cpu' aporta la flash, la decodificacion (y su cache) y la
+        ejecucion de respaldo; su propio estado se pisa en cada respaldo.
+    """
+    # Manejador -> (tabla, mascara, operando, usa carry, guarda, Z acumulado)
+    #   operando: "r" registro, "K" inmediato (d + 16), None instruccion de
+    #   un operando
+    ALU = {
+        Atmega328.f_add:  ("add", ADD_MASK, "r", False, True,  False),
+        Atmega328.f_adc:  ("add", ADD_MASK, "r", True,  True,  False),
+        Atmega328.f_sub:  ("sub", SUB_MASK, "r", False, True,  False),
+        Atmega328.f_sbc:  ("sub", SBC_MASK, "r", True,  True,  True),
+        Atmega328.f_cp:   ("sub", SUB_MASK, "r", False, False, False),
+        Atmega328.f_cpc:  ("sub", SBC_MASK, "r", True,  False, True),
+        Atmega328.f_subi: ("sub", SUB_MASK, "K", False, True,  False),
+        Atmega328.f_sbci: ("sub", SBC_MASK, "K", True,  True,  True),
+        Atmega328.f_cpi:  ("sub", SUB_MASK, "K", False, False, False),
+        Atmega328.f_inc:  ("inc", INC_MASK, None, False, True, False),
+        Atmega328.f_dec:  ("dec", INC_MASK, None, False, True, False),
+        Atmega328.f_com:  ("com", COM_MASK, None, False, True, False),
+        Atmega328.f_neg:  ("neg", NEG_MASK, None, False, True, False),
+        Atmega328.f_lsr:  ("lsr", SHIFT_MASK, None, False, True, False),
+        Atmega328.f_asr:  ("asr", SHIFT_MASK, None, False, True, False),
+        Atmega328.f_ror:  ("ror", SHIFT_MASK, None, True, True, False),
+    }
+
+    # Manejador -> (operacion, operando, guarda)
+    LOGIC = {
+        Atmega328.f_and:  (np.bitwise_and, "r", True),
+        Atmega328.f_or:   (np.bitwise_or,  "r", True),
+        Atmega328.f_eor:  (np.bitwise_xor, "r", True),
+        Atmega328.f_andi: (np.bitwise_and, "K", True),
+        Atmega328.f_ori:  (np.bitwise_or,  "K", True),
+        Atmega328.f_tst:  (None,           None, False),
+    }
+
+    tables = None
+
+    def __init__(self, cpu, lanes):
+        if Lockstep.tables == None:
+            Alu.build()
+            Lockstep.tables = {name: np.frombuffer(getattr(Alu, name),
+                                        np.uint16 if name != "logic" else np.uint8)
+                                 for name in ("add", "sub", "logic", "inc", "dec",
+                                              "com", "neg", "lsr", "asr", "ror")}
+        self.cpu = cpu
+        self.lanes = lanes
+        # Un espacio de datos por carril, con la misma forma que cpu.data;
+        # ram es una vista de los registros (como en Atmega328)
+        self.data = np.tile(np.frombuffer(cpu.data, np.uint8), (lanes, 1))
+        self.ram = self.data[:, :Atmega328.IO_START]
+        self.flags = np.zeros(lanes, np.uint8)
+        self.pc = np.full(lanes, cpu.pc, np.int64)
+        self.cycles = np.zeros(lanes, np.int64)
+        self.halted = np.full(lanes, -1, np.int8)  # StopReason o -1
+
+        self.kernels = {
+            Atmega328.f_mov:  self.k_mov,
+            Atmega328.f_movw: self.k_movw,
+            Atmega328.f_adiw: self.k_adiw,
+            Atmega328.f_brbs: self.k_brbs,
+            Atmega328.f_brbc: self.k_brbc,
+            Atmega328.f_rjmp: self.k_rjmp,
+            Atmega328.f_jmp:  self.k_jmp,
+            Atmega328.f_cpse: self.k_cpse,
+            Atmega328.f_break: self.k_break,
+            Atmega328.f_sleep: self.k_sleep,
+        }
+        self.vector_groups = 0      # Grupos ejecutados con nucleo
+        self.scalar_lanes = 0       # Carriles ejecutados con single_step
+
+
+    #
+    # Nucleos: idx son los carriles del grupo, todos en el mismo pc
+    #
+    def k_alu(self, idx, opd_dict, spec):
+        name, mask, src, carry, store, zkeep = spec
+        if src == "K":
+            d = opd_dict["d"] + 16
+        else:
+            d = opd_dict["d"]
+        rd = self.ram[idx, d].astype(np.int32)
+        flags = self.flags[idx]
+
+        if src == None:
+            i = rd
+            if carry:
+                i = i | ((flags & 0x01).astype(np.int32) << 8)
+        else:
+            i = rd << 8
+            if src == "r":
+                i = i | self.ram[idx, opd_dict["r"]]
+            else:
+                i = i | opd_dict["K"]
+            if carry:
+                i = i | ((flags & 0x01).astype(np.int32) << 16)
+
+        v = self.tables[name][i]
+        f = (v >> 8).astype(np.uint8)
+        if zkeep:
+            self.flags[idx] = (flags & (0xff & ~mask) & (f | (0xff & ~Z))) | (f & mask)
+        else:
+            self.flags[idx] = (flags & (0xff & ~mask)) | f
+        if store:
+            self.ram[idx, d] = v & 0xff
+
+
+    def k_logic(self, idx, opd_dict, spec):
+        op, src, store = spec
+        if src == "K":
+            d = opd_dict["d"] + 16
+            res = op(self.ram[idx, d], opd_dict["K"])
+        elif src == "r":
+            d = opd_dict["d"]
+            res = op(self.ram[idx, d], self.ram[idx, opd_dict["r"]])
+        else:
+            d = opd_dict["d"]
+            res = self.ram[idx, d]
+        self.flags[idx] = (self.flags[idx] & (0xff & ~LOGIC_MASK)) | self.tables["logic"][res]
+        if store:
+            self.ram[idx, d] = res
+
+
+    def k_mov(self, idx, opd_dict):
+        self.ram[idx, opd_dict["d"]] = self.ram[idx, opd_dict["r"]]
+
+
+    def k_movw(self, idx, opd_dict):
+        d = opd_dict["d"] * 2
+        r = opd_dict["r"] * 2
+        self.ram[idx, d:d + 2] = self.ram[idx, r:r + 2]
+
+
+    def k_adiw(self, idx, opd_dict):
+        # Mismas operaciones que Atmega328.f_adiw
+        d = opd_dict["d"] * 2 + 24
+        k = opd_dict["K"]
+        lo = self.ram[idx, d].astype(np.int32) + k
+        hi = self.ram[idx, d + 1].astype(np.int32) + k
+        dh7 = (self.ram[idx, d + 1] >> 7) & 0x01
+        r15 = ((hi >> 7) & 0x01).astype(np.uint8)
+        v = r15 & (dh7 ^ 1)
+        f = (v << 3) | (r15 << 2) | ((r15 ^ v) << 4) | (dh7 & (r15 ^ 1))
+        f |= (((lo & 0xff) == 0) & ((hi & 0xff) == 0)).astype(np.uint8) << 1
+        self.flags[idx] = (self.flags[idx] & 0xe0) | f
+        self.ram[idx, d] = lo & 0xff
+        self.ram[idx, d + 1] = hi & 0xff
+
+
+    def k_brbs(self, idx, opd_dict):
+        taken = idx[(self.flags[idx] >> opd_dict["s"]) & 0x01 == 1]
+        self.pc[taken] = self.cpu.calc_addr(int(self.pc[idx[0]]), opd_dict["k"], 128)
+        return taken
+
+
+    def k_brbc(self, idx, opd_dict):
+        taken = idx[(self.flags[idx] >> opd_dict["s"]) & 0x01 == 0]
+        self.pc[taken] = self.cpu.calc_addr(int(self.pc[idx[0]]), opd_dict["k"], 128)
+        return taken
+
+
+    @property
+    def sp(self):
+        return (self.data[:, Atmega328.SPL].astype(np.int64)
+                    | (self.data[:, Atmega328.SPH].astype(np.int64) << 8))
+
+
+    def k_rjmp(self, idx, opd_dict):
+        self.pc[idx] = (self.cpu.calc_addr(int(self.pc[idx[0]]), opd_dict["k"], 4096)
+                            & Atmega328.PC_MASK)
+
+
+    def k_jmp(self, idx, opd_dict):
+        self.pc[idx] = (opd_dict["k"] << 1) & Atmega328.PC_MASK
+
+
+    def k_cpse(self, idx, opd_dict):
+        skip = idx[self.ram[idx, opd_dict["d"]] == self.ram[idx, opd_dict["r"]]]
+        if len(skip):
+            entry = self.cpu.find_opcode(self.cpu.flash.get_word(int(self.pc[idx[0]])))
+            words = 2 if entry != None and entry.size == 4 else 1
+            self.pc[skip] += 2 * words
+            self.cycles[skip] += words
+        return None
+
+
+    def k_break(self, idx, opd_dict):
+        self.halted[idx] = StopReason.BREAK
+
+
+    def k_sleep(self, idx, opd_dict):
+        self.halted[idx] = StopReason.SLEEP
+
+
+    #
+    # Respaldo escalar
+    #
+    def scalar_step(self, lanes):
+        """ Ejecuta con single_step cada carril de 'lanes'. Un carril que
+            accede fuera de la memoria queda detenido con FAULT, con el pc
+            en la instruccion que fallo (como en Atmega328.run); los demas
+            siguen.
+        """
+        cpu = self.cpu
+        for lane in lanes:
+            cpu.data[:] = self.data[lane].tobytes()
+            cpu.flags = int(self.flags[lane])
+            cpu.pc = int(self.pc[lane])
+            cpu.cycles = int(self.cycles[lane])
+            cpu.halted = None
+            try:
+                cpu.single_step()
+            except MemoryFault:
+                cpu.halted = StopReason.FAULT
+            self.data[lane] = np.frombuffer(cpu.data, np.uint8)
+            self.flags[lane] = cpu.flags
+            self.pc[lane] = cpu.pc
+            self.cycles[lane] = cpu.cycles
+            if cpu.halted != None:
+                self.halted[lane] = cpu.halted
+        self.scalar_lanes += len(lanes)
+
+
+    def step_group(self, pc, idx):
+        """ Ejecuta la instruccion en 'pc' sobre los carriles idx
+        """
+        slot = self.cpu.fetch_decoded(pc)
+        if slot == None:                        # Igual que single_step
+            self.pc[idx] += 2
+            return
+        sim_instr, entry, opd_dict, size = slot
+
+        if sim_instr in self.ALU:
+            self.k_alu(idx, opd_dict, self.ALU[sim_instr])
+        elif sim_instr in self.LOGIC:
+            self.k_logic(idx, opd_dict, self.LOGIC[sim_instr])
+        elif sim_instr in self.kernels:
+            self.pc[idx] = pc + size
+            taken = self.kernels[sim_instr](idx, opd_dict)
+            self.cycles[idx] += entry.cycles[0]
+            if taken is not None and len(taken):
+                self.cycles[taken] += entry.cycles[1] - entry.cycles[0]
+            self.vector_groups += 1
+            return
+        elif not is_empty(sim_instr):
+            self.scalar_step(idx)
+            return
+
+        self.pc[idx] = pc + size
+        self.cycles[idx] += entry.cycles[0]
+        self.vector_groups += 1
+
+
+    def step(self, lanes = None):
+        """ Un paso en cada carril de 'lanes' (todos si es None)
+        """
+        if lanes is None:
+            lanes = np.arange(self.lanes)
+        if not len(lanes):
+            return
+        pcs = self.pc[lanes]
+        order = np.argsort(pcs, kind = "stable")
+        lanes = lanes[order]
+        pcs = pcs[order]
+        bounds = np.flatnonzero(np.diff(pcs)) + 1
+        for group in np.split(lanes, bounds):
+            self.step_group(int(self.pc[group[0]]), group)
+
+
+    def run(self, steps):
+        """ Hasta 'steps' pasos; los carriles que ejecutaron break o sleep,
+            o que fallaron, quedan detenidos (como en Atmega328.run).
+            Devuelve la cantidad de carriles todavia activos.
+        """
+        for _ in range(steps):
+            active = np.flatnonzero(self.halted < 0)
+            if not len(active):
+                break
+            self.step(active)
+        return int(np.count_nonzero(self.halted < 0))
+
+
+
+# Programa con instrucciones sin nucleo (pila, llamadas, ld/st), para check;
+# r21 cuenta las vueltas (ldi todavia no se simula)
+CHECK_PROGRAM = """
+loop:   st X+, r16
+        ld r18, -X
+        push r16
+        push r17
+        rcall sub
+        pop r19
+        pop r20
+        add r19, r20
+        dec r21
+        brne loop
+        break
+sub:    inc r16
+        call sub2
+        ret
+sub2:   st X, r17
+        ret
+"""
+
+def check(lanes = 16):
+    """ Ejecuta CHECK_PROGRAM en lockstep y compara cada carril con
+        Atmega328.run() desde el mismo estado inicial. Algunos carriles
+        arrancan con el sp o X fuera de la memoria, para que fallen.
+        Devuelve la cantidad de carriles distintos.
+    """
+    from sim_asm import Assembler
+
+    asm = Assembler()
+    if not asm.assemble(CHECK_PROGRAM.splitlines()):
+        raise Exception("No se pudo ensamblar: {!r}".format(asm.errors))
+    cpu = Atmega328(None)
+    asm.load(cpu.flash)
+    ls = Lockstep(cpu, lanes)
+    rng = np.random.default_rng(1)
+    ls.ram[:] = rng.integers(0, 256, (lanes, 32))
+    ls.ram[:, 21] = 4
+    ls.ram[:, 27] = rng.choice([0x01, 0x02, 0x08, 0x09], lanes)    # X alto
+    ls.ram[:, 26] = rng.choice([0x00, 0x80, 0xfe], lanes)
+    ls.data[0, Atmega328.SPH] = 0xff                    # Falla en el push
+    ls.flags[:] = rng.integers(0, 256, lanes)
+    initial = ls.data.copy(), ls.flags.copy()
+    ls.run(1000)
+
+    errors = 0
+    ref = Atmega328(None)
+    asm.load(ref.flash)
+    ref.cycle_accurate = True
+    for lane in range(lanes):
+        ref.data[:] = initial[0][lane].tobytes()
+        ref.flags = int(initial[1][lane])
+        ref.pc = 0
+        ref.cycles = 0
+        stop = ref.run(1000)
+        reason = -1 if stop.reason == StopReason.BUDGET else stop.reason
+        if ((bytes(ref.data), ref.flags, ref.pc, ref.cycles, reason) !=
+            (ls.data[lane].tobytes(), int(ls.flags[lane]), int(ls.pc[lane]),
+             int(ls.cycles[lane]), int(ls.halted[lane]))):
+            print("    Error, carril {:d}: {!s}".format(lane, stop))
+            errors += 1
+    return errors
+
+def main(args):
+    import time
+
+    lanes = int(args[1]) if len(args) > 1 else 1000
+    cpu = Atmega328(None)
+    cpu.load_flash("validate_hex.hex")
+    ls = Lockstep(cpu, lanes)
+    ls.ram[:] = np.random.randint(0, 256, (lanes, 32))
+    ls.flags[:] = np.random.randint(0, 256, lanes)
+
+    t0 = time.perf_counter()
+    ls.run(1000)
+    t = time.perf_counter() - t0
+    print("{:d} carriles x 1000 pasos: {:.3f} s ({:.0f} instr/s)".format(
+                lanes, t, lanes * 1000 / t))
+    print("Grupos vectorizados: {:d}, carriles escalares: {:d}".format(
+                ls.vector_groups, ls.scalar_lanes))
+    print("Comparacion con Atmega328.run (pila, llamadas, ld/st):")
+    print("    Correcto" if check() == 0 else "    Error")
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -23,18 +23,77 @@
 #  
 
 import pdb
+import itertools
+import os
+import mmap
+import struct
+from binascii import unhexlify
+
+unpack_word = struct.Struct("<H").unpack_from
+
+
+class MemoryFault(Exception):
+    """ Acceso fuera del rango de una memoria
+    """
+    def __init__(self, memtype, addr, size, write = False):
+        self.memtype = memtype
+        self.addr = addr
+        self.size = size
+        self.write = write
+        # (instrucciones, ciclos) completados antes de la falla, cuando
+        # ocurre dentro de un bloque de sim_block; None si no
+        self.partial = None
+        super().__init__("{:s} fuera de la memoria ({:s}): 0x{:04x}".format(
+                    "Escritura" if write else "Lectura",
+                    Memory.names[memtype], addr))
+
 
 class Memory():
     FLASH, EEPROM, SRAM, REG = range(4)
-    def __init__(self, size, memtype, base = 0):
+    names = ("flash", "eeprom", "sram", "registros")
+    versions = itertools.count(1)       # Numeros de version, unicos
+    def __init__(self, size, memtype, base = 0, check_init = False):
         self.size = size
         self.memtype = memtype
         self.base = base
         self.highest_used = None
         
-        self.mem = bytearray(self.size)
+        # La flash y la eeprom borradas leen 0xff, como en el chip
+        erased = 0xff if memtype in (Memory.FLASH, Memory.EEPROM) else 0
+        self.mem = bytearray([erased]) * self.size
         self.bitmap = bytearray(self.size // 8)
+        self.watchers = []
+        self.version = next(self.versions)  # Cambia con cada escritura
+        self.frozen = None                  # Ultimo snapshot() tomado
+        self.load_errors = []               # De la ultima carga de archivo
+        self.start_address = None
+        self.set_check_init(check_init)
+        
+
+    def set_check_init(self, enabled):
+        """ Opcion de depuracion: si esta activa, get_byte y get_word
+            devuelven None para los bytes nunca escritos (consultando el
+            bitmap en cada acceso). Si no, leen el contenido directamente.
+        """
+        self.check_init = enabled
+        if enabled:
+            self.get_byte = self.get_byte_checked
+            self.get_word = self.get_word_checked
+        else:
+            self.__dict__.pop("get_byte", None)
+            self.__dict__.pop("get_word", None)
+
+
+    def add_watcher(self, fn):
+        """ Registra fn(start, end), llamada despues de cada escritura en
+            el rango de bytes [start, end)
+        """
+        self.watchers.append(fn)
+        
         
+    def notify(self, start, end):
+        for fn in self.watchers:
+            fn(start, end)
 
     def empty(self, addr):
         """ Retorna True/False si 'addr' esta inicializada
@@ -61,33 +120,70 @@ class Memory():
 
         
     def save_byte(self, addr, value):
-        if (addr - self.base) >= self.size:
-            print("Acceso fuera de la memoria")
-            return
+        if not 0 <= addr - self.base < self.size:
+            raise MemoryFault(self.memtype, addr, self.size, True)
             
         self.update_highest_used(addr)
         self.mem[addr - self.base] = value
         self.mark(addr)
+        self.version = next(self.versions)
+        if self.watchers:
+            self.notify(addr, addr + 1)
         
         
     def get_byte(self, addr):
-        if (addr - self.base) >= self.size:
-            print("Acceso fuera de la memoria")
-            return
-        if self.empty(addr): 
-            return
-        return self.mem[addr - self.base]
+        offs = addr - self.base
+        if 0 <= offs < self.size:
+            return self.mem[offs]
+        raise MemoryFault(self.memtype, addr, self.size)
         
         
     def get_word(self, addr):
         assert (addr % 2) == 0
+        offs = addr - self.base
+        if 0 <= offs < self.size - 1:
+            return unpack_word(self.mem, offs)[0]
+        raise MemoryFault(self.memtype, addr, self.size)
         
-        if (addr - self.base) >= self.size:
-            print("Acceso fuera de la memoria")
+        
+    def get_byte_checked(self, addr):
+        b = Memory.get_byte(self, addr)
+        if self.empty(addr): 
             return
+        return b
+        
+        
+    def get_word_checked(self, addr):
+        w = Memory.get_word(self, addr)
         if self.empty(addr) or self.empty(addr + 1): 
             return
-        return self.mem[addr - self.base] + (self.mem[addr - self.base + 1] << 8)
+        return w
+        
+        
+    def snapshot(self):
+        """ Copia inmutable del contenido. Mientras no haya escrituras se
+            devuelve la misma copia, sin volver a copiar.
+        """
+        if self.frozen == None or self.frozen[0] != self.version:
+            self.frozen = (self.version, bytes(self.mem), bytes(self.bitmap),
+                           self.highest_used)
+        return self.frozen
+        
+        
+    def restore(self, state):
+        """ Vuelve al contenido de un snapshot(). Si la memoria no cambio
+            desde entonces no se copia nada (ni se avisa a los observadores).
+        """
+        version, mem, bitmap, highest_used = state
+        if version == self.version:
+            return
+        self.mem[:] = mem
+        self.bitmap[:] = bitmap
+        self.highest_used = highest_used
+        self.version = version
+        self.frozen = state
+        if self.watchers:
+            self.notify(self.base, self.base + self.size)
         
         
     def mark(self, addr):
@@ -95,75 +191,209 @@ class Memory():
         self.bitmap[b // 8] |= (1 << (b % 8))
        
        
-    def dump(self):
-        s = "      +0 +1 +2 +3 +4 +5 +6 +7 +8 +9 +A +B +C +D +E +F"
-        for offs in range(self.size):
-            if (offs % 16) == 0:
-                s += "\n{:04x}: ".format(offs + self.base)
-            if self.empty(offs + self.base):
-                s+= "-- "
+    def extent(self, start = None, end = None, row = 16):
+        """ Rango [start, end) a mostrar, alineado a filas de 'row' bytes.
+            Por defecto va del primer al ultimo byte inicializado.
+        """
+        if start == None:
+            used = len(self.bitmap) - len(self.bitmap.lstrip(b"\0"))
+            start = self.base + used * 8
+        if end == None:
+            end = start if self.highest_used == None else self.highest_used + 1
+        start = max(start, self.base) & ~(row - 1)
+        end = min(end, self.base + self.size)
+        return start, (end + row - 1) & ~(row - 1)
+
+
+    def rows(self, start, end):
+        """ Genera (direccion, bytes de la fila, estado) por cada fila de
+            16 bytes; estado es True (todos inicializados), False (ninguno)
+            o la lista de bytes vacios.
+        """
+        mem = memoryview(self.mem)
+        bitmap = self.bitmap
+        for addr in range(start, end, 16):
+            offs = addr - self.base
+            marks = bitmap[offs >> 3 : (offs >> 3) + 2]
+            if marks == b"\xff\xff":
+                yield addr, mem[offs : offs + 16], True
+            elif marks == b"\0\0":
+                yield addr, None, False
             else:
-                s += "{:02x} ".format(self.mem[offs])
-         
-        return s + "\n"
-        
-        
-    def dump_words(self):
-        s = "       +0   +1   +2   +3   +4   +5   +6   +7 "
-        for offs in range(0, self.size, 2):
-            if (offs % 16) == 0:
-                s += "\n{:04x}: ".format(offs + self.base)
-            if self.empty(offs + self.base):
-                s+= "---- "
+                yield addr, mem[offs : offs + 16], [self.empty(addr + i) for i in range(16)]
+
+
+    def iter_dump(self, start = None, end = None):
+        """ Genera las lineas del volcado de bytes de [start, end) (por
+            defecto, la zona inicializada). Una serie de filas vacias se
+            resume en una sola linea "*".
+        """
+        yield "      +0 +1 +2 +3 +4 +5 +6 +7 +8 +9 +A +B +C +D +E +F"
+        collapsed = False
+        for addr, data, state in self.rows(*self.extent(start, end)):
+            if state is False:
+                if not collapsed:
+                    yield "*"
+                    collapsed = True
+                continue
+            collapsed = False
+            if state is True:
+                yield "{:04x}: {:s}".format(addr, data.hex(" "))
             else:
-                s += "{:04x} ".format((self.mem[offs+1] << 8) + self.mem[offs])
-         
-        return s + "\n"
-        
-        
+                yield "{:04x}: {:s}".format(addr, " ".join(
+                            "--" if empty else "{:02x}".format(b)
+                                for b, empty in zip(data, state)))
+
+
+    def iter_dump_words(self, start = None, end = None):
+        """ Como iter_dump, pero en palabras de 16 bits (8 por fila)
+        """
+        yield "       +0   +1   +2   +3   +4   +5   +6   +7 "
+        collapsed = False
+        swapped = bytearray(16)
+        for addr, data, state in self.rows(*self.extent(start, end)):
+            if state is False:
+                if not collapsed:
+                    yield "*"
+                    collapsed = True
+                continue
+            collapsed = False
+            swapped[0::2] = data[1::2]          # Palabras little endian
+            swapped[1::2] = data[0::2]
+            if state is True:
+                yield "{:04x}: {:s}".format(addr, swapped.hex(" ", 2))
+            else:
+                yield "{:04x}: {:s}".format(addr, " ".join(
+                            "----" if state[i] and state[i + 1] else swapped[i : i + 2].hex()
+                                for i in range(0, 16, 2)))
+
+
+    def dump(self, start = None, end = None):
+        return "\n".join(self.iter_dump(start, end)) + "\n"
+
+
+    def dump_words(self, start = None, end = None):
+        return "\n".join(self.iter_dump_words(start, end)) + "\n"
+
+
+    def mark_range(self, start, end):
+        """ Marca como inicializados los bytes [start, end): bit a bit en
+            los extremos y de a bytes enteros del bitmap en el medio
+        """
+        b, e = start - self.base, end - self.base
+        bitmap = self.bitmap
+        while b < e and (b & 7):
+            bitmap[b >> 3] |= 1 << (b & 7)
+            b += 1
+        full = (e - b) >> 3
+        if full > 0:
+            bitmap[b >> 3 : (b >> 3) + full] = b"\xff" * full
+            b += full << 3
+        while b < e:
+            bitmap[b >> 3] |= 1 << (b & 7)
+            b += 1
+
+
+    def write_block(self, addr, data):
+        """ Escribe 'data' desde 'addr' con una sola asignacion de rebanada.
+            Marca el bitmap y actualiza highest_used, pero no cambia la
+            version ni avisa a los observadores (ver load_intel_hex).
+        """
+        offs = addr - self.base
+        if offs < 0 or offs + len(data) > self.size:
+            raise MemoryFault(self.memtype, addr + len(data) - 1, self.size, True)
+        self.mem[offs : offs + len(data)] = data
+        self.mark_range(addr, addr + len(data))
+        self.update_highest_used(addr + len(data) - 1)
+
+
     def load_intel_hex(self, fname):
-        with open(fname, "r") as hexf:
-            for line in hexf.readlines():
-                line = line.rstrip('\n ')
-                if len(line) < 11:
-                    continue
-                if line[0] != ':':
-                    continue
-                # Linea parece contener datos
-                checksum = 0
-                nr_bytes = int(line[1 : 3], 16)
-                checksum += nr_bytes
-                addr_h = int(line[3 : 5], 16)
-                checksum += addr_h
-                addr_l = int(line[5 : 7], 16)
-                checksum += addr_l
-                kind = int(line[7 : 9], 16)
-                checksum += kind
-                
-                addr = (addr_h << 8) + addr_l
-                
-                #pdb.set_trace()
-                if kind == 1:           # Fin del archivo?
-                    t = int(line[9 : 11], 16)
-                    checksum += t
-                    if (checksum & 0xff) == 0:
-                        break
-                    else:
-                        return False
-                        
-                elif kind != 0:
+        """ Carga un archivo Intel HEX. Cada registro se decodifica entero
+            con unhexlify y sus datos se copian de una vez en mem y en
+            el bitmap. Soporta direcciones extendidas de segmento (02) y
+            lineales (04); la direccion de arranque (03/05) queda en
+            self.start_address.
+            Los registros con errores se saltean y se anotan en
+            self.load_errors como (numero de linea, mensaje). Devuelve True
+            si no hubo errores.
+            Al final se avisa a los observadores una vez por cada rango
+            contiguo escrito.
+        """
+        self.load_errors = []
+        self.start_address = None
+        ranges = []                     # [inicio, fin) de lo escrito
+        upper = 0                       # Base de registros 02/04
+        with open(fname, "rb") as hexf:
+            lines = hexf.read().splitlines()
+
+        for nr, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line.startswith(b":"):
+                continue
+            try:
+                rec = unhexlify(line[1:])
+            except ValueError:
+                self.load_errors.append((nr, "digitos hexadecimales invalidos"))
+                continue
+            if len(rec) < 5 or len(rec) != rec[0] + 5:
+                self.load_errors.append((nr, "longitud de registro incorrecta"))
+                continue
+            if sum(rec) & 0xff:
+                self.load_errors.append((nr, "checksum incorrecto"))
+                continue
+
+            kind = rec[3]
+            data = rec[4:-1]
+            if kind == 0:               # Datos
+                addr = upper + ((rec[1] << 8) | rec[2])
+                try:
+                    self.write_block(addr, data)
+                except MemoryFault as fault:
+                    self.load_errors.append((nr, str(fault)))
                     continue
-                    
-                # La linea contiene datos
-                for offs in range(nr_bytes):
-                    b = int(line[9 + offs*2 : 11 + offs*2], 16)
-                    checksum += b
-                    self.save_byte(addr + offs, b)
-                    
-                b = int(line[-2:], 16)
-                checksum += b
-                if (checksum & 0xff) != 0:
-                    return False
+                if ranges and ranges[-1][1] == addr:
+                    ranges[-1][1] = addr + len(data)
+                else:
+                    ranges.append([addr, addr + len(data)])
+            elif kind == 1:             # Fin del archivo
+                break
+            elif kind == 2:             # Direccion extendida de segmento
+                upper = int.from_bytes(data, "big") << 4
+            elif kind == 4:             # Direccion extendida lineal
+                upper = int.from_bytes(data, "big") << 16
+            elif kind in (3, 5):        # Direccion de arranque
+                self.start_address = int.from_bytes(data, "big")
+            else:
+                self.load_errors.append((nr, "tipo de registro {:02x} desconocido".format(kind)))
+
+        self.loaded(ranges)
+        return not self.load_errors
+
+
+    def loaded(self, ranges):
+        """ Cierre de una carga hecha con write_block: nueva version y un
+            aviso a los observadores por cada rango [inicio, fin)
+        """
+        if ranges:
+            self.version = next(self.versions)
+            if self.watchers:
+                for start, end in ranges:
+                    self.notify(start, end)
+
+
+    def load_bin(self, fname, addr = 0):
+        """ Carga un archivo binario crudo desde 'addr', mapeandolo en
+            memoria y copiandolo con una sola asignacion
+        """
+        self.load_errors = []
+        self.start_address = None
+        with open(fname, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return True
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                self.write_block(addr, mm)
+                self.loaded([(addr, addr + len(mm))])
+        return True
                 
        
 
@@ -22,53 +22,9 @@
 #
 #
 
-import re
-import pdb
-from sim_mem import Memory
 from Atmega328 import Atmega328
 from sym_table import Symbol_table
-
-
-class Disassembler():
-    def __init__(self, cpu):
-        self.cpu = cpu
-        print("Numero de instrucciones: ", len(self.cpu.opcodes))
-
-
-    def load_flash(self, prog_name):
-        self.cpu.load_flash(prog_name)
-
-
-    def disassemble(self, pc, end):
-        # Pasada 1: Recoleccion de etiquetas
-        tpc = pc
-        while tpc < end:
-            r = self.cpu.disassemble_one_instruction(tpc, self.cpu.symtable)
-            if r == None:
-                raise Exception("No puedo desensamblar en 0x{:04x}".format(tpc))
-            tpc = r[1]
-
-        # Pasada 2: Generacion del listado
-        tpc = pc
-        s = ""
-        while tpc < end:
-            r = self.cpu.disassemble_one_instruction(tpc, self.cpu.symtable)
-            if r != None:
-                lbl = self.cpu.symtable.create_label(tpc)
-                sym = self.cpu.symtable.find_symbol(lbl)
-                if type(sym) != bool:                   # Para detectar False!
-                    s += "     {:s}:\n".format(lbl)
-                s += "{:04x}{:s}\n".format(tpc, r[0])
-                tpc = r[1]
-            else:
-                break
-
-        s += "\n"
-        s += "Tabla de simbolos\n"
-        for l in self.cpu.symtable.dump_table():
-            s += l + "\n"
-
-        return s
+from sim_dis import Disassembler
 
 
 
@@ -22,19 +22,105 @@
 #  
 #  
 
+from bisect import bisect_left, bisect_right, insort
+
+
 class Symbol_table():
+    """ Tabla nombre -> valor, con indices para buscar por direccion:
+            by_addr:    valor -> [nombres] (solo valores enteros)
+            addrs:      valores distintos, ordenados (para bisect)
+            by_code:    como by_addr, solo con los simbolos de codigo
+                        (funciones y etiquetas), no los de datos o
+                        constantes, que estan en otro espacio
+            code_addrs: claves de by_code, ordenadas
+            names:      nombres ordenados (para dump_table)
+    """
     def __init__(self):
         self.table = {}
+        self.by_addr = {}
+        self.addrs = []
+        self.by_code = {}
+        self.code_addrs = []
+        self.names = []
+        
+        
+    def index(self, sym, value, code = True):
+        """ Agrega 'sym' = 'value' a los indices
+        """
+        if sym not in self.table:
+            insort(self.names, sym)
+        if isinstance(value, int):
+            indexes = ((self.by_addr, self.addrs), (self.by_code, self.code_addrs))
+            for by_addr, addrs in indexes[: 2 if code else 1]:
+                names = by_addr.get(value)
+                if names == None:
+                    by_addr[value] = [sym]
+                    insort(addrs, value)
+                elif sym not in names:
+                    names.append(sym)
         
         
-    def add(self, sym, value = None):
+    def add(self, sym, value = None, code = True):
+        """ Agrega 'sym' = 'value'; 'code' dice si es una direccion de la
+            flash (ver by_code)
+        """
         if  ((sym in self.table) and 
              (self.table[sym] != None) and 
              (self.table[sym] != value)):
             print("Valor definido con otro valor")
             return False
             
-        self.table[sym] = value
+        if sym not in self.table or self.table[sym] != value:
+            self.index(sym, value, code)
+            self.table[sym] = value
+        return True
+        
+        
+    def add_many(self, items, code = True):
+        """ Agrega de una vez muchos pares (simbolo, valor), todos de codigo
+            o todos no (ver add). Los simbolos que ya tenian otro valor lo
+            conservan; se devuelve la lista de esos simbolos.
+        """
+        new = dict(items)
+        table = self.table
+        conflicts = [sym for sym in new.keys() & table.keys()
+                        if table[sym] != None and table[sym] != new[sym]]
+        for sym in conflicts:
+            del new[sym]
+        table.update(new)
+
+        # Los indices se rearman una sola vez
+        indexes = (self.by_addr, self.by_code)[: 2 if code else 1]
+        for sym, value in new.items():
+            if isinstance(value, int):
+                for by_addr in indexes:
+                    names = by_addr.setdefault(value, [])
+                    if sym not in names:
+                        names.append(sym)
+        self.addrs = sorted(self.by_addr)
+        self.code_addrs = sorted(self.by_code)
+        self.names = sorted(table)
+        return conflicts
+        
+        
+    def remove(self, sym):
+        """ Quita 'sym' de la tabla y de los indices. Devuelve False si no
+            estaba.
+        """
+        if sym not in self.table:
+            return False
+        value = self.table.pop(sym)
+        del self.names[bisect_left(self.names, sym)]
+        if isinstance(value, int):
+            for by_addr, addrs in ((self.by_addr, self.addrs),
+                                   (self.by_code, self.code_addrs)):
+                names = by_addr.get(value)
+                if names == None or sym not in names:
+                    continue
+                names.remove(sym)
+                if not names:
+                    del by_addr[value]
+                    del addrs[bisect_left(addrs, value)]
         return True
         
         
@@ -55,12 +141,59 @@ class Symbol_table():
             
     def find_none(self):
         return None in self.table.values();
+        
+        
+    def has_label(self, addr):
+        """ Hay algun simbolo de codigo en la direccion 'addr'?
+        """
+        return addr in self.by_code
+        
+        
+    def labels_at(self, addr):
+        """ Simbolos de codigo en 'addr' (lista vacia si no hay)
+        """
+        return self.by_code.get(addr, [])
+        
+        
+    def containing(self, addr):
+        """ Simbolo de codigo mas cercano en o antes de 'addr' (p.ej. la
+            funcion que contiene un pc): (nombre, valor), o None si no hay
+        """
+        i = bisect_right(self.code_addrs, addr)
+        if i == 0:
+            return None
+        value = self.code_addrs[i - 1]
+        return self.by_code[value][0], value
+        
+        
+    def symbol_offset(self, addr):
+        """ 'addr' como "simbolo+0x..." (o solo "simbolo"); None si no hay
+            simbolo antes
+        """
+        found = self.containing(addr)
+        if found == None:
+            return None
+        sym, value = found
+        if addr == value:
+            return sym
+        return "{:s}+0x{:x}".format(sym, addr - value)
+        
+        
+    def sorted_items(self):
+        """ Genera (simbolo, valor) en orden de nombre, sin reordenar
+        """
+        table = self.table
+        for sym in self.names:
+            yield sym, table[sym]
+            
+            
+    def format_entry(self, sym, value):
+        return "{:>20s} = {:s}".format(sym, str(value))
+            
             
     def dump_table(self):
-        out = []
-        for sym, val in sorted(self.table.items()):
-            out.append("{:>20s} = {:s}".format(sym, str(val)))
-        return out
+        for sym, val in self.sorted_items():
+            yield self.format_entry(sym, val)
         
         
 
@@ -69,11 +202,13 @@ def main(args):
     st.add("main", 1234)
     st.add("nodef", None)
     st.add("xref", 4321)
+    st.add("buf", 0x0100, code = False)
     print("Tabla de simbolos:")
     for line in st.dump_table():
         print(line)
     print("Etiquetas sin definir: ", st.find_none())
     print("Valor de 'main': ", st.find_symbol("main"))
+    print("0x04e0 es: ", st.symbol_offset(0x04e0))
         
     return 0
 